@@ -2,12 +2,10 @@ from flask import Flask, request, abort, redirect, url_for, jsonify
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, 
+    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, PushMessageRequest,
     TextMessage, FlexMessage, FlexContainer
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, PostbackEvent
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime
 import re
 import os
@@ -16,8 +14,23 @@ import logging
 from user_management import UserManager
 from stripe_payment import StripePayment
 from excel_online import ExcelOnlineManager
+from google_sheets import GoogleSheetsClientManager, SheetHandleCache, RowCursorCache
+from sheet_columns import col_to_num
+from dispatcher import KeyedExecutor
+from metrics import LatencyRecorder
+from command_router import CommandRouter
+from estimate_parser import (
+    BULK_COMMAND_PATTERN, parse_estimate_records, parse_bulk_records, is_product_record, split_product_type,
+    has_product_fields, find_incomplete_products
+)
 import sqlite3
 import traceback
+import atexit
+import time
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+from functools import lru_cache
 
 # ログ設定
 logging.basicConfig(
@@ -49,9 +62,38 @@ DEFAULT_SHEET_NAME = os.environ.get('DEFAULT_SHEET_NAME', '比較見積書 ロ
 SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID', SHARED_SPREADSHEET_ID)
 SHEET_NAME = os.environ.get('SHEET_NAME', DEFAULT_SHEET_NAME)
 
+# gunicornのスレッド数（DockerfileのGUNICORN_THREADSと同じ値）。各スレッドプール・接続プールの既定値に使う
+SERVER_THREADS = int(os.environ.get('GUNICORN_THREADS', 8))
+
 configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+# LINE APIへの接続プール（gunicornのスレッド数に合わせる）
+configuration.connection_pool_maxsize = int(os.environ.get('LINE_POOL_SIZE', SERVER_THREADS))
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# プロセス全体で共有するLINE APIクライアント（接続とTLSセッションを使い回す）
+_line_api_client = None
+_line_api_client_lock = threading.Lock()
+
+def get_line_api_client():
+    """共有ApiClientを取得（初回呼び出し時に作成）"""
+    global _line_api_client
+    if _line_api_client is None:
+        with _line_api_client_lock:
+            if _line_api_client is None:
+                _line_api_client = ApiClient(configuration)
+    return _line_api_client
+
+@contextmanager
+def shared_api_client():
+    """`with ApiClient(configuration)`の代わりに使う（withを抜けても接続を閉じない）"""
+    yield get_line_api_client()
+
+# LINE API呼び出しのレイテンシ（返信・プッシュ別）
+line_api_latency = {
+    'reply': LatencyRecorder(),
+    'push': LatencyRecorder()
+}
+
 # ユーザー管理システムの初期化
 try:
     user_manager = UserManager()
@@ -75,12 +117,102 @@ try:
     logger.info(f"MS_CLIENT_SECRET: {os.environ.get('MS_CLIENT_SECRET', 'NOT_SET')[:10]}..." if os.environ.get('MS_CLIENT_SECRET') else 'NOT_SET')
     logger.info(f"MS_TENANT_ID: {os.environ.get('MS_TENANT_ID', 'NOT_SET')}")
     
-    excel_online_manager = ExcelOnlineManager()
+    # Graph APIへの接続プール（gunicornのスレッド数に合わせる）
+    excel_online_manager = ExcelOnlineManager(
+        pool_size=int(os.environ.get('GRAPH_POOL_SIZE', SERVER_THREADS))
+    )
     logger.info("Excel Online system initialized successfully")
 except Exception as e:
     logger.error(f"Excel Online system initialization error: {e}")
     excel_online_manager = None
 
+# Google Sheetsクライアント管理の初期化（認証はプロセスごとに1回）
+try:
+    google_sheets_manager = GoogleSheetsClientManager(SCOPES)
+    logger.info("Google Sheets client manager initialized successfully")
+except Exception as e:
+    logger.error(f"Google Sheets client manager initialization error: {e}")
+    google_sheets_manager = None
+
+# Spreadsheet/Worksheetハンドルのキャッシュ（(spreadsheet_id, sheet_name)ごと）
+sheet_handle_cache = SheetHandleCache(
+    max_entries=int(os.environ.get('SHEET_HANDLE_CACHE_SIZE', 128)),
+    ttl_seconds=int(os.environ.get('SHEET_HANDLE_CACHE_TTL', 600))
+)
+
+# 商品タイプごとの次の書き込み行カーソル（ROW_CURSOR_PERSIST=1でSQLiteにも保存）
+# メモリ上のカーソルは1プロセス内でしか排他できないため、gunicornのワーカーが
+# 複数（WEB_CONCURRENCY>1）の場合は常にSQLiteに保存する
+ROW_CURSOR_PERSIST = (os.environ.get('ROW_CURSOR_PERSIST') == '1'
+                      or int(os.environ.get('WEB_CONCURRENCY', 1)) > 1)
+if ROW_CURSOR_PERSIST and not user_manager:
+    print("警告: データベースが利用できないため、書き込み行カーソルを共有できません（ワーカーは1つにしてください）")
+row_cursor_cache = RowCursorCache(
+    revalidate_seconds=int(os.environ.get('ROW_CURSOR_REVALIDATE_SECONDS', 300)),
+    db_path=user_manager.db_path if user_manager and ROW_CURSOR_PERSIST else None
+)
+
+def on_user_target_change(user_id, change_type, old_values, new_values):
+    """ユーザーの書き込み先が変わったら関連するキャッシュを破棄"""
+    if change_type == 'spreadsheet':
+        for values in (old_values, new_values):
+            if values.get('spreadsheet_id'):
+                sheet_handle_cache.invalidate(values['spreadsheet_id'])
+
+if user_manager:
+    user_manager.add_change_listener(on_user_target_change)
+
+# Webhookイベントの処理キュー（ユーザーごとに到着順で直列実行、ユーザー間は並列）
+# WEBHOOK_ASYNC=1で/callbackは署名検証後すぐに200を返す
+# 同期モードではリクエストスレッドがシャードの完了を待つので、シャード数はスレッド数以上にする
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '0') == '1'
+webhook_executor = KeyedExecutor(
+    shards=int(os.environ.get('WEBHOOK_WORKERS', SERVER_THREADS)),
+    queue_size=int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100)),
+    name='webhook'
+)
+if WEBHOOK_ASYNC:
+    logger.info("Webhook async dispatch enabled")
+
+webhook_stats = {'events': 0, 'queued': 0, 'blocked': 0, 'refused': 0}
+webhook_stats_lock = threading.Lock()
+
+def count_webhook(name):
+    with webhook_stats_lock:
+        webhook_stats[name] += 1
+
+# 時間のかかる処理（リセット・商品書き込み）の実行用スレッド
+# REPLY_DEADLINE_SECONDSを超えたら「処理中」を返信し、結果はプッシュで送る
+REPLY_DEADLINE_SECONDS = float(os.environ.get('REPLY_DEADLINE_SECONDS', 10))
+slow_task_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SLOW_TASK_WORKERS', SERVER_THREADS)),
+    thread_name_prefix='slow-task'
+)
+
+def shutdown_background_workers():
+    """プロセス終了時に処理待ちの仕事を流し切ってから、依存される側を後に停止する
+
+    atexitは登録と逆順に実行されるため、順序が必要な停止処理はここにまとめる。
+    """
+    # キューに残ったイベントを処理（リセット・商品書き込みはslow_task_executorを使う）
+    webhook_executor.shutdown()
+    slow_task_executor.shutdown(wait=True)
+    # 利用履歴のバッファを書き込んでからDB接続を閉じる
+    if user_manager:
+        user_manager.close()
+    # 結果のプッシュが終わってからLINE APIの接続を閉じる
+    if _line_api_client is not None:
+        _line_api_client.close()
+
+atexit.register(shutdown_background_workers)
+
+response_stats = {'reply': 0, 'processing': 0, 'push': 0, 'reply_failed': 0, 'push_failed': 0}
+response_stats_lock = threading.Lock()
+
+def count_response(path):
+    with response_stats_lock:
+        response_stats[path] += 1
+
 # ユーザーセッション管理（簡易版）
 user_sessions = {}
 
@@ -129,71 +261,11 @@ SHEET_WRITE_CONFIG = {
 }
 
 def setup_google_sheets():
-    """Google Sheets APIの設定"""
-    try:
-        print("=== Google Sheets設定開始 ===")
-        
-        # ローカルファイルを優先的に使用
-        if os.path.exists('gsheet_service_account.json'):
-            print("ローカルファイルからサービスアカウント情報を読み込み中...")
-            creds = Credentials.from_service_account_file(
-                'gsheet_service_account.json', scopes=SCOPES)
-            print("ローカルファイルからの読み込み成功")
-        else:
-            # 環境変数からサービスアカウント情報を取得
-            service_account_info = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')
-            print(f"GOOGLE_SHEETS_CREDENTIALS: {'SET' if service_account_info else 'NOT_SET'}")
-            
-            if service_account_info:
-                print("環境変数からサービスアカウント情報を読み込み中...")
-                creds = Credentials.from_service_account_info(
-                    json.loads(service_account_info), scopes=SCOPES)
-                print("環境変数からの読み込み成功")
-            else:
-                print("サービスアカウント情報が見つかりません")
-                return None
-        
-        print("gspreadクライアントを認証中...")
-        client = gspread.authorize(creds)
-        print("=== Google Sheets設定完了 ===")
-        return client
-    except Exception as e:
-        print(f"=== Google Sheets setup error: {e} ===")
+    """Google Sheets APIの設定（プロセス内で共有するクライアントを返す）"""
+    if not google_sheets_manager:
+        print("=== Google Sheets setup error: クライアント管理システムが利用できません ===")
         return None
-
-def parse_estimate_data(text):
-    """1行ずつ項目名:値を抽出し、柔軟に辞書化"""
-    data = {}
-    lines = text.replace('\r', '').split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        # コロンで分割（全角・半角両対応）
-        if ':' in line:
-            key, value = line.split(':', 1)
-        elif '：' in line:
-            key, value = line.split('：', 1)
-        else:
-            continue
-        key = key.strip()
-        value = value.strip()
-        # 抽出対象の項目を拡張
-        if key in ['社名', '会社名', '商品名', '単価', '数量', '日付', 'サイクル', '設置場所']:
-            data[key] = value
-    # 社名と会社名を統一
-    if '会社名' in data and '社名' not in data:
-        data['社名'] = data['会社名']
-    # 料金を計算
-    if '単価' in data and '数量' in data:
-        try:
-            unit_price = int(re.sub(r'[^0-9]', '', data['単価']))
-            quantity = int(re.sub(r'[^0-9]', '', data['数量']))
-            data['料金'] = unit_price * quantity
-        except ValueError:
-            data['料金'] = 0
-    print(f"parse_estimate_data: {data}")
-    return data
+    return google_sheets_manager.get_client()
 
 def extract_spreadsheet_id(url):
     """GoogleスプレッドシートURLまたはMicrosoft Excel Online URLからIDを抽出"""
@@ -219,29 +291,87 @@ def extract_spreadsheet_id(url):
     
     return None
 
-def write_to_spreadsheet(data, user_id=None):
+def load_user_profile(user_id):
+    """イベント処理の最初に1回だけユーザー情報と書き込み先を読み込む"""
+    if not (user_id and user_manager):
+        return None
+    try:
+        return user_manager.get_user_profile(user_id)
+    except Exception as e:
+        print(f"ユーザー情報の取得エラー: {e}")
+        return None
+
+def ensure_user_profile(user_id):
+    """初回利用時はユーザー登録し、プロフィールを返す（イベントごとに1回呼ぶ）"""
+    if not user_manager:
+        logger.warning("User management system not available")
+        return None
+    try:
+        profile, created = user_manager.ensure_user(user_id, "LINE User")
+        if created:
+            logger.info(f"New user registered: {user_id}")
+        return profile
+    except Exception as e:
+        logger.error(f"User registration failed: {e}")
+        return None
+
+def get_excel_online_target(user_id, profile=None):
+    """Excel Onlineの書き込み先(file_id, sheet_name)を取得（未登録なら(None, None)）"""
+    if not (user_id and user_manager and excel_online_manager):
+        return None, None
+    if profile is None:
+        profile = load_user_profile(user_id)
+    if profile and profile.uses_excel_online:
+        print(f"Excel Online設定を検出: {profile.excel_online_url}")
+        return profile.excel_file_id, profile.excel_sheet_name
+    return None, None
+
+def get_google_sheets_target(user_id, profile=None):
+    """Google Sheetsの書き込み先(spreadsheet_id, sheet_name)を取得（未登録なら共有スプレッドシート）"""
+    spreadsheet_id = sheet_name = None
+    if user_id and user_manager:
+        if profile is None:
+            profile = load_user_profile(user_id)
+        if profile:
+            spreadsheet_id, sheet_name = profile.spreadsheet_id, profile.sheet_name
+        if not spreadsheet_id:
+            # ユーザーがスプレッドシートを登録していない場合は共有スプレッドシートを使用
+            print(f"ユーザーがスプレッドシートを登録していないため、共有スプレッドシートを使用: {SHARED_SPREADSHEET_ID}")
+    if not spreadsheet_id:
+        return SHARED_SPREADSHEET_ID, DEFAULT_SHEET_NAME
+    return spreadsheet_id, sheet_name
+
+def write_to_spreadsheet(data, user_id=None, profile=None):
     """スプレッドシートまたはExcel Onlineにデータを書き込み（シート名・項目別対応）"""
     try:
         print(f"開始: データ書き込み処理")
         
         # まずExcel Online設定をチェック
-        excel_online_enabled = False
-        excel_url = None
-        excel_file_id = None
-        excel_sheet_name = None
-        
-        if user_id and user_manager and excel_online_manager:
-            excel_url, excel_file_id, excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            if excel_url and excel_file_id:
-                excel_online_enabled = True
-                print(f"Excel Online設定を検出: {excel_url}")
+        excel_file_id, excel_sheet_name = get_excel_online_target(user_id, profile)
         
         # Excel Onlineが有効な場合はExcel Onlineに書き込み
-        if excel_online_enabled:
+        if excel_file_id:
             return write_to_excel_online(data, excel_file_id, excel_sheet_name, user_id)
         
         # 従来のGoogle Sheets処理
-        return write_to_google_sheets(data, user_id)
+        return write_to_google_sheets(data, user_id, profile)
+        
+    except Exception as e:
+        print(f"データ書き込みエラー: {e}")
+        return False, f"データ書き込みエラー: {e}"
+
+def write_records_to_spreadsheet(records, user_id=None, profile=None):
+    """複数商品のデータをスプレッドシートまたはExcel Onlineにまとめて書き込み"""
+    try:
+        print(f"開始: データ書き込み処理 ({len(records)}件)")
+        
+        # Excel Onlineは1回の範囲書き込みで書き込み
+        excel_file_id, excel_sheet_name = get_excel_online_target(user_id, profile)
+        if excel_file_id:
+            return write_records_to_excel_online(records, excel_file_id, excel_sheet_name, user_id)
+        
+        # Google Sheetsは1回のbatch_updateで書き込み
+        return write_records_to_google_sheets(records, user_id, profile)
         
     except Exception as e:
         print(f"データ書き込みエラー: {e}")
@@ -249,36 +379,61 @@ def write_to_spreadsheet(data, user_id=None):
 
 def write_to_excel_online(data, file_id, sheet_name, user_id=None):
     """Excel Onlineにデータを書き込み"""
+    return write_records_to_excel_online([data], file_id, sheet_name, user_id)
+
+# Excel Onlineの見積書テンプレートで商品を書き込める行（この下は合計・フッター）
+EXCEL_PRODUCT_ROW_START = 19
+EXCEL_PRODUCT_ROW_END = 36
+
+def find_empty_excel_rows(existing_data, count, row_start=EXCEL_PRODUCT_ROW_START, row_end=EXCEL_PRODUCT_ROW_END):
+    """row_start〜row_endでcount行続けて空いている最初の行番号を探す（最初の3列が空の行を空きとみなす）
+
+    戻り値は(行番号, 連続した空き行の最大数)で、count行の空きがなければ行番号はNone。
+    """
+    existing_data = existing_data or []
+    run = longest = 0
+    for i in range(row_end - row_start + 1):
+        row = existing_data[i] if i < len(existing_data) else []
+        run = 0 if any(cell for cell in row[:3] if cell) else run + 1
+        longest = max(longest, run)
+        if run == count:
+            return row_start + i - count + 1, longest
+    return None, longest
+
+def write_records_to_excel_online(records, file_id, sheet_name, user_id=None):
+    """Excel Onlineに複数商品のデータを1回の範囲書き込みでまとめて書き込み"""
     try:
-        print(f"開始: Excel Online書き込み処理")
+        print(f"開始: Excel Online書き込み処理 ({len(records)}件)")
         print(f"file_id: {file_id}, sheet_name: {sheet_name}")
         
         if not excel_online_manager:
             return False, "Excel Onlineシステムが利用できません"
         
         # 商品データの書き込み
-        if '商品名' in data and '単価' in data and '数量' in data:
-            # 空いている行を探す
-            row_number = 19  # デフォルトの開始行
-            
-            # 既存データを確認して空いている行を探す
-            existing_data, error = excel_online_manager.read_range(file_id, sheet_name, 'A19:G36')
-            if existing_data:
-                for i, row in enumerate(existing_data):
-                    if not any(cell for cell in row[:3] if cell):  # 最初の3列が空の場合
-                        row_number = 19 + i
-                        break
-                else:
-                    row_number = 19 + len(existing_data)  # 最後の行の次の行
+        products = [data for data in records if is_product_record(data)]
+        if products:
+            # 既存データを1回だけ読み取り、商品数分の連続した空き行を探す
+            existing_data, error = excel_online_manager.read_range(
+                file_id, sheet_name, f'A{EXCEL_PRODUCT_ROW_START}:G{EXCEL_PRODUCT_ROW_END}'
+            )
+            if error:
+                return False, f"既存データの読み取りに失敗: {error}"
+            row_number, free_rows = find_empty_excel_rows(existing_data, len(products))
+            if row_number is None:
+                # テンプレートの行範囲を超えて書き込むと合計・フッターを上書きするため1件も書き込まない
+                return False, (f"空き行が足りません。{len(products)}件のうち{len(products) - free_rows}件が"
+                               f"{EXCEL_PRODUCT_ROW_START}〜{EXCEL_PRODUCT_ROW_END}行目に収まりません。"
+                               "「リセット」で見積書をクリアするか、件数を減らしてください。")
             
             # 商品データを書き込み
-            success, error = excel_online_manager.write_product_data_excel(data, file_id, sheet_name, row_number)
+            success, error = excel_online_manager.write_products_data_excel(products, file_id, sheet_name, row_number)
             if not success:
                 return False, f"商品データの書き込みに失敗: {error}"
             
-            print(f"商品データを行 {row_number} に書き込みました")
+            print(f"商品データを行 {row_number}〜{row_number + len(products) - 1} に書き込みました")
             
-        # 会社情報の更新
+        # 会社情報の更新（社名・日付はメッセージ全体で共通なので1回だけ）
+        data = records[0] if records else {}
         if '社名' in data or '日付' in data:
             success, error = excel_online_manager.update_company_info_excel(data, file_id, sheet_name)
             if not success:
@@ -292,22 +447,78 @@ def write_to_excel_online(data, file_id, sheet_name, user_id=None):
         print(f"Excel Online書き込みエラー: {e}")
         return False, f"Excel Online書き込みエラー: {e}"
 
-def write_to_google_sheets(data, user_id=None):
+# 商品データの項目と、SHEET_WRITE_CONFIGの列キーの対応
+PRODUCT_FIELD_COLUMNS = [
+    ('商品名', 'name'),
+    ('サイクル', 'cycle'),
+    ('数量', 'quantity'),
+    ('単価', 'price'),
+    ('設置場所', 'place')
+]
+
+def build_product_row_updates(data, product_config, row):
+    """1商品分の書き込み内容をbatch_update用のリストに組み立て"""
+    updates = []
+    for field, col_key in PRODUCT_FIELD_COLUMNS:
+        value = data.get(field, '')
+        if not value or col_key not in product_config:
+            continue
+        cols = product_config[col_key]
+        if not isinstance(cols, list):
+            cols = [cols]
+        for col in cols:
+            updates.append({'range': f"{col}{row}", 'values': [[value]]})
+    return updates
+
+def get_product_columns(product_config):
+    """商品設定で使用している列名の一覧を取得"""
+    check_columns = []
+    for col_key in ['name', 'option', 'price', 'quantity', 'cycle', 'place']:
+        if col_key in product_config:
+            col_value = product_config[col_key]
+            if isinstance(col_value, list):
+                check_columns.extend(col_value)
+            else:
+                check_columns.append(col_value)
+    return check_columns
+
+def count_used_rows(sheet, product_config):
+    """テンプレートの行範囲だけを読み取り、データが入っている行数を数える"""
+    row_start = product_config.get('row_start', 19)
+    row_end = product_config.get('row_end', 36)
+    check_columns = get_product_columns(product_config)
+    if not check_columns:
+        return 0
+    
+    # 対象列を含む最小の矩形（例: A19:O36）のみを取得
+    first_col = min(check_columns, key=col_to_num)
+    last_col = max(check_columns, key=col_to_num)
+    window = f"{first_col}{row_start}:{last_col}{row_end}"
+    values = sheet.get(window)
+    print(f"チェック対象列: {check_columns} (読み取り範囲: {window}, 取得行数: {len(values)})")
+    
+    offset = col_to_num(first_col)
+    col_indexes = [col_to_num(col) - offset for col in check_columns]
+    used_rows = 0
+    for row in values:
+        # 該当する列にデータがあるかチェック
+        if any(i < len(row) and row[i] for i in col_indexes):
+            used_rows += 1
+    return used_rows
+
+def write_to_google_sheets(data, user_id=None, profile=None):
     """Google Sheetsにデータを書き込み（従来の処理）"""
+    return write_records_to_google_sheets([data], user_id, profile)
+
+def write_records_to_google_sheets(records, user_id=None, profile=None):
+    """Google Sheetsに複数商品のデータを1回のbatch_updateで書き込み"""
+    spreadsheet_id = sheet_name = None
+    cursor_keys = []
     try:
-        print(f"開始: Google Sheets書き込み処理")
+        print(f"開始: Google Sheets書き込み処理 ({len(records)}件)")
         
         # 顧客のスプレッドシートIDを取得
-        if user_id and user_manager:
-            spreadsheet_id, sheet_name = user_manager.get_user_spreadsheet(user_id)
-            if not spreadsheet_id:
-                # ユーザーがスプレッドシートを登録していない場合は共有スプレッドシートを使用
-                spreadsheet_id = SHARED_SPREADSHEET_ID
-                sheet_name = DEFAULT_SHEET_NAME
-                print(f"ユーザーがスプレッドシートを登録していないため、共有スプレッドシートを使用: {spreadsheet_id}")
-        else:
-            spreadsheet_id = SHARED_SPREADSHEET_ID
-            sheet_name = DEFAULT_SHEET_NAME
+        spreadsheet_id, sheet_name = get_google_sheets_target(user_id, profile)
         
         # --- シート名を正規化 ---
         # normalize_sheet_nameを削除
@@ -319,7 +530,7 @@ def write_to_google_sheets(data, user_id=None):
             return False, "Google Sheets接続エラー"
         
         print(f"成功: Google Sheets接続")
-        sheet = client.open_by_key(spreadsheet_id).worksheet(sheet_name)
+        sheet = sheet_handle_cache.get_worksheet(client, spreadsheet_id, sheet_name)
         print(f"成功: シート '{sheet_name}' を開きました")
         
         # シート名に対応する設定を取得
@@ -332,140 +543,88 @@ def write_to_google_sheets(data, user_id=None):
         print(f"SHEET_WRITE_CONFIG.keys(): {list(SHEET_WRITE_CONFIG.keys())}")
         print(f"sheet_name: '{sheet_name}'")
 
-        # 商品名から「現状」「当社」などの語尾を除去し、商品タイプを判定
-        product_name = data.get('商品名', '')
-        product_type = "default"  # デフォルト
-        if product_name:
-            import re
-            m = re.match(r"^(.*?)[\s　]*(現状|当社)$", product_name)
-            if m:
-                product_type = m.group(2)
-                data['商品名'] = m.group(1)
-            # elseはdefaultのまま
-
-        # 商品設定を取得
-        product_config = sheet_config.get('product', {}).get(product_type)
-        if not product_config:
-            # デフォルト設定を使用
-            available_configs = list(sheet_config.get('product', {}).values())
-            if available_configs:
-                product_config = available_configs[0]
-            else:
-                print(f"エラー: シート '{sheet_name}' に商品設定が見つかりません")
-                return False, f"シート '{sheet_name}' の設定エラー"
+        # 商品タイプ（「現状」「当社」など）ごとにまとめる
+        groups = {}
+        for data in records:
+            product_type = data.get('商品タイプ')
+            if product_type is None:
+                # parse_estimate_records()を通っていないデータは商品名の語尾から判定
+                data['商品名'], product_type = split_product_type(data.get('商品名', ''))
+
+            # 商品設定を取得
+            product_config = sheet_config.get('product', {}).get(product_type)
+            if not product_config:
+                # デフォルト設定を使用（カーソルも同じ列を使う商品タイプと共有する）
+                available_types = list(sheet_config.get('product', {}).keys())
+                if available_types:
+                    product_type = available_types[0]
+                    product_config = sheet_config['product'][product_type]
+                else:
+                    print(f"エラー: シート '{sheet_name}' に商品設定が見つかりません")
+                    return False, f"シート '{sheet_name}' の設定エラー"
+            groups.setdefault(product_type, (product_config, []))[1].append(data)
         
-        print(f"商品タイプ: {product_type}")
-        print(f"商品設定: {product_config}")
+        print(f"商品タイプ: {list(groups.keys())}")
         print(f"利用可能な設定: {list(sheet_config.get('product', {}).keys())}")
         
-        # 既存データの行数を確認
-        existing_data = sheet.get_all_values()
-        print(f"既存データ行数: {len(existing_data)}")
-        
-        # 使用済み行数を確認（商品タイプに応じた列のみ）
-        row_start = product_config.get('row_start', 19)
-        row_end = product_config.get('row_end', 36)
-        used_rows = 0
-        
-        # 商品タイプに応じた列のみをチェック
-        check_columns = []
-        for col_key in ['name', 'option', 'price', 'quantity', 'cycle', 'place']:
-            if col_key in product_config:
-                col_value = product_config[col_key]
-                if isinstance(col_value, list):
-                    check_columns.extend(col_value)
-                else:
-                    check_columns.append(col_value)
-        
-        print(f"チェック対象列: {check_columns}")
-        
-        for row in range(row_start - 1, min(row_end, len(existing_data))):
-            # 該当する列にデータがあるかチェック
-            has_data = False
-            for col_letter in check_columns:
-                col_index = ord(col_letter) - ord('A')
-                if col_index < len(existing_data[row]) and existing_data[row][col_index]:
-                    has_data = True
-                    break
-            if has_data:
-                used_rows += 1
-        
-        print(f"使用済み行数: {used_rows} (行範囲: {row_start}-{row_end})")
-        print(f"チェック対象列: {check_columns}")
-        
-        # 次の書き込み行を決定
-        next_row = row_start + used_rows
-        if next_row > row_end:
-            print(f"警告: 行数上限 {row_end} を超えています。{row_end}行目に書き込みます。")
-            next_row = row_end
-        
-        print(f"書き込み行: {next_row}")
-        
-        # 商品名（複数列対応）
-        if data.get('商品名', '') and 'name' in product_config:
-            name_cols = product_config['name']
-            if isinstance(name_cols, list):
-                for col in name_cols:
-                    sheet.update(values=[[data.get('商品名', '')]], range_name=f"{col}{next_row}")
-                    print(f"{col}{next_row} に {data.get('商品名', '')} を書き込みます")
-        else:
-                sheet.update(values=[[data.get('商品名', '')]], range_name=f"{name_cols}{next_row}")
-                print(f"{name_cols}{next_row} に {data.get('商品名', '')} を書き込みます")
-
-        # サイクル（サイクル列が指定されている場合のみ）
-        if data.get('サイクル', '') and 'cycle' in product_config:
-            cycle_col = product_config['cycle']
-            sheet.update(values=[[data.get('サイクル', '')]], range_name=f"{cycle_col}{next_row}")
-            print(f"{cycle_col}{next_row} に {data.get('サイクル', '')} を書き込みます")
-        
-        # 数量
-        if data.get('数量', '') and 'quantity' in product_config:
-            quantity_col = product_config['quantity']
-            sheet.update(values=[[data.get('数量', '')]], range_name=f"{quantity_col}{next_row}")
-            print(f"{quantity_col}{next_row} に {data.get('数量', '')} を書き込みます")
-
-        # 単価
-        if data.get('単価', '') and 'price' in product_config:
-            price_col = product_config['price']
-            sheet.update(values=[[data.get('単価', '')]], range_name=f"{price_col}{next_row}")
-            print(f"{price_col}{next_row} に {data.get('単価', '')} を書き込みます")
-        
-        # 設置場所（設置場所列が指定されている場合のみ）
-        if data.get('設置場所', '') and 'place' in product_config:
-            place_col = product_config['place']
-            sheet.update(values=[[data.get('設置場所', '')]], range_name=f"{place_col}{next_row}")
-            print(f"{place_col}{next_row} に {data.get('設置場所', '')} を書き込みます")
-        
-        print(f"成功: データを{next_row}行目に書き込みました")
-        return True, f"データを{next_row}行目に正常に書き込みました"
+        # 商品タイプごとにカーソルから連続した行を確保し、全商品を1回のbatch_updateで書き込み
+        updates = []
+        written_rows = []
+        for product_type, (product_config, group) in groups.items():
+            row_start = product_config.get('row_start', 19)
+            row_end = product_config.get('row_end', 36)
+            cursor_key = (spreadsheet_id, sheet_name, product_type)
+            first_row = row_cursor_cache.claim(
+                cursor_key, row_start, row_end,
+                lambda config=product_config: count_used_rows(sheet, config),
+                count=len(group)
+            )
+            if first_row is None:
+                # 入りきらない場合は1件も書き込まない（確保済みの他の商品タイプの行は取り直す）
+                for claimed_key in cursor_keys:
+                    row_cursor_cache.invalidate(claimed_key)
+                label = '' if product_type == 'default' else f"「{product_type}」の"
+                return False, (f"空き行が足りません。{label}{len(group)}件が{row_start}〜{row_end}行目に収まりません。"
+                               "「リセット」で見積書をクリアするか、件数を減らしてください。")
+            cursor_keys.append(cursor_key)
+            for i, data in enumerate(group):
+                row = first_row + i
+                updates.extend(build_product_row_updates(data, product_config, row))
+                written_rows.append(row)
+        
+        print(f"書き込み行: {written_rows}")
+        for update in updates:
+            print(f"{update['range']} に {update['values'][0][0]} を書き込みます")
+        if updates:
+            sheet.batch_update(updates)
+        
+        rows_text = '・'.join(str(row) for row in written_rows)
+        print(f"成功: データを{rows_text}行目に書き込みました")
+        return True, f"データを{rows_text}行目に正常に書き込みました"
         
     except Exception as e:
         print(f"Spreadsheet write error: {e}")
+        for cursor_key in cursor_keys:
+            # 確保した行が書き込まれていないため、次回はシートから取り直す
+            row_cursor_cache.invalidate(cursor_key)
+        if spreadsheet_id:
+            sheet_handle_cache.handle_api_error(e, spreadsheet_id, sheet_name)
         return False, f"書き込みエラー: {str(e)}"
 
-def update_company_info(data, user_id=None):
+def update_company_info(data, user_id=None, profile=None):
     """会社名と日付を更新（シート名別対応）"""
     try:
         print(f"開始: 会社情報更新処理")
         
         # まずExcel Online設定をチェック
-        excel_online_enabled = False
-        excel_url = None
-        excel_file_id = None
-        excel_sheet_name = None
-        
-        if user_id and user_manager and excel_online_manager:
-            excel_url, excel_file_id, excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            if excel_url and excel_file_id:
-                excel_online_enabled = True
-                print(f"Excel Online設定を検出: {excel_url}")
+        excel_file_id, excel_sheet_name = get_excel_online_target(user_id, profile)
         
         # Excel Onlineが有効な場合はExcel Onlineに更新
-        if excel_online_enabled:
+        if excel_file_id:
             return update_company_info_excel_online(data, excel_file_id, excel_sheet_name, user_id)
         
         # 従来のGoogle Sheets処理
-        return update_company_info_google_sheets(data, user_id)
+        return update_company_info_google_sheets(data, user_id, profile)
         
     except Exception as e:
         print(f"会社情報更新エラー: {e}")
@@ -490,22 +649,14 @@ def update_company_info_excel_online(data, file_id, sheet_name, user_id=None):
         print(f"Excel Online会社情報更新エラー: {e}")
         return False, f"Excel Online会社情報更新エラー: {e}"
 
-def update_company_info_google_sheets(data, user_id=None):
+def update_company_info_google_sheets(data, user_id=None, profile=None):
     """Google Sheetsの会社情報を更新（従来の処理）"""
+    spreadsheet_id = sheet_name = None
     try:
         print(f"開始: Google Sheets会社情報更新処理")
         
         # 顧客のスプレッドシートIDを取得
-        if user_id and user_manager:
-            spreadsheet_id, sheet_name = user_manager.get_user_spreadsheet(user_id)
-            if not spreadsheet_id:
-                # ユーザーがスプレッドシートを登録していない場合は共有スプレッドシートを使用
-                spreadsheet_id = SHARED_SPREADSHEET_ID
-                sheet_name = DEFAULT_SHEET_NAME
-                print(f"ユーザーがスプレッドシートを登録していないため、共有スプレッドシートを使用: {spreadsheet_id}")
-        else:
-            spreadsheet_id = SHARED_SPREADSHEET_ID
-            sheet_name = DEFAULT_SHEET_NAME
+        spreadsheet_id, sheet_name = get_google_sheets_target(user_id, profile)
         
         # --- シート名を正規化 ---
         # normalize_sheet_nameを削除
@@ -516,7 +667,7 @@ def update_company_info_google_sheets(data, user_id=None):
             print("エラー: Google Sheets接続失敗")
             return False, "Google Sheets接続エラー"
         
-        sheet = client.open_by_key(spreadsheet_id).worksheet(sheet_name)
+        sheet = sheet_handle_cache.get_worksheet(client, spreadsheet_id, sheet_name)
         
         # シート名に対応する設定を取得
         sheet_config = SHEET_WRITE_CONFIG.get(sheet_name)
@@ -536,8 +687,8 @@ def update_company_info_google_sheets(data, user_id=None):
                 start_col = range_match.group(1)
                 end_col = range_match.group(3)
                 # 列数を計算（A=1, B=2, ...）
-                start_col_num = sum((ord(c) - ord('A') + 1) * (26 ** i) for i, c in enumerate(reversed(start_col)))
-                end_col_num = sum((ord(c) - ord('A') + 1) * (26 ** i) for i, c in enumerate(reversed(end_col)))
+                start_col_num = col_to_num(start_col)
+                end_col_num = col_to_num(end_col)
                 col_count = end_col_num - start_col_num + 1
             else:
                 col_count = 8  # デフォルト
@@ -560,12 +711,6 @@ def update_company_info_google_sheets(data, user_id=None):
                 start_col = range_match.group(1)
                 end_col = range_match.group(3)
                 # 列数を計算（A=1, B=2, ...）
-                def col_to_num(col):
-                    result = 0
-                    for i, c in enumerate(reversed(col)):
-                        result += (ord(c) - ord('A') + 1) * (26 ** i)
-                    return result
-                
                 start_col_num = col_to_num(start_col)
                 end_col_num = col_to_num(end_col)
                 col_count = end_col_num - start_col_num + 1
@@ -589,6 +734,8 @@ def update_company_info_google_sheets(data, user_id=None):
         
     except Exception as e:
         print(f"Company info update error: {e}")
+        if spreadsheet_id:
+            sheet_handle_cache.handle_api_error(e, spreadsheet_id, sheet_name)
         return False, f"更新エラー: {str(e)}"
 
 def create_main_menu():
@@ -938,10 +1085,48 @@ def create_sheet_selection():
         }
     }
 
+# 静的なFlexメッセージ（起動時に1回だけFlexContainerに変換・検証して使い回す）
+STATIC_FLEX_BUILDERS = {
+    'main_menu': create_main_menu,
+    'product_selection': create_product_selection,
+    'plan_selection': create_plan_selection,
+    'sheet_selection': create_sheet_selection
+}
+_static_flex_containers = {}
+
+def build_static_flex_containers():
+    """静的なFlexコンテナをまとめて作成"""
+    for name, builder in STATIC_FLEX_BUILDERS.items():
+        try:
+            _static_flex_containers[name] = FlexContainer.from_dict(builder())
+        except Exception as e:
+            logger.error(f"Flexテンプレートの作成に失敗: {name}: {e}")
+
+def get_flex_container(name):
+    """静的なFlexコンテナを取得（起動時に作成できなかった場合はここで作成）"""
+    container = _static_flex_containers.get(name)
+    if container is None:
+        container = _static_flex_containers[name] = FlexContainer.from_dict(STATIC_FLEX_BUILDERS[name]())
+    return container
+
+FLEX_CACHE_SIZE = int(os.environ.get('FLEX_CACHE_SIZE', 128))
+
+@lru_cache(maxsize=FLEX_CACHE_SIZE)
+def get_size_selection_container(product):
+    """商品ごとのサイズ選択Flexコンテナ（引数ごとにキャッシュ）"""
+    return FlexContainer.from_dict(create_size_selection(product))
+
+@lru_cache(maxsize=FLEX_CACHE_SIZE)
+def get_quantity_selection_container(product, size, price):
+    """商品・サイズ・単価ごとの数量選択Flexコンテナ（引数ごとにキャッシュ）"""
+    return FlexContainer.from_dict(create_quantity_selection(product, size, price))
+
+build_static_flex_containers()
+
 def create_rich_menu():
     """リッチメニューを作成"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 既存のリッチメニューを削除
@@ -1030,7 +1215,7 @@ def create_rich_menu():
 def create_simple_rich_menu():
     """シンプルなリッチメニューを作成（テスト用）"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 既存のリッチメニューを削除
@@ -1077,7 +1262,7 @@ def create_simple_rich_menu():
 def create_minimal_rich_menu():
     """最小限のリッチメニューを作成（テスト用）"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 既存のリッチメニューを削除
@@ -1157,6 +1342,30 @@ def env_check():
     
     return html
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """キャッシュ・接続の統計情報を返すエンドポイント（監視用）"""
+    return jsonify({
+        'google_sheets_client': google_sheets_manager.get_stats() if google_sheets_manager else None,
+        'sqlite': user_manager.db.get_stats() if user_manager else None,
+        'user_profile_cache': user_manager.profile_cache.get_stats() if user_manager else None,
+        'usage_recorder': user_manager.usage_recorder.get_stats() if user_manager and user_manager.usage_recorder else None,
+        'sheet_handle_cache': sheet_handle_cache.get_stats(),
+        'row_cursor_cache': row_cursor_cache.get_stats(),
+        'excel_online': excel_online_manager.get_stats() if excel_online_manager else None,
+        'webhook': dict(webhook_stats, mode='async' if WEBHOOK_ASYNC else 'sync'),
+        'webhook_executor': webhook_executor.get_stats(),
+        'responses': dict(response_stats),
+        'line_api_latency': {name: recorder.snapshot() for name, recorder in line_api_latency.items()},
+        'flex_cache': {
+            'static': len(_static_flex_containers),
+            'size_selection': get_size_selection_container.cache_info()._asdict(),
+            'quantity_selection': get_quantity_selection_container.cache_info()._asdict()
+        },
+        'message_router': message_router.get_stats(),
+        'postback_router': postback_router.get_stats()
+    })
+
 @app.route("/create-rich-menu", methods=['GET'])
 def create_rich_menu_endpoint():
     """リッチメニュー作成エンドポイント"""
@@ -1176,7 +1385,7 @@ def create_rich_menu_endpoint():
 def delete_rich_menu_endpoint():
     """リッチメニュー削除エンドポイント"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 既存のリッチメニューを削除
@@ -1197,124 +1406,212 @@ def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     logger.info(f"Received webhook: {body[:100]}...")  # ログ追加
+    if webhook_executor.shutting_down:
+        # 停止処理中は受け付けず、LINEに再送してもらう（200を返すとイベントが失われる）
+        logger.warning("停止処理中のためWebhookを503で返します")
+        count_webhook('refused')
+        abort(503)
+    refused = False
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
+        futures = []
+        for event in payload.events:
+            count_webhook('events')
+            key = get_event_key(event)
+            future = webhook_executor.submit(key, dispatch_webhook_event, event)
+            if future:
+                count_webhook('queued')
+            elif not webhook_executor.shutting_down:
+                # キューが満杯のときは順序を保つため空きを待って追加する
+                logger.warning("Webhookキューが満杯のため空きを待ちます")
+                count_webhook('blocked')
+                future = webhook_executor.submit_wait(key, dispatch_webhook_event, event)
+            if future is None:
+                # 受信中に停止処理が始まった（残りのイベントは再送に任せる）
+                refused = True
+                break
+            futures.append(future)
+        if not WEBHOOK_ASYNC:
+            # 同期モードでは処理が終わるまで応答しない
+            for future in futures:
+                if future:
+                    future.result()
     except InvalidSignatureError as e:
         logger.error(f"Invalid signature error: {e}")  # ログ追加
         abort(400)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")  # ログ追加
         abort(500)
+    if refused:
+        logger.warning("停止処理中のためWebhookを503で返します")
+        count_webhook('refused')
+        abort(503)
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
-    user_id = event.source.user_id
-    user_text = event.message.text.strip()
-    
-    # デバッグ情報を追加
-    print(f"=== メッセージ受信 ===")
-    print(f"user_id: {user_id}")
-    print(f"user_text: '{user_text}'")
-    print(f"user_text length: {len(user_text)}")
-    print(f"user_text bytes: {user_text.encode('utf-8')}")
-    print(f"=== メッセージ受信終了 ===")
-    
-    # グローバル変数のuser_managerを使用
-    global user_manager
-    
-    # reply変数を初期化
-    reply = ""
-    
-    # ユーザー登録（初回利用時）
+def get_event_key(event):
+    """イベントの処理順序を保つ単位（ユーザー・グループ・トーク）のキー"""
+    source = event.source
+    return (getattr(source, 'user_id', None) or getattr(source, 'group_id', None)
+            or getattr(source, 'room_id', None) or 'unknown')
+
+def dispatch_webhook_event(event):
+    """パース済みのWebhookイベントを対応するハンドラーに振り分け"""
+    try:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            handle_message(event)
+        elif isinstance(event, PostbackEvent):
+            handle_postback(event)
+        else:
+            logger.info(f"未対応のイベントを無視: {type(event).__name__}")
+    except Exception as e:
+        logger.error(f"イベント処理エラー: {e}")
+        traceback.print_exc()
+
+# テキストコマンドとpostbackのルーティングテーブル（ハンドラは下でデコレータ登録）
+message_router = CommandRouter('message')
+postback_router = CommandRouter('postback')
+
+def add_product_records(event, user_id, profile, records, label):
+    """商品レコードを利用回数を確保したうえでまとめて書き込み、結果を返信する"""
+    data = records[0]
+    # 利用制限チェック（商品の件数分をまとめて確保）
     if user_manager:
-        user_info = user_manager.get_user_info(user_id)
-        if not user_info:
-            # 新規ユーザー登録
-            success, message = user_manager.register_user(user_id, "LINE User")
-            if success:
-                logger.info(f"New user registered: {user_id}")
-            else:
-                logger.error(f"User registration failed: {message}")
+        can_use, limit_message = user_manager.reserve_usage(user_id, len(records))
+        if not can_use:
+            reply = f"❌ {limit_message}\n\n"
+            reply += "プランアップグレードをご検討ください。\n"
+            reply += "「メニュー」→「利用状況確認」で詳細を確認できます。"
+            send_text_message(event.reply_token, reply)
+            return
     else:
-        logger.warning("User management system not available")
+        print("User management system not available, skipping usage limit check")
 
-    # リッチメニューやテキストコマンドに応じた返答
-    if user_text in ["商品を追加"]:
-        # ユーザーの状態を商品追加に設定
-        set_user_state(user_id, 'product_add')
-        # 入力フォーマットを表示
-        reply = "商品を追加するには、以下の形式で入力してください：\n\n"
-        reply += "「比較見積書 ロング」\n"
-        reply += "・商品名：\n"
-        reply += "・単価：\n"
-        reply += "・数量：\n"
-        reply += "・サイクル：\n\n"
-        reply += "「比較御見積書　ショート」\n"
-        reply += "・商品名：\n"
-        reply += "・単価：\n"
-        reply += "・数量：\n"
-        reply += "・サイクル：\n\n"
-        reply += "「新規見積書　ショート」\n"
-        reply += "・商品名：\n"
-        reply += "・サイクル：\n"
-        reply += "・数量：\n"
-        reply += "・単価：\n\n"
-        reply += "「新規見積書　ロング」\n"
-        reply += "・商品名：\n"
-        reply += "・設置場所：\n"
-        reply += "・サイクル：\n"
-        reply += "・数量：\n"
-        reply += "・単価："
-        send_text_message(event.reply_token, reply)
-        return
-    elif user_text in ["スプレッドシート登録"]:
-        # ユーザーの状態をスプレッドシート登録に設定
-        set_user_state(user_id, 'spreadsheet_register')
-        # シート選択画面を表示
-        flex_message = FlexMessage(
-            alt_text="シート選択",
-            contents=FlexContainer.from_dict(create_sheet_selection())
-        )
-        send_flex_message(event.reply_token, flex_message)
-        return
-    elif user_text in ["会社情報を更新"]:
-        reply = "会社情報を更新するには、以下の形式で入力してください：\n\n"
-        reply += "会社名:○○株式会社\n"
-        reply += "日付:2024/01/15\n\n"
-        reply += "または、\n"
-        reply += "会社名:○○株式会社 日付:2024/01/15"
-        send_text_message(event.reply_token, reply)
-        return
-    elif user_text in ["利用状況確認"]:
-        if user_manager:
-            summary = user_manager.get_usage_summary(user_id)
-            send_text_message(event.reply_token, summary)
+    # 商品データの書き込み（複数商品は1回の書き込みにまとめる）
+    written = False
+    def build_add_product_reply():
+        nonlocal written
+        success, message = write_records_to_spreadsheet(records, user_id, profile)
+        if success:
+            written = True
+            # 利用回数をまとめて記録
+            if user_manager:
+                user_manager.increment_usage_batch(user_id, "add_product", records)
+            reply = f"✅ 見積書を作成しました！\n\n"
+            reply += f"📋 登録内容:\n"
+            reply += f"社名: {data.get('社名', 'N/A')}\n"
+            if len(records) == 1:
+                reply += f"商品名: {data.get('商品名', 'N/A')}\n"
+                reply += f"サイズ: {data.get('サイズ', 'N/A')}\n"
+                reply += f"単価: {data.get('単価', 'N/A')}\n"
+                reply += f"数量: {data.get('数量', 'N/A')}\n"
+                reply += f"料金: {data.get('料金', 'N/A')}\n\n"
+                reply += f"📊 スプレッドシートに反映されました。"
+            else:
+                for i, record in enumerate(records, 1):
+                    reply += f"{i}. {record['商品名']} 単価:{record['単価']} 数量:{record['数量']} 料金:{record.get('料金', 'N/A')}\n"
+                reply += f"\n📊 {len(records)}件をスプレッドシートに反映しました。"
         else:
-            send_text_message(event.reply_token, "利用状況の取得に失敗しました。")
-        return
-    elif user_text in ["プランアップグレード"]:
-        flex_message = FlexMessage(
-            alt_text="プラン選択",
-            contents=FlexContainer.from_dict(create_plan_selection())
-        )
-        send_flex_message(event.reply_token, flex_message)
-        return
-    elif user_text in ["見積書を確認"]:
-        reply = "現在の見積書を確認するには、Googleスプレッドシートを直接確認してください。\n\n"
-        reply += "📊 共有スプレッドシートURL:\n"
-        reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
-        reply += "💡 独自のスプレッドシートを登録している場合は、そのスプレッドシートを確認してください。"
-        send_text_message(event.reply_token, reply)
-        return
-    elif user_text in ["リセット"]:
-        # リセット機能
-        print(f"=== リセット機能開始 ===")
-        print(f"user_id: {user_id}")
-        print(f"user_text: '{user_text}'")
-        
+            reply = f"❌ 見積書作成エラー: {message}"
+        return reply
+    
+    try:
+        reply_with_deadline(event, build_add_product_reply, label)
+    finally:
+        # 書き込みに失敗・例外・タスクを実行できなかった場合は確保した利用回数を戻す
+        # （reply_with_deadline()は処理の完了まで待ってから戻る）
+        if user_manager and not written:
+            user_manager.release_usage(user_id, len(records))
+
+@message_router.command("商品を追加")
+def show_add_product_guide(event, user_id, user_text, profile):
+    """「商品を追加」: 入力フォーマットを表示"""
+    # ユーザーの状態を商品追加に設定
+    set_user_state(user_id, 'product_add')
+    # 入力フォーマットを表示
+    reply = "商品を追加するには、以下の形式で入力してください：\n\n"
+    reply += "「比較見積書 ロング」\n"
+    reply += "・商品名：\n"
+    reply += "・単価：\n"
+    reply += "・数量：\n"
+    reply += "・サイクル：\n\n"
+    reply += "「比較御見積書　ショート」\n"
+    reply += "・商品名：\n"
+    reply += "・単価：\n"
+    reply += "・数量：\n"
+    reply += "・サイクル：\n\n"
+    reply += "「新規見積書　ショート」\n"
+    reply += "・商品名：\n"
+    reply += "・サイクル：\n"
+    reply += "・数量：\n"
+    reply += "・単価：\n\n"
+    reply += "「新規見積書　ロング」\n"
+    reply += "・商品名：\n"
+    reply += "・設置場所：\n"
+    reply += "・サイクル：\n"
+    reply += "・数量：\n"
+    reply += "・単価："
+    send_text_message(event.reply_token, reply)
+
+@message_router.command("スプレッドシート登録")
+def show_spreadsheet_registration_guide(event, user_id, user_text, profile):
+    """「スプレッドシート登録」: シート選択画面を表示"""
+    # ユーザーの状態をスプレッドシート登録に設定
+    set_user_state(user_id, 'spreadsheet_register')
+    # シート選択画面を表示
+    flex_message = FlexMessage(
+        alt_text="シート選択",
+        contents=get_flex_container('sheet_selection')
+    )
+    send_flex_message(event.reply_token, flex_message)
+
+@message_router.command("会社情報を更新")
+def show_company_update_guide(event, user_id, user_text, profile):
+    """「会社情報を更新」: 入力フォーマットの案内"""
+    reply = "会社情報を更新するには、以下の形式で入力してください：\n\n"
+    reply += "会社名:○○株式会社\n"
+    reply += "日付:2024/01/15\n\n"
+    reply += "または、\n"
+    reply += "会社名:○○株式会社 日付:2024/01/15"
+    send_text_message(event.reply_token, reply)
+
+@message_router.command("利用状況確認")
+def show_usage_summary(event, user_id, user_text, profile):
+    """「利用状況確認」: 今月の利用状況を表示"""
+    if user_manager:
+        summary = user_manager.get_usage_summary(user_id)
+        send_text_message(event.reply_token, summary)
+    else:
+        send_text_message(event.reply_token, "利用状況の取得に失敗しました。")
+
+@message_router.command("プランアップグレード")
+def show_plan_upgrade(event, user_id, user_text, profile):
+    """「プランアップグレード」: プラン選択画面を表示"""
+    flex_message = FlexMessage(
+        alt_text="プラン選択",
+        contents=get_flex_container('plan_selection')
+    )
+    send_flex_message(event.reply_token, flex_message)
+
+@message_router.command("見積書を確認")
+def show_estimate_guide(event, user_id, user_text, profile):
+    """「見積書を確認」: 見積書の確認方法を案内"""
+    reply = "現在の見積書を確認するには、Googleスプレッドシートを直接確認してください。\n\n"
+    reply += "📊 共有スプレッドシートURL:\n"
+    reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
+    reply += "💡 独自のスプレッドシートを登録している場合は、そのスプレッドシートを確認してください。"
+    send_text_message(event.reply_token, reply)
+
+@message_router.command("リセット")
+def reset_estimate(event, user_id, user_text, profile):
+    """「リセット」: 見積書のデータをクリア"""
+    # リセット機能
+    print(f"=== リセット機能開始 ===")
+    print(f"user_id: {user_id}")
+    print(f"user_text: '{user_text}'")
+    
+    def build_reset_reply():
         try:
-            success, message = reset_spreadsheet_data(user_id)
+            success, message = reset_spreadsheet_data(user_id, profile)
             print(f"リセット結果: success={success}, message={message}")
             
             if success:
@@ -1332,271 +1629,312 @@ def handle_message(event):
             reply += "システム管理者にお問い合わせください。"
         
         print(f"リセット機能終了: {reply}")
-        send_text_message(event.reply_token, reply)
-        return
-    elif user_text in ["シート名変更"]:
-        # シート名変更機能
-        print(f"=== シート名変更機能開始 ===")
-        print(f"user_id: {user_id}")
-        print(f"user_text: '{user_text}'")
-        
-        if user_manager:
-            print("ユーザー管理システム: 利用可能")
-            # ユーザーの状態をシート名変更に設定
-            set_user_state(user_id, 'sheet_name_change')
-            print(f"ユーザー状態を設定: sheet_name_change")
-            
-            # 現在のスプレッドシート情報を取得
-            current_spreadsheet_id, current_sheet_name = user_manager.get_user_spreadsheet(user_id)
-            current_excel_url, current_excel_file_id, current_excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            
-            print(f"現在のスプレッドシート情報:")
-            print(f"  Google Sheets - ID: {current_spreadsheet_id}, シート名: {current_sheet_name}")
-            print(f"  Excel Online - URL: {current_excel_url}, ファイルID: {current_excel_file_id}, シート名: {current_excel_sheet_name}")
-            
-            # 商品追加機能と同じように、シンプルにシート選択画面を表示
-            print("シート選択画面を表示")
-            flex_message = FlexMessage(
-                alt_text="シート選択",
-                contents=FlexContainer.from_dict(create_sheet_selection())
-            )
-            print("Flex Messageを作成完了")
-            send_flex_message(event.reply_token, flex_message)
-            print("Flex Messageを送信完了")
-            print("=== シート名変更機能終了 ===")
-            return
-        else:
-            print("ユーザー管理システム: 利用不可")
-            reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
-            send_text_message(event.reply_token, reply)
-            return
-
-    # スプレッドシート管理機能
-    print(f"user_text: {user_text}")
-    if re.search(r"スプレッドシート[\s　]*登録[：:]", user_text):
-        print("スプレッドシート登録コマンドを検出")
-        # URLを抽出
-        url = None
-        sheet_name = None
-        for line in user_text.splitlines():
-            if not url:
-                m_url = re.search(r"https?://[\w\-./?%&=:#]+", line)
-                if m_url:
-                    url = m_url.group(0).strip()
-            if not sheet_name:
-                m_sheet = re.search(r"シート名[：:]?[\s　]*(.+)", line)
-                if m_sheet:
-                    sheet_name = m_sheet.group(1).strip()
-        print(f"url: {url}, sheet_name: {sheet_name}")
-        
-        # URLの種類を判定
-        if is_excel_online_url(url):
-            # Microsoft Excel Onlineの場合
-            file_id, _ = extract_excel_online_info(url)
-            if file_id:
-                # シート名が指定されていない場合はデフォルトシート名を使用
-                if not sheet_name:
-                    sheet_name = DEFAULT_SHEET_NAME
-                    print(f"デフォルトシート名を使用: {sheet_name}")
-                
-                success, message = user_manager.set_user_excel_online(user_id, url, file_id, sheet_name)
-                if success:
-                    reply = f"✅ Microsoft Excel Onlineを登録しました！\n\n"
-                    reply += f"📊 Excel Online URL:\n"
-                    reply += f"{url}\n\n"
-                    reply += f"📋 シート名: {sheet_name}\n\n"
-                    reply += "💡 シート名を変更したい場合は、リッチメニューの「スプレッドシート登録」から変更できます。"
-                else:
-                    reply = f"❌ 登録エラー: {message}"
-            else:
-                reply = "❌ Microsoft Excel Online URLが正しくありません。\n\n"
-                reply += "正しい形式：\n"
-                reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx\n\n"
-                reply += "または、シート名を指定：\n"
-                reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx シート名:比較見積書 ロング"
-        else:
-            # Googleスプレッドシートの場合
-            spreadsheet_id = extract_spreadsheet_id(url) if url else None
-            if spreadsheet_id:
-                # シート名が指定されていない場合はデフォルトシート名を使用
-                if not sheet_name:
-                    sheet_name = DEFAULT_SHEET_NAME
-                    print(f"デフォルトシート名を使用: {sheet_name}")
-                
-                success, message = user_manager.set_user_spreadsheet(user_id, spreadsheet_id, sheet_name)
-                if success:
-                    reply = f"✅ Googleスプレッドシートを登録しました！\n\n"
-                    reply += f"📊 スプレッドシートURL:\n"
-                    reply += f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}\n\n"
-                    reply += f"📋 シート名: {sheet_name}\n\n"
-                    reply += "💡 シート名を変更したい場合は、リッチメニューの「スプレッドシート登録」から変更できます。"
-                else:
-                    reply = f"❌ 登録エラー: {message}"
-            else:
-                reply = "❌ スプレッドシートが登録されていません。\n\n"
-                reply += "まずスプレッドシートを登録してください。"
-        send_text_message(event.reply_token, reply)
-        return
-
-    elif user_text == "スプレッドシート確認":
-        print(f"スプレッドシート確認処理開始: user_id={user_id}")
-        if user_manager:
-            # Googleスプレッドシートの情報を取得
-            spreadsheet_id, sheet_name = user_manager.get_user_spreadsheet(user_id)
-            # Microsoft Excel Onlineの情報を取得
-            excel_url, excel_file_id, excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            
-            print(f"取得結果: spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
-            print(f"Excel Online結果: excel_url={excel_url}, excel_file_id={excel_file_id}, excel_sheet_name={excel_sheet_name}")
-            
-            if excel_url and excel_file_id:
-                # Microsoft Excel Onlineが登録されている場合
-                reply = f"📊 あなたのMicrosoft Excel Online\n\n"
-                reply += f"Excel Online URL:\n"
-                reply += f"{excel_url}\n\n"
-                reply += f"シート名: {excel_sheet_name}"
-            elif spreadsheet_id:
-                # Googleスプレッドシートが登録されている場合
-                reply = f"📊 あなたのGoogleスプレッドシート\n\n"
-                reply += f"スプレッドシートURL:\n"
-                reply += f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}\n\n"
-                reply += f"シート名: {sheet_name}"
-            else:
-                # どちらも登録されていない場合
-                reply = f"📊 共有スプレッドシートを使用中\n\n"
-                reply += f"スプレッドシートURL:\n"
-                reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
-                reply += f"シート名: {DEFAULT_SHEET_NAME}\n\n"
-                reply += "💡 独自のスプレッドシートを使用したい場合は、以下の形式で登録してください：\n"
-                reply += "【Googleスプレッドシート】\n"
-                reply += "スプレッドシート登録:https://docs.google.com/spreadsheets/d/xxxxxxx\n\n"
-                reply += "【Microsoft Excel Online】\n"
-                reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx"
-        else:
-            print("user_manager is None")
-            reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
-        send_text_message(event.reply_token, reply)
-        return
+        return reply
+    
+    reply_with_deadline(event, build_reset_reply, 'reset')
 
-    elif user_text == "スプレッドシート登録":
-        # ユーザーの状態をスプレッドシート登録に設定
-        set_user_state(user_id, 'spreadsheet_register')
-        # シート選択画面を表示
+@message_router.command("シート名変更")
+def start_sheet_name_change(event, user_id, user_text, profile):
+    """「シート名変更」: シート選択画面を表示"""
+    # シート名変更機能
+    print(f"=== シート名変更機能開始 ===")
+    print(f"user_id: {user_id}")
+    print(f"user_text: '{user_text}'")
+    
+    if user_manager:
+        print("ユーザー管理システム: 利用可能")
+        # ユーザーの状態をシート名変更に設定
+        set_user_state(user_id, 'sheet_name_change')
+        print(f"ユーザー状態を設定: sheet_name_change")
+        
+        # 現在のスプレッドシート情報を取得
+        current_spreadsheet_id, current_sheet_name = profile.google_sheets_target() if profile else (None, None)
+        current_excel_url, current_excel_file_id, current_excel_sheet_name = profile.excel_online_target() if profile else (None, None, None)
+        
+        print(f"現在のスプレッドシート情報:")
+        print(f"  Google Sheets - ID: {current_spreadsheet_id}, シート名: {current_sheet_name}")
+        print(f"  Excel Online - URL: {current_excel_url}, ファイルID: {current_excel_file_id}, シート名: {current_excel_sheet_name}")
+        
+        # 商品追加機能と同じように、シンプルにシート選択画面を表示
+        print("シート選択画面を表示")
         flex_message = FlexMessage(
             alt_text="シート選択",
-            contents=FlexContainer.from_dict(create_sheet_selection())
+            contents=get_flex_container('sheet_selection')
         )
+        print("Flex Messageを作成完了")
         send_flex_message(event.reply_token, flex_message)
+        print("Flex Messageを送信完了")
+        print("=== シート名変更機能終了 ===")
+        return
+    else:
+        print("ユーザー管理システム: 利用不可")
+        reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
+        send_text_message(event.reply_token, reply)
         return
 
-    # Excel Online URLの処理
-    elif re.search(r"Excel[\s　]*Online[\s　]*登録[：:]", user_text) or re.search(r"エクセル[\s　]*オンライン[\s　]*登録[：:]", user_text):
-        print("Excel Online登録コマンドを検出")
-        # URLを抽出
-        url = None
-        sheet_name = None
-        for line in user_text.splitlines():
-            if not url:
-                m_url = re.search(r"https?://[\w\-./?%&=:#]+", line)
-                if m_url:
-                    url = m_url.group(0).strip()
-            if not sheet_name:
-                m_sheet = re.search(r"シート名[：:]?[\s　]*(.+)", line)
-                if m_sheet:
-                    sheet_name = m_sheet.group(1).strip()
-        
-        print(f"Excel Online URL: {url}, sheet_name: {sheet_name}")
-        
-        if url and excel_online_manager:
-            # URLの妥当性をチェック
-            is_valid, error_msg = excel_online_manager.validate_excel_url(url)
-            if not is_valid:
-                reply = f"❌ Excel Online URLが正しくありません: {error_msg}\n\n"
-                reply += "正しい形式：\n"
-                reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/...\n\n"
-                reply += "または、シート名を指定：\n"
-                reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書"
-                send_text_message(event.reply_token, reply)
-                return
-            
-            # ファイルIDを抽出
-            file_id = excel_online_manager.extract_file_id_from_url(url)
-            if not file_id:
-                reply = "❌ Excel Online URLからファイルIDを抽出できませんでした。\n\n"
-                reply += "正しいSharePoint/OneDrive URLを入力してください。"
-                send_text_message(event.reply_token, reply)
-                return
-            
-            # シート名が指定されていない場合は実際のシート名を取得
+@message_router.pattern(r"スプレッドシート[\s　]*登録[：:]")
+def register_spreadsheet(event, user_id, user_text, profile):
+    """「スプレッドシート登録:URL」: Google Sheetsを登録"""
+    print("スプレッドシート登録コマンドを検出")
+    # URLを抽出
+    url = None
+    sheet_name = None
+    for line in user_text.splitlines():
+        if not url:
+            m_url = re.search(r"https?://[\w\-./?%&=:#]+", line)
+            if m_url:
+                url = m_url.group(0).strip()
+        if not sheet_name:
+            m_sheet = re.search(r"シート名[：:]?[\s　]*(.+)", line)
+            if m_sheet:
+                sheet_name = m_sheet.group(1).strip()
+    print(f"url: {url}, sheet_name: {sheet_name}")
+    
+    # URLの種類を判定
+    if is_excel_online_url(url):
+        # Microsoft Excel Onlineの場合
+        file_id, _ = extract_excel_online_info(url)
+        if file_id:
+            # シート名が指定されていない場合はデフォルトシート名を使用
             if not sheet_name:
-                try:
-                    worksheets, error = excel_online_manager.get_worksheets(file_id)
-                    if worksheets and not error:
-                        sheet_name = worksheets[0]  # 最初のシートを使用
-                        print(f"取得したシート名: {sheet_name}")
-                    else:
-                        sheet_name = "Sheet1"  # フォールバック
-                        print(f"シート名取得エラー: {error}")
-                except Exception as e:
-                    print(f"シート名取得エラー: {e}")
-                    sheet_name = "Sheet1"  # フォールバック
+                sheet_name = DEFAULT_SHEET_NAME
+                print(f"デフォルトシート名を使用: {sheet_name}")
             
-            # ユーザーのExcel Online設定を保存
             success, message = user_manager.set_user_excel_online(user_id, url, file_id, sheet_name)
             if success:
-                reply = f"✅ Excel Onlineファイルを登録しました！\n\n"
+                reply = f"✅ Microsoft Excel Onlineを登録しました！\n\n"
                 reply += f"📊 Excel Online URL:\n"
                 reply += f"{url}\n\n"
                 reply += f"📋 シート名: {sheet_name}\n\n"
-                reply += "これで商品データがこのExcel Onlineファイルに反映されます。"
+                reply += "💡 シート名を変更したい場合は、リッチメニューの「スプレッドシート登録」から変更できます。"
             else:
                 reply = f"❌ 登録エラー: {message}"
         else:
-            reply = "❌ Excel Online URLが正しくありません。\n\n"
+            reply = "❌ Microsoft Excel Online URLが正しくありません。\n\n"
+            reply += "正しい形式：\n"
+            reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx\n\n"
+            reply += "または、シート名を指定：\n"
+            reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx シート名:比較見積書 ロング"
+    else:
+        # Googleスプレッドシートの場合
+        spreadsheet_id = extract_spreadsheet_id(url) if url else None
+        if spreadsheet_id:
+            # シート名が指定されていない場合はデフォルトシート名を使用
+            if not sheet_name:
+                sheet_name = DEFAULT_SHEET_NAME
+                print(f"デフォルトシート名を使用: {sheet_name}")
+            
+            success, message = user_manager.set_user_spreadsheet(user_id, spreadsheet_id, sheet_name)
+            if success:
+                reply = f"✅ Googleスプレッドシートを登録しました！\n\n"
+                reply += f"📊 スプレッドシートURL:\n"
+                reply += f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}\n\n"
+                reply += f"📋 シート名: {sheet_name}\n\n"
+                reply += "💡 シート名を変更したい場合は、リッチメニューの「スプレッドシート登録」から変更できます。"
+            else:
+                reply = f"❌ 登録エラー: {message}"
+        else:
+            reply = "❌ スプレッドシートが登録されていません。\n\n"
+            reply += "まずスプレッドシートを登録してください。"
+    send_text_message(event.reply_token, reply)
+
+@message_router.command("スプレッドシート確認")
+def show_spreadsheet_info(event, user_id, user_text, profile):
+    """「スプレッドシート確認」: 登録済みのGoogle Sheetsを表示"""
+    print(f"スプレッドシート確認処理開始: user_id={user_id}")
+    if user_manager:
+        # Googleスプレッドシートの情報を取得
+        spreadsheet_id, sheet_name = profile.google_sheets_target() if profile else (None, None)
+        # Microsoft Excel Onlineの情報を取得
+        excel_url, excel_file_id, excel_sheet_name = profile.excel_online_target() if profile else (None, None, None)
+        
+        print(f"取得結果: spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
+        print(f"Excel Online結果: excel_url={excel_url}, excel_file_id={excel_file_id}, excel_sheet_name={excel_sheet_name}")
+        
+        if excel_url and excel_file_id:
+            # Microsoft Excel Onlineが登録されている場合
+            reply = f"📊 あなたのMicrosoft Excel Online\n\n"
+            reply += f"Excel Online URL:\n"
+            reply += f"{excel_url}\n\n"
+            reply += f"シート名: {excel_sheet_name}"
+        elif spreadsheet_id:
+            # Googleスプレッドシートが登録されている場合
+            reply = f"📊 あなたのGoogleスプレッドシート\n\n"
+            reply += f"スプレッドシートURL:\n"
+            reply += f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}\n\n"
+            reply += f"シート名: {sheet_name}"
+        else:
+            # どちらも登録されていない場合
+            reply = f"📊 共有スプレッドシートを使用中\n\n"
+            reply += f"スプレッドシートURL:\n"
+            reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
+            reply += f"シート名: {DEFAULT_SHEET_NAME}\n\n"
+            reply += "💡 独自のスプレッドシートを使用したい場合は、以下の形式で登録してください：\n"
+            reply += "【Googleスプレッドシート】\n"
+            reply += "スプレッドシート登録:https://docs.google.com/spreadsheets/d/xxxxxxx\n\n"
+            reply += "【Microsoft Excel Online】\n"
+            reply += "スプレッドシート登録:https://your-tenant.sharepoint.com/path/to/spreadsheet.xlsx"
+    else:
+        print("user_manager is None")
+        reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
+    send_text_message(event.reply_token, reply)
+
+@message_router.pattern(r"Excel[\s　]*Online[\s　]*登録[：:]", r"エクセル[\s　]*オンライン[\s　]*登録[：:]")
+def register_excel_online(event, user_id, user_text, profile):
+    """「Excel Online登録:URL」: Excel Onlineを登録"""
+    print("Excel Online登録コマンドを検出")
+    # URLを抽出
+    url = None
+    sheet_name = None
+    for line in user_text.splitlines():
+        if not url:
+            m_url = re.search(r"https?://[\w\-./?%&=:#]+", line)
+            if m_url:
+                url = m_url.group(0).strip()
+        if not sheet_name:
+            m_sheet = re.search(r"シート名[：:]?[\s　]*(.+)", line)
+            if m_sheet:
+                sheet_name = m_sheet.group(1).strip()
+    
+    print(f"Excel Online URL: {url}, sheet_name: {sheet_name}")
+    
+    if url and excel_online_manager:
+        # URLの妥当性をチェック
+        is_valid, error_msg = excel_online_manager.validate_excel_url(url)
+        if not is_valid:
+            reply = f"❌ Excel Online URLが正しくありません: {error_msg}\n\n"
             reply += "正しい形式：\n"
             reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/...\n\n"
             reply += "または、シート名を指定：\n"
-            reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書\n\n"
-            reply += "⚠️ 重要：\n"
-            reply += "• SharePoint/OneDriveのExcel Onlineファイルを使用してください\n"
-            reply += "• ファイルは共有設定で「編集者」に設定してください\n"
-            reply += "• シート名を指定しない場合は、最初のシートが使用されます"
-        send_text_message(event.reply_token, reply)
-        return
+            reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書"
+            send_text_message(event.reply_token, reply)
+            return
+        
+        # ファイルIDを抽出
+        file_id = excel_online_manager.extract_file_id_from_url(url)
+        if not file_id:
+            reply = "❌ Excel Online URLからファイルIDを抽出できませんでした。\n\n"
+            reply += "正しいSharePoint/OneDrive URLを入力してください。"
+            send_text_message(event.reply_token, reply)
+            return
+        
+        # シート名が指定されていない場合は実際のシート名を取得
+        if not sheet_name:
+            try:
+                worksheets, error = excel_online_manager.get_worksheets(file_id)
+                if worksheets and not error:
+                    sheet_name = worksheets[0]  # 最初のシートを使用
+                    print(f"取得したシート名: {sheet_name}")
+                else:
+                    sheet_name = "Sheet1"  # フォールバック
+                    print(f"シート名取得エラー: {error}")
+            except Exception as e:
+                print(f"シート名取得エラー: {e}")
+                sheet_name = "Sheet1"  # フォールバック
+        
+        # ユーザーのExcel Online設定を保存
+        success, message = user_manager.set_user_excel_online(user_id, url, file_id, sheet_name)
+        if success:
+            reply = f"✅ Excel Onlineファイルを登録しました！\n\n"
+            reply += f"📊 Excel Online URL:\n"
+            reply += f"{url}\n\n"
+            reply += f"📋 シート名: {sheet_name}\n\n"
+            reply += "これで商品データがこのExcel Onlineファイルに反映されます。"
+        else:
+            reply = f"❌ 登録エラー: {message}"
+    else:
+        reply = "❌ Excel Online URLが正しくありません。\n\n"
+        reply += "正しい形式：\n"
+        reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/...\n\n"
+        reply += "または、シート名を指定：\n"
+        reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書\n\n"
+        reply += "⚠️ 重要：\n"
+        reply += "• SharePoint/OneDriveのExcel Onlineファイルを使用してください\n"
+        reply += "• ファイルは共有設定で「編集者」に設定してください\n"
+        reply += "• シート名を指定しない場合は、最初のシートが使用されます"
+    send_text_message(event.reply_token, reply)
 
-    elif user_text == "Excel Online確認" or user_text == "エクセルオンライン確認":
-        print(f"Excel Online確認処理開始: user_id={user_id}")
-        if user_manager:
-            excel_url, excel_file_id, excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            print(f"取得結果: excel_url={excel_url}, excel_file_id={excel_file_id}, excel_sheet_name={excel_sheet_name}")
-            if excel_url:
-                reply = f"📊 あなたのExcel Onlineファイル\n\n"
-                reply += f"Excel Online URL:\n"
-                reply += f"{excel_url}\n\n"
-                reply += f"シート名: {excel_sheet_name}"
-            else:
-                reply = f"📊 共有スプレッドシートを使用中\n\n"
-                reply += f"スプレッドシートURL:\n"
-                reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
-                reply += f"シート名: {DEFAULT_SHEET_NAME}\n\n"
-                reply += "💡 Excel Onlineファイルを使用したい場合は、以下の形式で登録してください：\n"
-                reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書"
+@message_router.command("Excel Online確認", "エクセルオンライン確認")
+def show_excel_online_info(event, user_id, user_text, profile):
+    """「Excel Online確認」: 登録済みのExcel Onlineを表示"""
+    print(f"Excel Online確認処理開始: user_id={user_id}")
+    if user_manager:
+        excel_url, excel_file_id, excel_sheet_name = profile.excel_online_target() if profile else (None, None, None)
+        print(f"取得結果: excel_url={excel_url}, excel_file_id={excel_file_id}, excel_sheet_name={excel_sheet_name}")
+        if excel_url:
+            reply = f"📊 あなたのExcel Onlineファイル\n\n"
+            reply += f"Excel Online URL:\n"
+            reply += f"{excel_url}\n\n"
+            reply += f"シート名: {excel_sheet_name}"
         else:
-            print("user_manager is None")
-            reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
+            reply = f"📊 共有スプレッドシートを使用中\n\n"
+            reply += f"スプレッドシートURL:\n"
+            reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
+            reply += f"シート名: {DEFAULT_SHEET_NAME}\n\n"
+            reply += "💡 Excel Onlineファイルを使用したい場合は、以下の形式で登録してください：\n"
+            reply += "Excel Online登録:https://unimatlifejp-my.sharepoint.com/... シート名:見積書"
+    else:
+        print("user_manager is None")
+        reply = "❌ システムエラー: ユーザー管理システムが利用できません。"
+    send_text_message(event.reply_token, reply)
+
+@message_router.pattern(BULK_COMMAND_PATTERN.pattern)
+def bulk_add_products(event, user_id, user_text, profile):
+    """「一括登録」: 続けて入力された複数商品をまとめて登録（見積の貼り付け用）"""
+    records, errors = parse_bulk_records(user_text)
+    if errors:
+        reply = "❌ 読み取れない商品があるため、登録しませんでした。\n\n"
+        reply += '\n'.join(errors) + "\n\n"
+        reply += "商品名・単価・数量（数値）を入力してください。"
+        send_text_message(event.reply_token, reply)
+        return
+    if not records:
+        reply = "複数の商品をまとめて登録するには、1行目に「一括登録」と入力し、\n"
+        reply += "2行目以降に1行1商品で入力してください：\n\n"
+        reply += "一括登録\n"
+        reply += "商品名,単価,数量,サイクル,設置場所\n"
+        reply += "マット,1200,3,月1回,玄関\n"
+        reply += "モップ、1,200、2、月2回\n\n"
+        reply += "※ 1,200のような3桁区切りのカンマを使う場合は「、」かタブで区切ってください。\n"
+        reply += "※ スプレッドシートからコピーしたタブ区切りの行、\n"
+        reply += "「商品名:○○」形式の入力（空行区切り）も使えます。"
         send_text_message(event.reply_token, reply)
         return
+    add_product_records(event, user_id, profile, records, 'bulk_add_product')
+
+@handler.add(MessageEvent, message=TextMessageContent)
+def handle_message(event):
+    user_id = event.source.user_id
+    user_text = event.message.text.strip()
+    
+    # デバッグ情報を追加
+    print(f"=== メッセージ受信 ===")
+    print(f"user_id: {user_id}")
+    print(f"user_text: '{user_text}'")
+    print(f"user_text length: {len(user_text)}")
+    print(f"user_text bytes: {user_text.encode('utf-8')}")
+    print(f"=== メッセージ受信終了 ===")
+
+    # ユーザー登録（初回利用時）と書き込み先の読み込み（このイベント内ではprofileを使い回す）
+    profile = ensure_user_profile(user_id)
+
+    # リッチメニューやテキストコマンドに応じた返答
+    if message_router.dispatch(user_text, event, user_id, user_text, profile):
+        return
 
     # それ以外は従来通りの案内＋データ解析・登録
-    data = parse_estimate_data(user_text)
+    reply = ""
+    records = parse_estimate_records(user_text)
+    data = records[0] if records else {}
     if data:
-        # 会社情報の更新か商品データの書き込みかを判定
+        # 会社情報の更新か商品データの書き込みかを判定（商品の項目が1つもなければ会社情報のみ）
         is_company_update = '社名' in data or '会社名' in data or '日付' in data
-        is_product_data = '商品名' in data and '単価' in data and '数量' in data
+        product_records = [record for record in records if has_product_fields(record)]
+        incomplete_products = find_incomplete_products(product_records)
 
-        if is_company_update and not is_product_data:
+        if is_company_update and not product_records:
             # 会社情報の更新
-            success, message = update_company_info(data, user_id)
+            success, message = update_company_info(data, user_id, profile)
             if success:
                 reply = f"会社情報を更新しました！\n\n"
                 if '社名' in data:
@@ -1606,42 +1944,21 @@ def handle_message(event):
             else:
                 reply = f"エラー: {message}"
 
-        elif is_product_data:
-            # 利用制限チェック
-            if user_manager:
-                can_use, limit_message = user_manager.check_usage_limit(user_id)
-                if not can_use:
-                    reply = f"❌ {limit_message}\n\n"
-                    reply += "プランアップグレードをご検討ください。\n"
-                    reply += "「メニュー」→「利用状況確認」で詳細を確認できます。"
-                    send_text_message(event.reply_token, reply)
-                    return
-            else:
-                print("User management system not available, skipping usage limit check")
-
-            # 商品データの書き込み
-            success, message = write_to_spreadsheet(data, user_id)
-            if success:
-                # 利用回数を記録
-                if user_manager:
-                    user_manager.increment_usage(user_id, "add_product", data)
-                reply = f"✅ 見積書を作成しました！\n\n"
-                reply += f"📋 登録内容:\n"
-                reply += f"社名: {data.get('社名', 'N/A')}\n"
-                reply += f"商品名: {data.get('商品名', 'N/A')}\n"
-                reply += f"サイズ: {data.get('サイズ', 'N/A')}\n"
-                reply += f"単価: {data.get('単価', 'N/A')}\n"
-                reply += f"数量: {data.get('数量', 'N/A')}\n"
-                reply += f"料金: {data.get('料金', 'N/A')}\n\n"
-                reply += f"📊 スプレッドシートに反映されました。"
-            else:
-                reply = f"❌ 見積書作成エラー: {message}"
+        elif product_records and not incomplete_products:
+            add_product_records(event, user_id, profile, product_records, 'add_product')
+            return
+        elif incomplete_products:
+            # 1件でも欠けていれば書き込まず、どの商品に何が足りないかを返す
+            reply = "❌ 項目が足りない商品があるため、登録していません。\n\n"
+            reply += "\n".join(incomplete_products)
+            reply += "\n\n各商品に商品名・単価・数量を入力して、もう一度送信してください。"
         else:
             reply = "データの形式が正しくありません。\n\n"
             reply += "【会社情報更新】\n"
             reply += "例: 会社名:ABC株式会社 日付:2024/01/15\n\n"
             reply += "【商品データ登録】\n"
-            reply += "例: 社名:ABC株式会社 商品名:商品A サイズ:M 単価:1000 数量:5\n\n"
+            reply += "例: 社名:ABC株式会社 商品名:商品A サイズ:M 単価:1000 数量:5\n"
+            reply += "※ 複数の商品は空行で区切って続けて入力できます\n\n"
             reply += "【追加項目（シートによって利用可能）】\n"
             reply += "サイクル:月1回 設置場所:1階\n\n"
             reply += "【語尾指定（比較見積書系のみ）】\n"
@@ -1655,6 +1972,7 @@ def handle_message(event):
         reply = "見積書作成システムへようこそ！\n\n"
         reply += "以下のコマンドが利用できます：\n\n"
         reply += "📝 商品を追加\n"
+        reply += "📋 一括登録（複数商品の貼り付け）\n"
         reply += "📊 スプレッドシート登録\n"
         reply += "📊 Excel Online登録\n"
         reply += "🏢 会社情報を更新\n"
@@ -1665,111 +1983,110 @@ def handle_message(event):
     
     send_text_message(event.reply_token, reply)
 
-@handler.add(PostbackEvent)
-def handle_postback(event):
-    """Postbackイベントの処理（ボタンクリック）"""
-    user_id = event.source.user_id
-    data = event.postback.data
-    print(f"Received postback from {user_id}: {data}")
+@postback_router.command('add_product')
+def postback_add_product(event, user_id, params, profile):
+    """add_product: 商品選択画面を表示"""
+    flex_message = FlexMessage(
+        alt_text="商品選択",
+        contents=get_flex_container('product_selection')
+    )
+    send_flex_message(event.reply_token, flex_message)
+
+@postback_router.command('custom_product')
+def postback_custom_product(event, user_id, params, profile):
+    """custom_product: カスタム商品名入力の案内"""
+    reply = "カスタム商品を追加するには、以下の形式で入力してください：\n\n"
+    reply += "【基本項目】\n"
+    reply += "商品名:○○○○\n"
+    reply += "サイズ:○○\n"
+    reply += "単価:○○○○\n"
+    reply += "数量:○○\n\n"
+    reply += "【追加項目（シートによって利用可能）】\n"
+    reply += "サイクル:○○\n"
+    reply += "設置場所:○○\n\n"
+    reply += "【語尾指定（比較見積書系のみ）】\n"
+    reply += "商品名:マット 現状  ← 現状用の列に書き込み\n"
+    reply += "商品名:マット 当社  ← 当社用の列に書き込み\n\n"
+    reply += "例：\n"
+    reply += "商品名:オリジナルTシャツ\n"
+    reply += "サイズ:L\n"
+    reply += "単価:2000\n"
+    reply += "数量:5\n"
+    reply += "サイクル:週2"
+    send_text_message(event.reply_token, reply)
+
+@postback_router.command('select_product')
+def postback_select_product(event, user_id, params, profile):
+    """select_product: サイズ選択画面を表示"""
+    product = params.get('product', '')
+    flex_message = FlexMessage(
+        alt_text="サイズ選択",
+        contents=get_size_selection_container(product)
+    )
+    send_flex_message(event.reply_token, flex_message)
+
+@postback_router.command('custom_price')
+def postback_custom_price(event, user_id, params, profile):
+    """custom_price: カスタム価格入力の案内"""
+    product = params.get('product', '')
+    reply = f"{product}のカスタム価格を設定するには、以下の形式で入力してください：\n\n"
+    reply += f"商品名:{product}\n"
+    reply += "サイズ:○○\n"
+    reply += "単価:○○○○\n"
+    reply += "数量:○○\n"
+    reply += "サイクル:○○\n\n"
+    reply += f"例：\n"
+    reply += f"商品名:{product}\n"
+    reply += "サイズ:L\n"
+    reply += "単価:1800\n"
+    reply += "数量:3\n"
+    reply += "サイクル:週2"
+    send_text_message(event.reply_token, reply)
+
+@postback_router.command('select_quantity')
+def postback_select_quantity(event, user_id, params, profile):
+    """select_quantity: 商品データをスプレッドシートに書き込み"""
+    product = params.get('product', '')
+    size = params.get('size', '')
+    price = params.get('price', '')
+    quantity = params.get('quantity', '')
     
-    # データをパース
-    params = {}
-    for item in data.split('&'):
-        if '=' in item:
-            key, value = item.split('=', 1)
-            params[key] = value
+    # デバッグ用ログ
+    print(f"Processing quantity selection: product={product}, size={size}, price={price}, quantity={quantity}")
     
-    action = params.get('action', '')
+    try:
+        total = int(price) * int(quantity)
+    except ValueError:
+        send_text_message(event.reply_token, f"❌ エラー: 単価「{price}」または数量「{quantity}」が数値ではありません")
+        return
     
-    if action == 'add_product':
-        # 商品選択画面を表示
-        flex_message = FlexMessage(
-            alt_text="商品選択",
-            contents=FlexContainer.from_dict(create_product_selection())
-        )
-        send_flex_message(event.reply_token, flex_message)
-        
-    elif action == 'custom_product':
-        # カスタム商品名入力の案内
-        reply = "カスタム商品を追加するには、以下の形式で入力してください：\n\n"
-        reply += "【基本項目】\n"
-        reply += "商品名:○○○○\n"
-        reply += "サイズ:○○\n"
-        reply += "単価:○○○○\n"
-        reply += "数量:○○\n\n"
-        reply += "【追加項目（シートによって利用可能）】\n"
-        reply += "サイクル:○○\n"
-        reply += "設置場所:○○\n\n"
-        reply += "【語尾指定（比較見積書系のみ）】\n"
-        reply += "商品名:マット 現状  ← 現状用の列に書き込み\n"
-        reply += "商品名:マット 当社  ← 当社用の列に書き込み\n\n"
-        reply += "例：\n"
-        reply += "商品名:オリジナルTシャツ\n"
-        reply += "サイズ:L\n"
-        reply += "単価:2000\n"
-        reply += "数量:5\n"
-        reply += "サイクル:週2"
-        send_text_message(event.reply_token, reply)
-        
-    elif action == 'select_product':
-        # サイズ選択画面を表示
-        product = params.get('product', '')
-        flex_message = FlexMessage(
-            alt_text="サイズ選択",
-            contents=FlexContainer.from_dict(create_size_selection(product))
-        )
-        send_flex_message(event.reply_token, flex_message)
-        
-    elif action == 'custom_price':
-        # カスタム価格入力の案内
-        product = params.get('product', '')
-        reply = f"{product}のカスタム価格を設定するには、以下の形式で入力してください：\n\n"
-        reply += f"商品名:{product}\n"
-        reply += "サイズ:○○\n"
-        reply += "単価:○○○○\n"
-        reply += "数量:○○\n"
-        reply += "サイクル:○○\n\n"
-        reply += f"例：\n"
-        reply += f"商品名:{product}\n"
-        reply += "サイズ:L\n"
-        reply += "単価:1800\n"
-        reply += "数量:3\n"
-        reply += "サイクル:週2"
-        send_text_message(event.reply_token, reply)
-        
-    elif action == 'select_quantity':
-        # 商品データをスプレッドシートに書き込み
-        product = params.get('product', '')
-        size = params.get('size', '')
-        price = params.get('price', '')
-        quantity = params.get('quantity', '')
-        
-        # デバッグ用ログ
-        print(f"Processing quantity selection: product={product}, size={size}, price={price}, quantity={quantity}")
-        
-        # 利用制限チェック
-        if user_manager:
-            can_use, limit_message = user_manager.check_usage_limit(user_id)
-            if not can_use:
-                reply = f"❌ {limit_message}\n\n"
-                reply += "プランアップグレードをご検討ください。\n"
-                reply += "「メニュー」→「利用状況確認」で詳細を確認できます。"
-                send_text_message(event.reply_token, reply)
-                return
-        else:
-            print("User management system not available, skipping usage limit check")
-        
-        data = {
-            '商品名': product,
-            'サイズ': size,
-            '単価': price,
-            '数量': quantity,
-            '料金': int(price) * int(quantity)
-        }
-        
-        success, message = write_to_spreadsheet(data, user_id)
+    # 利用制限チェック
+    if user_manager:
+        can_use, limit_message = user_manager.reserve_usage(user_id)
+        if not can_use:
+            reply = f"❌ {limit_message}\n\n"
+            reply += "プランアップグレードをご検討ください。\n"
+            reply += "「メニュー」→「利用状況確認」で詳細を確認できます。"
+            send_text_message(event.reply_token, reply)
+            return
+    else:
+        print("User management system not available, skipping usage limit check")
+    
+    data = {
+        '商品名': product,
+        'サイズ': size,
+        '単価': price,
+        '数量': quantity,
+        '料金': total
+    }
+    
+    written = False
+    def build_add_product_reply():
+        nonlocal written
+        success, message = write_to_spreadsheet(data, user_id, profile)
         
         if success:
+            written = True
             # 利用回数を記録
             if user_manager:
                 user_manager.increment_usage(user_id, "add_product", data)
@@ -1784,166 +2101,200 @@ def handle_postback(event):
         else:
             reply = f"❌ エラー: {message}"
         
-        send_text_message(event.reply_token, reply)
-        
-    elif action == 'check_usage':
-        # 利用状況確認
-        if user_manager:
-            summary = user_manager.get_usage_summary(user_id)
-            send_text_message(event.reply_token, summary)
-        else:
-            print("User management system not available, skipping usage summary")
-        
-    elif action == 'update_company':
-        # 会社情報更新の案内
-        reply = "会社情報を更新するには、以下の形式で入力してください：\n\n"
-        reply += "会社名:○○株式会社\n"
-        reply += "日付:2024/01/15\n\n"
-        reply += "または、\n"
-        reply += "会社名:○○株式会社 日付:2024/01/15"
-        send_text_message(event.reply_token, reply)
-        
-    elif action == 'view_estimate':
-        # 見積書確認の案内
-        reply = "現在の見積書を確認するには、Googleスプレッドシートを直接確認してください。\n\n"
-        reply += "📊 共有スプレッドシートURL:\n"
-        reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
-        reply += "💡 独自のスプレッドシートを登録している場合は、そのスプレッドシートを確認してください。"
-        send_text_message(event.reply_token, reply)
-        return
-
-    elif action == 'upgrade_plan':
-        # プラン選択画面を表示
-        if stripe_payment:
-            flex_message = FlexMessage(
-                alt_text="プラン選択",
-                contents=FlexContainer.from_dict(create_plan_selection())
-            )
-            send_flex_message(event.reply_token, flex_message)
-        else:
-            reply = "申し訳ございません。決済システムが利用できません。"
-            send_text_message(event.reply_token, reply)
+        return reply
     
-    elif action == 'show_sheet_selection':
-        # シート選択画面を表示
+    try:
+        reply_with_deadline(event, build_add_product_reply, 'add_product')
+    finally:
+        # 書き込みに失敗・例外・タスクを実行できなかった場合は確保した利用回数を戻す
+        if user_manager and not written:
+            user_manager.release_usage(user_id)
+
+@postback_router.command('check_usage')
+def postback_check_usage(event, user_id, params, profile):
+    """check_usage: 利用状況確認"""
+    if user_manager:
+        summary = user_manager.get_usage_summary(user_id)
+        send_text_message(event.reply_token, summary)
+    else:
+        print("User management system not available, skipping usage summary")
+
+@postback_router.command('update_company')
+def postback_update_company(event, user_id, params, profile):
+    """update_company: 会社情報更新の案内"""
+    reply = "会社情報を更新するには、以下の形式で入力してください：\n\n"
+    reply += "会社名:○○株式会社\n"
+    reply += "日付:2024/01/15\n\n"
+    reply += "または、\n"
+    reply += "会社名:○○株式会社 日付:2024/01/15"
+    send_text_message(event.reply_token, reply)
+
+@postback_router.command('view_estimate')
+def postback_view_estimate(event, user_id, params, profile):
+    """view_estimate: 見積書確認の案内"""
+    reply = "現在の見積書を確認するには、Googleスプレッドシートを直接確認してください。\n\n"
+    reply += "📊 共有スプレッドシートURL:\n"
+    reply += f"https://docs.google.com/spreadsheets/d/{SHARED_SPREADSHEET_ID}\n\n"
+    reply += "💡 独自のスプレッドシートを登録している場合は、そのスプレッドシートを確認してください。"
+    send_text_message(event.reply_token, reply)
+
+@postback_router.command('upgrade_plan')
+def postback_upgrade_plan(event, user_id, params, profile):
+    """upgrade_plan: プラン選択画面を表示"""
+    if stripe_payment:
         flex_message = FlexMessage(
-            alt_text="シート選択",
-            contents=FlexContainer.from_dict(create_sheet_selection())
+            alt_text="プラン選択",
+            contents=get_flex_container('plan_selection')
         )
         send_flex_message(event.reply_token, flex_message)
-    
-    elif action == 'select_sheet':
-        # シート選択時の処理
-        sheet_name = params.get('sheet', '')
-        print(f"Sheet selection: {sheet_name} for user {user_id}")
-        
-        # 現在のスプレッドシート情報を取得
-        if user_manager:
-            current_spreadsheet_id, current_sheet_name = user_manager.get_user_spreadsheet(user_id)
-            current_excel_url, current_excel_file_id, current_excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            user_state = get_user_state(user_id)
+    else:
+        reply = "申し訳ございません。決済システムが利用できません。"
+        send_text_message(event.reply_token, reply)
 
-            # シート変更処理（user_stateに関係なく実行）
-            if current_excel_url and current_excel_file_id:
-                # Microsoft Excel Onlineが登録されている場合
-                if current_excel_sheet_name != sheet_name:
-                    success, message = user_manager.set_user_excel_online(user_id, current_excel_url, current_excel_file_id, sheet_name)
-                    if not success:
-                        reply = f"❌ シート変更エラー: {message}\n\n"
-                        reply += "スプレッドシートの登録からやり直してください。"
-                        send_text_message(event.reply_token, reply)
-                        return
-                
-                # ユーザーの状態に応じてメッセージを変更
-                if user_state == 'sheet_name_change':
-                    reply = f"✅ シート名を変更しました！\n\n"
-                    reply += f"📊 Excel Online URL:\n"
-                    reply += f"{current_excel_url}\n\n"
-                    reply += f"📋 変更前シート: {current_excel_sheet_name}\n"
-                    reply += f"📋 変更後シート: {sheet_name}\n\n"
-                    reply += "これで商品データが選択したシートに反映されます。"
-                    # ユーザーの状態をリセット
-                    set_user_state(user_id, '')
-                else:
-                    reply = f"✅ Microsoft Excel Onlineのシートを変更しました！\n\n"
-                    reply += f"📊 Excel Online URL:\n"
-                    reply += f"{current_excel_url}\n\n"
-                    reply += f"📋 変更前シート: {current_excel_sheet_name}\n"
-                    reply += f"📋 変更後シート: {sheet_name}\n\n"
-                    reply += "これで商品データが選択したシートに反映されます。"
-            elif current_spreadsheet_id:
-                # Googleスプレッドシートが登録されている場合
-                if current_sheet_name != sheet_name:
-                    success, message = user_manager.set_user_spreadsheet(user_id, current_spreadsheet_id, sheet_name)
-                    if not success:
-                        reply = f"❌ シート変更エラー: {message}\n\n"
-                        reply += "スプレッドシートの登録からやり直してください。"
-                        send_text_message(event.reply_token, reply)
-                        return
-                
-                # ユーザーの状態に応じてメッセージを変更
-                if user_state == 'sheet_name_change':
-                    reply = f"✅ シート名を変更しました！\n\n"
-                    reply += f"📊 スプレッドシートURL:\n"
-                    reply += f"https://docs.google.com/spreadsheets/d/{current_spreadsheet_id}\n\n"
-                    reply += f"📋 変更前シート: {current_sheet_name}\n"
-                    reply += f"📋 変更後シート: {sheet_name}\n\n"
-                    reply += "これで商品データが選択したシートに反映されます。"
-                    # ユーザーの状態をリセット
-                    set_user_state(user_id, '')
-                else:
-                    reply = f"✅ Googleスプレッドシートのシートを変更しました！\n\n"
-                    reply += f"📊 スプレッドシートURL:\n"
-                    reply += f"https://docs.google.com/spreadsheets/d/{current_spreadsheet_id}\n\n"
-                    reply += f"📋 変更前シート: {current_sheet_name}\n"
-                    reply += f"📋 変更後シート: {sheet_name}\n\n"
-                    reply += "これで商品データが選択したシートに反映されます。"
+@postback_router.command('show_sheet_selection')
+def postback_show_sheet_selection(event, user_id, params, profile):
+    """show_sheet_selection: シート選択画面を表示"""
+    flex_message = FlexMessage(
+        alt_text="シート選択",
+        contents=get_flex_container('sheet_selection')
+    )
+    send_flex_message(event.reply_token, flex_message)
+
+@postback_router.command('select_sheet')
+def postback_select_sheet(event, user_id, params, profile):
+    """select_sheet: シート選択時の処理"""
+    sheet_name = params.get('sheet', '')
+    print(f"Sheet selection: {sheet_name} for user {user_id}")
+    
+    # 現在のスプレッドシート情報を取得
+    if user_manager:
+        current_spreadsheet_id, current_sheet_name = profile.google_sheets_target() if profile else (None, None)
+        current_excel_url, current_excel_file_id, current_excel_sheet_name = profile.excel_online_target() if profile else (None, None, None)
+        user_state = get_user_state(user_id)
+
+        # シート変更処理（user_stateに関係なく実行）
+        if current_excel_url and current_excel_file_id:
+            # Microsoft Excel Onlineが登録されている場合
+            if current_excel_sheet_name != sheet_name:
+                success, message = user_manager.set_user_excel_online(user_id, current_excel_url, current_excel_file_id, sheet_name)
+                if not success:
+                    reply = f"❌ シート変更エラー: {message}\n\n"
+                    reply += "スプレッドシートの登録からやり直してください。"
+                    send_text_message(event.reply_token, reply)
+                    return
+            
+            # ユーザーの状態に応じてメッセージを変更
+            if user_state == 'sheet_name_change':
+                reply = f"✅ シート名を変更しました！\n\n"
+                reply += f"📊 Excel Online URL:\n"
+                reply += f"{current_excel_url}\n\n"
+                reply += f"📋 変更前シート: {current_excel_sheet_name}\n"
+                reply += f"📋 変更後シート: {sheet_name}\n\n"
+                reply += "これで商品データが選択したシートに反映されます。"
+                # ユーザーの状態をリセット
+                set_user_state(user_id, '')
             else:
-                reply = "❌ スプレッドシートが登録されていません。\n\n"
-                reply += "まずスプレッドシートを登録してください。"
-            send_text_message(event.reply_token, reply)
-            return
-
-    elif action == 'select_plan':
-        # プラン選択時の処理
-        plan_type = params.get('plan', '')
-        print(f"Plan selection: {plan_type} for user {user_id}")
-        
-        if stripe_payment and user_manager:
-            print("Stripe payment and user manager are available")
-            # Stripeチェックアウトセッションを作成
-            success, result = stripe_payment.create_checkout_session(plan_type, user_id)
-            print(f"Checkout session result: success={success}, result={result}")
+                reply = f"✅ Microsoft Excel Onlineのシートを変更しました！\n\n"
+                reply += f"📊 Excel Online URL:\n"
+                reply += f"{current_excel_url}\n\n"
+                reply += f"📋 変更前シート: {current_excel_sheet_name}\n"
+                reply += f"📋 変更後シート: {sheet_name}\n\n"
+                reply += "これで商品データが選択したシートに反映されます。"
+        elif current_spreadsheet_id:
+            # Googleスプレッドシートが登録されている場合
+            if current_sheet_name != sheet_name:
+                success, message = user_manager.set_user_spreadsheet(user_id, current_spreadsheet_id, sheet_name)
+                if not success:
+                    reply = f"❌ シート変更エラー: {message}\n\n"
+                    reply += "スプレッドシートの登録からやり直してください。"
+                    send_text_message(event.reply_token, reply)
+                    return
             
-            if success:
-                checkout_url = result['checkout_url']
-                plan_info = result['plan_info']
-                
-                reply = f"💳 {plan_info['name']}の決済\n\n"
-                reply += f"料金: {plan_info['price']}円\n"
-                reply += f"内容: {plan_info['description']}\n\n"
-                reply += "以下のURLから決済を完了してください：\n"
-                reply += f"{checkout_url}\n\n"
-                reply += "決済完了後、プランが自動的に更新されます。"
-                
-                # 決済情報をセッションに保存
-                user_sessions[user_id] = {
-                    'plan_type': plan_type,
-                    'session_id': result['session_id']
-                }
+            # ユーザーの状態に応じてメッセージを変更
+            if user_state == 'sheet_name_change':
+                reply = f"✅ シート名を変更しました！\n\n"
+                reply += f"📊 スプレッドシートURL:\n"
+                reply += f"https://docs.google.com/spreadsheets/d/{current_spreadsheet_id}\n\n"
+                reply += f"📋 変更前シート: {current_sheet_name}\n"
+                reply += f"📋 変更後シート: {sheet_name}\n\n"
+                reply += "これで商品データが選択したシートに反映されます。"
+                # ユーザーの状態をリセット
+                set_user_state(user_id, '')
             else:
-                reply = f"決済URLの作成に失敗しました: {result}"
-                print(f"Payment URL creation failed: {result}")
+                reply = f"✅ Googleスプレッドシートのシートを変更しました！\n\n"
+                reply += f"📊 スプレッドシートURL:\n"
+                reply += f"https://docs.google.com/spreadsheets/d/{current_spreadsheet_id}\n\n"
+                reply += f"📋 変更前シート: {current_sheet_name}\n"
+                reply += f"📋 変更後シート: {sheet_name}\n\n"
+                reply += "これで商品データが選択したシートに反映されます。"
         else:
-            reply = "申し訳ございません。決済システムが利用できません。"
-            print(f"Payment system not available: stripe_payment={stripe_payment}, user_manager={user_manager}")
-        
+            reply = "❌ スプレッドシートが登録されていません。\n\n"
+            reply += "まずスプレッドシートを登録してください。"
         send_text_message(event.reply_token, reply)
+        return
+
+@postback_router.command('select_plan')
+def postback_select_plan(event, user_id, params, profile):
+    """select_plan: プラン選択時の処理"""
+    plan_type = params.get('plan', '')
+    print(f"Plan selection: {plan_type} for user {user_id}")
+    
+    if stripe_payment and user_manager:
+        print("Stripe payment and user manager are available")
+        # Stripeチェックアウトセッションを作成
+        success, result = stripe_payment.create_checkout_session(plan_type, user_id)
+        print(f"Checkout session result: success={success}, result={result}")
+        
+        if success:
+            checkout_url = result['checkout_url']
+            plan_info = result['plan_info']
+            
+            reply = f"💳 {plan_info['name']}の決済\n\n"
+            reply += f"料金: {plan_info['price']}円\n"
+            reply += f"内容: {plan_info['description']}\n\n"
+            reply += "以下のURLから決済を完了してください：\n"
+            reply += f"{checkout_url}\n\n"
+            reply += "決済完了後、プランが自動的に更新されます。"
+            
+            # 決済情報をセッションに保存
+            user_sessions[user_id] = {
+                'plan_type': plan_type,
+                'session_id': result['session_id']
+            }
+        else:
+            reply = f"決済URLの作成に失敗しました: {result}"
+            print(f"Payment URL creation failed: {result}")
+    else:
+        reply = "申し訳ございません。決済システムが利用できません。"
+        print(f"Payment system not available: stripe_payment={stripe_payment}, user_manager={user_manager}")
+    
+    send_text_message(event.reply_token, reply)
+
+@handler.add(PostbackEvent)
+def handle_postback(event):
+    """Postbackイベントの処理（ボタンクリック）"""
+    user_id = event.source.user_id
+    data = event.postback.data
+    print(f"Received postback from {user_id}: {data}")
+    
+    # データをパース
+    params = {}
+    for item in data.split('&'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            params[key] = value
+    
+    action = params.get('action', '')
+    profile = ensure_user_profile(user_id)
+
+    if not postback_router.dispatch(action, event, user_id, params, profile):
+        print(f"未対応のpostback action: {action}")
 
-def send_text_message(reply_token, text):
-    """テキストメッセージを送信"""
+def send_text_message(reply_token, text, path='reply'):
+    """テキストメッセージを送信（pathは送信経路のタグ: reply / processing）"""
+    started = time.monotonic()
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             line_bot_api = MessagingApi(api_client)
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
@@ -1951,14 +2302,67 @@ def send_text_message(reply_token, text):
                     messages=[TextMessage(text=text)]
                 )
             )
-        print(f"Text message sent: {text}")
+        line_api_latency['reply'].record((time.monotonic() - started) * 1000)
+        count_response(path)
+        print(f"Text message sent [{path}]: {text}")
+        return True
+    except Exception as e:
+        count_response('reply_failed')
+        print(f"Error sending text message [{path}]: {e}")
+        return False
+
+def push_text_message(user_id, text):
+    """プッシュAPIでテキストメッセージを送信（返信トークンの期限切れ後の結果通知用）"""
+    started = time.monotonic()
+    try:
+        with shared_api_client() as api_client:
+            line_bot_api = MessagingApi(api_client)
+            line_bot_api.push_message_with_http_info(
+                PushMessageRequest(
+                    to=user_id,
+                    messages=[TextMessage(text=text)]
+                )
+            )
+        line_api_latency['push'].record((time.monotonic() - started) * 1000)
+        count_response('push')
+        print(f"Text message sent [push]: {text}")
+        return True
     except Exception as e:
-        print(f"Error sending text message: {e}")
+        count_response('push_failed')
+        print(f"Error sending push message: {e}")
+        return False
+
+def reply_with_deadline(event, build_reply, label):
+    """build_reply()をREPLY_DEADLINE_SECONDS以内に終えれば返信し、
+    超えた場合は「処理中」を返信して、完了後の結果はプッシュで送る"""
+    def run():
+        try:
+            return build_reply()
+        except Exception as e:
+            print(f"{label}: 処理中にエラーが発生: {e}")
+            traceback.print_exc()
+            return f"❌ 処理中にエラーが発生しました: {e}"
+    
+    started = time.monotonic()
+    future = slow_task_executor.submit(run)
+    user_id = getattr(event.source, 'user_id', None)
+    try:
+        # ユーザーIDがない（プッシュできない）場合は完了まで待つ
+        reply = future.result(timeout=REPLY_DEADLINE_SECONDS if user_id else None)
+    except concurrent.futures.TimeoutError:
+        print(f"{label}: {REPLY_DEADLINE_SECONDS}秒以内に終わらないため、結果はプッシュで送信します")
+        send_text_message(event.reply_token, "⏳ 処理中です。完了したら結果をお送りします。", path='processing')
+        # 同じユーザーの次のイベントが追い越さないよう、完了までこのスレッドで待つ
+        push_text_message(user_id, future.result())
+        print(f"{label}: 完了（{time.monotonic() - started:.1f}秒）")
+        return
+    send_text_message(event.reply_token, reply)
 
-def send_flex_message(reply_token, flex_message):
-    """Flexメッセージを送信"""
+def send_flex_message(reply_token, flex_message, path='reply'):
+    """Flexメッセージを送信（テキストと同じく返信の件数・遅延を記録する）"""
+    started = time.monotonic()
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             line_bot_api = MessagingApi(api_client)
             line_bot_api.reply_message_with_http_info(
                 ReplyMessageRequest(
@@ -1966,9 +2370,14 @@ def send_flex_message(reply_token, flex_message):
                     messages=[flex_message]
                 )
             )
-        print(f"Flex message sent")
+        line_api_latency['reply'].record((time.monotonic() - started) * 1000)
+        count_response(path)
+        print(f"Flex message sent [{path}]")
+        return True
     except Exception as e:
-        print(f"Error sending flex message: {e}")
+        count_response('reply_failed')
+        print(f"Error sending flex message [{path}]: {e}")
+        return False
 
 @app.route("/payment/success", methods=['GET'])
 def payment_success():
@@ -2098,33 +2507,22 @@ def is_excel_online_url(url):
     """URLがMicrosoft Excel Onlineのものかどうかを判定"""
     return 'office.com' in url or 'sharepoint.com' in url or 'onedrive.com' in url
 
-def reset_spreadsheet_data(user_id):
+def reset_spreadsheet_data(user_id, profile=None):
     """スプレッドシートの商品データをリセット（会社名と日付以外を白紙に戻す）"""
     try:
         print(f"リセット処理開始: user_id={user_id}")
         
         # まずExcel Online設定をチェック
-        excel_online_enabled = False
-        excel_url = None
-        excel_file_id = None
-        excel_sheet_name = None
-        
-        if user_id and user_manager and excel_online_manager:
-            excel_url, excel_file_id, excel_sheet_name = user_manager.get_user_excel_online(user_id)
-            print(f"Excel Online設定確認: url={excel_url}, file_id={excel_file_id}, sheet_name={excel_sheet_name}")
-            if excel_url and excel_file_id:
-                excel_online_enabled = True
-                print(f"Excel Online設定を検出: {excel_url}")
-                print(f"シート名: {excel_sheet_name}")
+        excel_file_id, excel_sheet_name = get_excel_online_target(user_id, profile)
         
         # Excel Onlineが有効な場合はExcel Onlineをリセット
-        if excel_online_enabled:
-            print(f"Excel Onlineリセット処理を実行します")
+        if excel_file_id:
+            print(f"Excel Onlineリセット処理を実行します（シート名: {excel_sheet_name}）")
             return reset_excel_online_data(excel_file_id, excel_sheet_name, user_id)
         
         # 従来のGoogle Sheets処理
         print(f"Google Sheetsリセット処理を実行します")
-        return reset_google_sheets_data(user_id)
+        return reset_google_sheets_data(user_id, profile)
         
     except Exception as e:
         print(f"リセット処理エラー: {e}")
@@ -2198,12 +2596,11 @@ def reset_excel_online_data(file_id, sheet_name, user_id=None):
             # その他のシート（デフォルト範囲）
             clear_ranges = ['A19:G36']
         
-        # 各範囲を個別にクリア（より確実な方法）
-        for clear_range in clear_ranges:
-            success, error = excel_online_manager.clear_range(file_id, sheet_name, clear_range)
-            if not success:
-                return False, f"範囲 {clear_range} のクリアに失敗: {error}"
-            print(f"範囲 {clear_range} をクリアしました")
+        # 全範囲をまとめて、最小限の矩形ごとにクリア
+        success, error = excel_online_manager.clear_ranges(file_id, sheet_name, clear_ranges)
+        if not success:
+            return False, f"範囲 {', '.join(clear_ranges)} のクリアに失敗: {error}"
+        print(f"範囲 {clear_ranges} をクリアしました")
         
         return True, f"Excel Onlineの商品データをリセットしました（{len(clear_ranges)}個の範囲）"
         
@@ -2211,25 +2608,16 @@ def reset_excel_online_data(file_id, sheet_name, user_id=None):
         print(f"Excel Onlineリセットエラー: {e}")
         return False, f"Excel Onlineリセットエラー: {e}"
 
-def reset_google_sheets_data(user_id=None):
+def reset_google_sheets_data(user_id=None, profile=None):
     """Google Sheetsの商品データをリセット"""
+    spreadsheet_id = sheet_name = None
     try:
         print(f"開始: Google Sheetsリセット処理")
         print(f"user_id: {user_id}")
         
         # 顧客のスプレッドシートIDを取得
-        if user_id and user_manager:
-            spreadsheet_id, sheet_name = user_manager.get_user_spreadsheet(user_id)
-            print(f"ユーザー管理システムから取得: spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
-            if not spreadsheet_id:
-                # ユーザーがスプレッドシートを登録していない場合は共有スプレッドシートを使用
-                spreadsheet_id = SHARED_SPREADSHEET_ID
-                sheet_name = DEFAULT_SHEET_NAME
-                print(f"ユーザーがスプレッドシートを登録していないため、共有スプレッドシートを使用: {spreadsheet_id}")
-        else:
-            spreadsheet_id = SHARED_SPREADSHEET_ID
-            sheet_name = DEFAULT_SHEET_NAME
-            print(f"デフォルト値を使用: spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
+        spreadsheet_id, sheet_name = get_google_sheets_target(user_id, profile)
+        print(f"書き込み先: spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
         
         # テスト用: 強制的に新規見積書　ショートに設定（コメントアウト）
         # sheet_name = "新規見積書　ショート"
@@ -2241,21 +2629,19 @@ def reset_google_sheets_data(user_id=None):
         if not client:
             return False, "Google Sheetsクライアントの設定に失敗しました"
         
-        # スプレッドシートを開く
+        # 利用可能なシート名を確認（スプレッドシートのハンドルとシート名一覧はキャッシュを利用）
         print(f"スプレッドシートを開こうとしています: {spreadsheet_id}")
-        spreadsheet = client.open_by_key(spreadsheet_id)
-        print(f"スプレッドシートを開きました: {spreadsheet.title}")
-        
-        # 利用可能なシート名を確認
-        available_sheets = [ws.title for ws in spreadsheet.worksheets()]
+        available_sheets = sheet_handle_cache.get_sheet_titles(client, spreadsheet_id)
         print(f"利用可能なシート: {available_sheets}")
         
         # 指定されたシート名が存在するか確認
         if sheet_name not in available_sheets:
             print(f"エラー: シート '{sheet_name}' が見つかりません")
+            # シートが追加された直後の可能性があるため、次回は一覧を取り直す
+            sheet_handle_cache.invalidate(spreadsheet_id)
             return False, f"シート '{sheet_name}' が見つかりません。利用可能なシート: {', '.join(available_sheets)}"
         
-        worksheet = spreadsheet.worksheet(sheet_name)
+        worksheet = sheet_handle_cache.get_worksheet(client, spreadsheet_id, sheet_name)
         print(f"ワークシートを開きました: {worksheet.title}")
         
         # シート名に応じてリセット範囲を決定
@@ -2324,10 +2710,15 @@ def reset_google_sheets_data(user_id=None):
         
         print(f"クリア処理完了: {len(clear_ranges)}個の範囲をクリアしました: {clear_ranges}")
         
+        # 書き込み行のカーソルも先頭に戻す
+        row_cursor_cache.reset(spreadsheet_id, sheet_name)
+        
         return True, f"Google Sheetsの商品データをリセットしました（{len(clear_ranges)}個の範囲）"
         
     except Exception as e:
         print(f"Google Sheetsリセットエラー: {e}")
+        if spreadsheet_id:
+            sheet_handle_cache.handle_api_error(e, spreadsheet_id, sheet_name)
         return False, f"Google Sheetsリセットエラー: {e}"
 
 @app.route("/test-reset", methods=['GET'])
@@ -2638,7 +3029,7 @@ def test_rich_menu():
         # 設定オブジェクトを確認
         print(f"Configuration access_token: {configuration.access_token[:20]}...")
         
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 既存のリッチメニューを取得
@@ -2683,7 +3074,7 @@ def test_rich_menu():
 def test_simple_rich_menu():
     """シンプルなリッチメニュー作成のテスト"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # 最もシンプルなリッチメニュー
@@ -2716,7 +3107,7 @@ def test_simple_rich_menu():
 def test_correct_rich_menu():
     """正しい形式のリッチメニュー作成テスト"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # LINE Botの仕様に従った正しい形式
@@ -2753,7 +3144,7 @@ def test_correct_rich_menu():
 def test_v3_rich_menu():
     """LINE Bot SDK v3の正しい形式でリッチメニュー作成テスト"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # LINE Bot SDK v3の正しい形式
@@ -2791,7 +3182,7 @@ def test_v3_rich_menu():
 def test_official_rich_menu():
     """LINE Bot公式ドキュメントに従ったリッチメニュー作成テスト"""
     try:
-        with ApiClient(configuration) as api_client:
+        with shared_api_client() as api_client:
             messaging_api = MessagingApi(api_client)
             
             # LINE Bot公式ドキュメントに従った形式
@@ -0,0 +1,100 @@
+import re
+import threading
+import time
+
+from metrics import LatencyRecorder
+
+
+class CommandRouter:
+    """コマンド文字列からハンドラを引くルーティングテーブル
+
+    完全一致のコマンドは辞書で1回引くだけで決まる。パターン付きのコマンドは
+    登録順（従来のif/elifの順）に優先し、どのパターンにも一致しないテキストは
+    全パターンをまとめた1本の正規表現で1回だけ検索して素早く除外する。
+    ハンドラはデコレータで登録し、ルートごとの処理時間を記録する。
+    """
+
+    def __init__(self, name='command'):
+        self.name = name
+        self._exact = {}      # コマンド文字列 -> (ルート名, ハンドラ)
+        self._patterns = []   # (ルート名, コンパイル済みパターン, ハンドラ)
+        self._any_pattern = None  # 全パターンの選択（一致なしの判定用）
+        self._lock = threading.Lock()
+        self.latency = {}     # ルート名 -> LatencyRecorder
+        self.stats = {
+            'dispatched': 0,
+            'unmatched': 0,
+            'errors': 0
+        }
+
+    def command(self, *texts):
+        """完全一致で呼び出すハンドラを登録するデコレータ"""
+        def decorator(handler):
+            for text in texts:
+                if text in self._exact:
+                    raise ValueError(f"コマンドが重複しています: {text}")
+                self._exact[text] = (handler.__name__, handler)
+            self.latency.setdefault(handler.__name__, LatencyRecorder())
+            return handler
+        return decorator
+
+    def pattern(self, *patterns):
+        """正規表現に一致したときに呼び出すハンドラを登録するデコレータ
+
+        テキスト内のどこかに一致すればよい（re.search）。複数のパターンに
+        一致する場合は先に登録したものを優先する。
+        """
+        def decorator(handler):
+            for pattern in patterns:
+                self._patterns.append((handler.__name__, re.compile(pattern), handler))
+            self._any_pattern = re.compile('|'.join(
+                f"(?:{compiled.pattern})" for _, compiled, _ in self._patterns
+            ))
+            self.latency.setdefault(handler.__name__, LatencyRecorder())
+            return handler
+        return decorator
+
+    def match(self, text):
+        """テキストに対応する(ルート名, ハンドラ)を取得（該当なしの場合はNone）"""
+        route = self._exact.get(text)
+        if route is not None:
+            return route
+        if self._any_pattern is None or not self._any_pattern.search(text):
+            return None
+        for name, compiled, handler in self._patterns:
+            if compiled.search(text):
+                return name, handler
+        return None
+
+    def dispatch(self, text, *args, **kwargs):
+        """一致したハンドラを実行（ハンドラを実行した場合はTrue）"""
+        route = self.match(text)
+        if route is None:
+            with self._lock:
+                self.stats['unmatched'] += 1
+            return False
+
+        name, handler = route
+        started = time.monotonic()
+        try:
+            handler(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            self.latency[name].record((time.monotonic() - started) * 1000)
+            with self._lock:
+                self.stats['dispatched'] += 1
+        return True
+
+    def get_stats(self):
+        """ルートごとの処理時間と件数の統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['routes'] = {
+            name: recorder.snapshot()
+            for name, recorder in self.latency.items()
+            if recorder.count
+        }
+        return stats
@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SQLiteConnectionManager:
+    def __init__(self, db_path, busy_timeout_ms=5000, cached_statements=128):
+        """スレッドごとにSQLite接続を使い回すクラス
+
+        接続はスレッド内で再利用し、WALモード・synchronous=NORMAL・busy_timeoutを
+        設定する。同じSQL文はcached_statementsの範囲でプリペアドステートメントが
+        再利用される。
+        """
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  # thread ident -> connection
+        self.stats = {
+            'opened': 0,
+            'closed': 0
+        }
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=False  # close()を別スレッドから呼ぶため
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        return conn
+
+    def connection(self):
+        """現在のスレッドの接続を取得（なければ作成）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._close_dead_threads()
+                # 終了したスレッドと同じidentが再利用された場合は古い接続を閉じる
+                stale = self._connections.pop(threading.get_ident(), None)
+                if stale is not None:
+                    stale.close()
+                    self.stats['closed'] += 1
+                self._connections[threading.get_ident()] = conn
+                self.stats['opened'] += 1
+        return conn
+
+    def _close_dead_threads(self):
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [i for i in self._connections if i not in alive]:
+            try:
+                self._connections.pop(ident).close()
+            except Exception as e:
+                print(f"SQLite接続のクローズに失敗: {e}")
+            self.stats['closed'] += 1
+
+    def execute(self, sql, params=()):
+        """読み取り用のクエリを実行してカーソルを返す"""
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """書き込み用のトランザクション（正常終了でcommit、例外でrollback）"""
+        conn = self.connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close(self):
+        """すべてのスレッドの接続を閉じる（プロセス終了時など）"""
+        with self._lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except Exception as e:
+                    print(f"SQLite接続のクローズに失敗: {e}")
+                self.stats['closed'] += 1
+            self._connections.clear()
+        self._local = threading.local()
+
+    def get_stats(self):
+        """接続数の統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['open'] = len(self._connections)
+            return stats
@@ -0,0 +1,171 @@
+import queue
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import Future
+
+from metrics import LatencyRecorder
+
+
+class BoundedExecutor:
+    """上限付きキューを持つワーカースレッドプール
+
+    submit()は受け付けたタスクのFutureを返す。キューが満杯のときはNoneを返すので、
+    呼び出し側で同期処理に切り替えるなどのバックプレッシャー制御ができる。
+    """
+
+    def __init__(self, max_workers=4, queue_size=100, name='worker'):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.name = name
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._busy = 0
+        self.wait_latency = LatencyRecorder()
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'max_queue_depth': 0
+        }
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def shutting_down(self):
+        """shutdown()が呼ばれて新規のタスクを受け付けない状態か"""
+        return self._shutdown
+
+    def submit(self, fn, *args, **kwargs):
+        """タスクをキューに追加してFutureを返す（満杯または停止済みの場合はNone）"""
+        return self._enqueue(fn, args, kwargs, block=False)
+
+    def submit_wait(self, fn, *args, **kwargs):
+        """キューに空きができるまで待ってタスクを追加し、Futureを返す（停止済みの場合はNone）"""
+        return self._enqueue(fn, args, kwargs, block=True)
+
+    def _enqueue(self, fn, args, kwargs, block):
+        if self._shutdown:
+            return None
+        future = Future()
+        try:
+            self._queue.put((future, fn, args, kwargs, time.monotonic()), block=block)
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            return None
+        with self._lock:
+            self.stats['submitted'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+        return future
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            future, fn, args, kwargs, enqueued_at = item
+            self.wait_latency.record((time.monotonic() - enqueued_at) * 1000)
+            with self._lock:
+                self._busy += 1
+            succeeded = False
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args, **kwargs))
+                succeeded = True
+            except Exception as e:
+                print(f"{self.name}: タスク実行エラー: {e}")
+                traceback.print_exc()
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self.stats['completed' if succeeded else 'failed'] += 1
+                self._queue.task_done()
+
+    def shutdown(self, wait=True, timeout=10):
+        """新規受付を止め、キューに残ったタスクを処理してからワーカーを終了"""
+        if self._shutdown:
+            return
+        self._shutdown = True
+        for _ in self._threads:
+            # 停止用の番兵はキューの空きを待って入れる
+            self._queue.put(None)
+        if wait:
+            deadline = time.monotonic() + timeout
+            for thread in self._threads:
+                thread.join(max(0, deadline - time.monotonic()))
+
+    def get_stats(self):
+        """キュー長・待ち時間などの統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['busy_workers'] = self._busy
+        stats['queue_depth'] = self._queue.qsize()
+        stats['queue_size'] = self.queue_size
+        stats['max_workers'] = self.max_workers
+        stats['wait'] = self.wait_latency.snapshot()
+        return stats
+
+
+class KeyedExecutor:
+    """キーごとに実行順序を保つワーカープール
+
+    キー（ユーザーIDなど）のハッシュでシャードを決め、各シャードは1スレッドで
+    FIFO順に処理する。同じキーのタスクは直列に、異なるキーのタスクは別シャードで
+    並列に実行される。
+    """
+
+    def __init__(self, shards=4, queue_size=100, name='keyed'):
+        self.name = name
+        self._shards = [
+            BoundedExecutor(max_workers=1, queue_size=queue_size, name=f"{name}-{i}")
+            for i in range(shards)
+        ]
+
+    def _shard_for(self, key):
+        # hash()はプロセスごとに変わるのでcrc32で安定して振り分ける
+        return self._shards[zlib.crc32(str(key).encode('utf-8')) % len(self._shards)]
+
+    @property
+    def shutting_down(self):
+        """shutdown()が呼ばれて新規のタスクを受け付けない状態か"""
+        return any(shard.shutting_down for shard in self._shards)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """キーに対応するシャードにタスクを追加してFutureを返す（満杯・停止済みの場合はNone）"""
+        return self._shard_for(key).submit(fn, *args, **kwargs)
+
+    def submit_wait(self, key, fn, *args, **kwargs):
+        """シャードのキューに空きができるまで待ってタスクを追加し、Futureを返す（停止済みの場合はNone）"""
+        return self._shard_for(key).submit_wait(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, timeout=10):
+        for shard in self._shards:
+            shard.shutdown(wait=False)
+        if wait:
+            deadline = time.monotonic() + timeout
+            for shard in self._shards:
+                for thread in shard._threads:
+                    thread.join(max(0, deadline - time.monotonic()))
+
+    def get_stats(self):
+        """全シャードの合計とシャードごとのキュー長・待ち時間を取得"""
+        shard_stats = [shard.get_stats() for shard in self._shards]
+        total = {
+            name: sum(s[name] for s in shard_stats)
+            for name in ('submitted', 'completed', 'failed', 'rejected', 'queue_depth', 'busy_workers')
+        }
+        total['shards'] = len(self._shards)
+        total['max_queue_depth'] = max(s['max_queue_depth'] for s in shard_stats)
+        total['max_wait_ms'] = max(s['wait']['max_ms'] for s in shard_stats)
+        total['queue_depth_by_shard'] = [s['queue_depth'] for s in shard_stats]
+        total['wait_p95_ms_by_shard'] = [s['wait']['p95_ms'] for s in shard_stats]
+        return total
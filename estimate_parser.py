@@ -0,0 +1,204 @@
+import re
+import unicodedata
+
+
+# 見積データとして読み取る項目（長い項目名を先に並べる: 会社名 → 社名）
+COMPANY_FIELDS = ('会社名', '社名', '日付')
+PRODUCT_FIELDS = ('商品名', 'サイズ', '単価', '数量', 'サイクル', '設置場所')
+NUMERIC_FIELDS = ('単価', '数量')
+_ESTIMATE_KEYS = '|'.join(COMPANY_FIELDS + PRODUCT_FIELDS)
+
+# 「項目:値」（全角・半角コロン、先頭の「・」可、1行に複数可）と空行を1回の走査で切り出す
+ESTIMATE_TOKEN_PATTERN = re.compile(
+    rf'(?P<blank>\n[ \t　]*(?=\n))'
+    rf'|(?:^|(?<=[\s・･]))[・･]?[ \t　]*(?P<key>{_ESTIMATE_KEYS})[ \t　]*[:：][ \t　]*'
+    rf'(?P<value>[^\n]*?)[ \t　]*(?=[ \t　]+[・･]?(?:{_ESTIMATE_KEYS})[ \t　]*[:：]|\n|$)',
+    re.MULTILINE
+)
+PRODUCT_TYPE_SUFFIX_PATTERN = re.compile(r"^(.*?)[\s　]*(現状|当社)$")
+NON_DIGIT_PATTERN = re.compile(r'[^0-9]')
+
+
+def split_product_type(product_name):
+    """商品名から「現状」「当社」の語尾を除き、(商品名, 商品タイプ)を返す"""
+    m = PRODUCT_TYPE_SUFFIX_PATTERN.match(product_name)
+    if m:
+        return m.group(1), m.group(2)
+    return product_name, 'default'
+
+
+def normalize_estimate_record(record):
+    """1件分の項目を正規化（社名の統一・商品タイプの分離・料金の計算）"""
+    if '会社名' in record and '社名' not in record:
+        record['社名'] = record['会社名']
+    if '商品名' in record:
+        record['商品名'], record['商品タイプ'] = split_product_type(record['商品名'])
+    if '単価' in record and '数量' in record:
+        try:
+            unit_price = int(NON_DIGIT_PATTERN.sub('', record['単価']))
+            quantity = int(NON_DIGIT_PATTERN.sub('', record['数量']))
+            record['料金'] = unit_price * quantity
+        except ValueError:
+            record['料金'] = 0
+    return record
+
+
+def parse_estimate_records(text):
+    """メッセージから見積データを読み取り、商品ごとのレコードのリストを返す
+
+    空行、または同じ商品項目がもう一度出てきたところで次の商品に切り替える。
+    社名・日付はメッセージ全体の項目として各レコードに付ける。
+    単価・数量は全角数字・全角カンマを半角に揃える（NFKC）。
+    """
+    common = {}
+    records = []
+    current = {}
+    for m in ESTIMATE_TOKEN_PATTERN.finditer(text.replace('\r', '')):
+        if m.group('blank') is not None:
+            if current:
+                records.append(current)
+                current = {}
+            continue
+        key, value = m.group('key'), m.group('value')
+        if not value:
+            continue
+        if key in COMPANY_FIELDS:
+            common[key] = value
+            continue
+        if key in current:
+            records.append(current)
+            current = {}
+        if key in NUMERIC_FIELDS:
+            value = unicodedata.normalize('NFKC', value)
+        current[key] = value
+    if current:
+        records.append(current)
+
+    if not records:
+        records = [{}] if common else []
+    records = [normalize_estimate_record(dict(common, **record)) for record in records]
+    print(f"parse_estimate_records: {records}")
+    return records
+
+
+def parse_estimate_data(text):
+    """見積データを読み取り、最初の1件を辞書で返す（該当なしの場合は空の辞書）"""
+    records = parse_estimate_records(text)
+    return records[0] if records else {}
+
+
+REQUIRED_PRODUCT_FIELDS = ('商品名', '単価', '数量')
+
+
+def is_product_record(data):
+    """商品の書き込みに必要な項目（商品名・単価・数量）が揃っているか"""
+    return all(key in data for key in REQUIRED_PRODUCT_FIELDS)
+
+
+def has_product_fields(data):
+    """商品の項目（商品名・単価など）が1つでも含まれているか"""
+    return any(key in data for key in PRODUCT_FIELDS)
+
+
+def find_incomplete_products(records):
+    """必要な項目が欠けている商品を「{n}件目（単価がありません）」の形式で列挙する"""
+    errors = []
+    for i, record in enumerate(records, 1):
+        missing = [key for key in REQUIRED_PRODUCT_FIELDS if key not in record]
+        if missing:
+            errors.append(f"{i}件目（{'・'.join(missing)}がありません）")
+    return errors
+
+
+# 一括登録のコマンド（1行目の残りも商品の入力として扱う）
+BULK_COMMAND_PATTERN = re.compile(r'^一括(?:登録|追加)[ \t　]*[:：]?')
+# 一括登録のCSV形式の列（タブ・読点を含む行はそれで、それ以外はカンマで区切る）
+BULK_COLUMNS = ('商品名', '単価', '数量', 'サイクル', '設置場所')
+BULK_SEPARATOR_PATTERN = re.compile(r'[,，]')
+# 数字の間の「,」のうち3桁区切りになりうるもの（1,200など）
+THOUSANDS_SEPARATOR_PATTERN = re.compile(r'(?<=\d)[,，](?=\d{3}(?!\d))')
+# 単価・数量として受け付ける値（NFKC後、例: 1200 / 1,200円 / ¥1,200 / 3個）
+NUMERIC_VALUE_PATTERN = re.compile(r'^¥?[0-9][0-9,]*[^0-9,]*$')
+
+
+def is_numeric_value(value):
+    """単価・数量の値が数値として読み取れるか"""
+    return bool(NUMERIC_VALUE_PATTERN.match(unicodedata.normalize('NFKC', value).strip()))
+
+
+def check_bulk_record(record):
+    """一括登録の1件を検査し、問題があれば理由を返す（問題なしの場合はNone）"""
+    for key in REQUIRED_PRODUCT_FIELDS:
+        if key not in record:
+            return f"{key}がありません"
+    for key in NUMERIC_FIELDS:
+        if not is_numeric_value(record[key]):
+            return f"{key}「{record[key]}」が数値ではありません"
+    return None
+
+
+def read_bulk_fields(fields):
+    """区切った列を一括登録の1件として読み取り、(レコード, 問題)を返す（問題なしの場合はNone）"""
+    fields = [field.strip() for field in fields]
+    record = {key: value for key, value in zip(BULK_COLUMNS, fields) if value}
+    problem = check_bulk_record(record)
+    if problem is None and len(fields) > len(BULK_COLUMNS):
+        problem = "列が多すぎます"
+    return record, problem
+
+
+def parse_bulk_records(text):
+    """一括登録のメッセージ（先頭は「一括登録」コマンド）から商品レコードを読み取る
+
+    「商品名:…」形式のブロックはparse_estimate_records()で、それ以外は
+    1行1商品の「商品名,単価,数量[,サイクル][,設置場所]」として読み取る。
+    スプレッドシートからコピーしたタブ区切りの行、「、」区切りの行もそのまま受け付ける。
+    カンマ区切りの行はまず区切り文字どおりに読み、読み取れない場合だけ1,200のような
+    3桁区切りを数値の一部として読み直す。どちらでも読み取れる行は曖昧なので受け付けない。
+    戻り値は(レコードのリスト, 読み取れなかった行とその理由のリスト)。
+    """
+    body = BULK_COMMAND_PATTERN.sub('', text.replace('\r', '').lstrip(), count=1)
+    if any(m.group('key') for m in ESTIMATE_TOKEN_PATTERN.finditer(body)):
+        records = parse_estimate_records(body)
+        errors = []
+        for i, record in enumerate(records, 1):
+            problem = check_bulk_record(record)
+            if problem:
+                errors.append(f"{i}件目（{problem}）")
+        return [record for record in records if not check_bulk_record(record)], errors
+
+    records = []
+    errors = []
+    for line_number, line in enumerate(body.split('\n'), 1):  # メッセージ全体での行番号
+        line = line.strip().lstrip('・･').strip()
+        if not line:
+            continue
+        if '\t' in line:
+            fields = line.split('\t')
+        elif '、' in line:
+            # 読点区切りの行ではカンマは3桁区切りとして値に残す
+            fields = line.split('、')
+        else:
+            fields = BULK_SEPARATOR_PATTERN.split(line)
+        if fields[0].strip() == '商品名':
+            # 見出し行
+            continue
+        record, problem = read_bulk_fields(fields)
+        if '\t' not in line and '、' not in line and THOUSANDS_SEPARATOR_PATTERN.search(line):
+            merged_record, merged_problem = read_bulk_fields(
+                BULK_SEPARATOR_PATTERN.split(THOUSANDS_SEPARATOR_PATTERN.sub('', line))
+            )
+            if problem is None and merged_problem is None:
+                problem = "3桁区切りか列の区切りか判別できません。タブか「、」で区切ってください"
+            elif problem is not None and merged_problem is None:
+                record, problem = merged_record, None
+            elif problem is not None:
+                problem += "。3桁区切りと紛らわしい場合はタブか「、」で区切ってください"
+        if problem:
+            errors.append(f"{line_number}行目「{line}」（{problem}）")
+            continue
+        for key in NUMERIC_FIELDS:
+            record[key] = unicodedata.normalize('NFKC', record[key])
+        records.append(normalize_estimate_record(record))
+    print(f"parse_bulk_records: {len(records)}件, エラー行: {errors}")
+    return records, errors
@@ -1,37 +1,216 @@
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import msal
+import threading
+import time
 from datetime import datetime
 import re
+import urllib.parse
+from sheet_columns import col_to_num, num_to_col
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_BATCH_URL = f"{GRAPH_BASE_URL}/$batch"
+# Graph APIの$batchに含められるリクエストの上限
+GRAPH_BATCH_LIMIT = 20
+
+def parse_range_address(range_address):
+    """'A19:B36'や'B23'を(開始列番号, 開始行, 終了列番号, 終了行)に変換（不正な形式はNone）"""
+    match = re.match(r'^([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$', range_address)
+    if not match:
+        return None
+    start_col, start_row = col_to_num(match.group(1)), int(match.group(2))
+    if match.group(3):
+        end_col, end_row = col_to_num(match.group(3)), int(match.group(4))
+    else:
+        end_col, end_row = start_col, start_row
+    return start_col, start_row, end_col, end_row
+
+def compute_clear_rectangles(range_addresses, protected_ranges=()):
+    """クリア対象のセルを、保護セルを除いた最小限の矩形範囲の一覧にまとめる
+    
+    列ごとに連続する行をまとめ、同じ行の区切りを持つ隣り合った列を1つの矩形にする。
+    例: ['A19:B36', 'C19:C36', 'D19:D36'] -> ['A19:D36']
+    """
+    cells = set()
+    for address in range_addresses:
+        bounds = parse_range_address(address)
+        if not bounds:
+            raise ValueError(f"無効な範囲形式です: {address}")
+        start_col, start_row, end_col, end_row = bounds
+        for col in range(start_col, end_col + 1):
+            for row in range(start_row, end_row + 1):
+                cells.add((col, row))
+    for address in protected_ranges:
+        bounds = parse_range_address(address)
+        if not bounds:
+            raise ValueError(f"無効な範囲形式です: {address}")
+        start_col, start_row, end_col, end_row = bounds
+        for col in range(start_col, end_col + 1):
+            for row in range(start_row, end_row + 1):
+                cells.discard((col, row))
+    
+    # 列ごとに連続する行の区間を求める
+    column_runs = {}
+    for col in sorted({col for col, _ in cells}):
+        rows = sorted(row for c, row in cells if c == col)
+        runs = []
+        for row in rows:
+            if runs and runs[-1][1] == row - 1:
+                runs[-1][1] = row
+            else:
+                runs.append([row, row])
+        column_runs[col] = tuple(tuple(run) for run in runs)
+    
+    # 同じ区間を持つ隣り合った列をまとめる
+    rectangles = []
+    group_start = group_end = None
+    for col in sorted(column_runs):
+        if group_start is not None and col == group_end + 1 and column_runs[col] == column_runs[group_start]:
+            group_end = col
+            continue
+        if group_start is not None:
+            rectangles.extend(_format_rectangles(group_start, group_end, column_runs[group_start]))
+        group_start = group_end = col
+    if group_start is not None:
+        rectangles.extend(_format_rectangles(group_start, group_end, column_runs[group_start]))
+    return rectangles
+
+def _format_rectangles(start_col, end_col, runs):
+    return [f"{num_to_col(start_col)}{start_row}:{num_to_col(end_col)}{end_row}" for start_row, end_row in runs]
+
+def is_session_error(response):
+    """ワークブックセッションの期限切れ・無効を示すレスポンスかどうかを判定"""
+    if response.status_code not in (400, 404, 409, 410):
+        return False
+    try:
+        code = response.json().get('error', {}).get('code', '')
+    except ValueError:
+        return False
+    return 'session' in code.lower()
 
 class ExcelOnlineManager:
-    def __init__(self):
-        """Microsoft Excel Onlineとの連携を管理するクラス"""
+    def __init__(self, pool_size=None):
+        """Microsoft Excel Onlineとの連携を管理するクラス
+
+        pool_sizeはGraph APIの接続プールのサイズ（省略時はGRAPH_POOL_SIZE、
+        なければgunicornのスレッド数GUNICORN_THREADS）。
+        """
         self.client_id = os.environ.get('MS_CLIENT_ID')
         self.client_secret = os.environ.get('MS_CLIENT_SECRET')
         self.tenant_id = os.environ.get('MS_TENANT_ID')
         self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
         self.scope = ["https://graph.microsoft.com/.default"]
+        # 有効期限のこの秒数前になったらトークンを取り直す
+        self.token_refresh_margin = int(os.environ.get('MS_TOKEN_REFRESH_MARGIN', 300))
+        
+        # MSALアプリケーションとトークンはプロセス内で共有
+        self._token_lock = threading.Lock()
+        self._token_cache = msal.TokenCache()
+        self._msal_app = None
+        self._access_token = None
+        self._token_expires_at = 0
+        self.token_stats = {
+            'fetches': 0,
+            'reuses': 0,
+            'errors': 0
+        }
+        # ワークブックセッション（persistChanges）をfile_idごとに再利用
+        self.use_workbook_session = os.environ.get('GRAPH_WORKBOOK_SESSION', '1') == '1'
+        self.session_refresh_seconds = int(os.environ.get('GRAPH_SESSION_REFRESH_SECONDS', 150))
+        self.session_idle_seconds = int(os.environ.get('GRAPH_SESSION_IDLE_SECONDS', 270))
+        self._session_lock = threading.Lock()
+        self._workbook_sessions = {}  # file_id -> {'id': str, 'last_used': float}
+        self._session_file_locks = {}  # file_id -> Lock（作成・延長の通信中は同じファイルだけを待たせる）
+        self.session_stats = {
+            'created': 0,
+            'reused': 0,
+            'refreshed': 0,
+            'expired': 0,
+            'invalidated': 0,
+            'errors': 0
+        }
+        self._batch_lock = threading.Lock()  # batch_stats用（トークン取得とは別のロック）
+        self.batch_stats = {
+            'batches': 0,
+            'operations': 0,
+            'failed_operations': 0
+        }
+        # Graph APIへの接続はプールして再利用（429/503はRetry-Afterに従って再試行）
+        self.request_timeout = int(os.environ.get('GRAPH_REQUEST_TIMEOUT', 30))
+        if pool_size is None:
+            pool_size = int(os.environ.get('GRAPH_POOL_SIZE', os.environ.get('GUNICORN_THREADS', 8)))
+        self.session = self._create_session(pool_size)
         
-    def get_access_token(self):
-        """Microsoft Graph APIのアクセストークンを取得"""
         try:
-            app = msal.ConfidentialClientApplication(
-                self.client_id,
-                authority=self.authority,
-                client_credential=self.client_secret
-            )
-            
-            result = app.acquire_token_for_client(scopes=self.scope)
-            if "access_token" in result:
-                return result["access_token"]
-            else:
-                print(f"トークン取得エラー: {result.get('error_description', 'Unknown error')}")
-                return None
+            self._msal_app = self._create_msal_app()
         except Exception as e:
-            print(f"アクセストークン取得エラー: {e}")
-            return None
+            # 起動時に作成できなくても、初回のトークン取得時に再試行する
+            print(f"MSALアプリケーション作成エラー: {e}")
+    
+    def _create_session(self, pool_size):
+        """keep-aliveと再試行ポリシーを設定したrequests.Sessionを作成"""
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 503, 504),
+            # POST（createSession・$batchなど）は冪等でないため自動では再試行しない
+            allowed_methods=frozenset(['GET', 'PATCH']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        return session
+    
+    def _create_msal_app(self):
+        return msal.ConfidentialClientApplication(
+            self.client_id,
+            authority=self.authority,
+            client_credential=self.client_secret,
+            token_cache=self._token_cache
+        )
+        
+    def get_access_token(self):
+        """Microsoft Graph APIのアクセストークンを取得（有効期限の少し前まで再利用）"""
+        with self._token_lock:
+            if self._access_token and time.time() < self._token_expires_at - self.token_refresh_margin:
+                self.token_stats['reuses'] += 1
+                return self._access_token
+            
+            try:
+                if self._msal_app is None:
+                    self._msal_app = self._create_msal_app()
+                
+                result = self._msal_app.acquire_token_for_client(scopes=self.scope)
+                if "access_token" in result:
+                    self.token_stats['fetches'] += 1
+                    self._access_token = result["access_token"]
+                    self._token_expires_at = time.time() + int(result.get('expires_in', 0))
+                    return self._access_token
+                else:
+                    self.token_stats['errors'] += 1
+                    print(f"トークン取得エラー: {result.get('error_description', 'Unknown error')}")
+                    return None
+            except Exception as e:
+                self.token_stats['errors'] += 1
+                print(f"アクセストークン取得エラー: {e}")
+                return None
+    
+    def get_stats(self):
+        """トークン取得・ワークブックセッション・$batch実行の統計情報を取得"""
+        with self._token_lock:
+            stats = {'token': dict(self.token_stats)}
+            stats['token']['expires_in'] = max(0, int(self._token_expires_at - time.time())) if self._access_token else None
+        with self._batch_lock:
+            stats['batch'] = dict(self.batch_stats)
+        with self._session_lock:
+            stats['workbook_session'] = dict(self.session_stats)
+            stats['workbook_session']['active'] = len(self._workbook_sessions)
+        return stats
     
     def extract_file_id_from_url(self, url):
         """SharePoint/OneDrive URLからファイルIDを抽出"""
@@ -55,21 +234,127 @@ class ExcelOnlineManager:
         
         return None
     
+    def _create_workbook_session(self, file_id, access_token):
+        """永続化ありのワークブックセッションを作成（失敗した場合はNone）"""
+        url = f"{GRAPH_BASE_URL}/me/drive/items/{file_id}/workbook/createSession"
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        response = self.session.post(url, headers=headers, json={'persistChanges': True}, timeout=self.request_timeout)
+        if response.status_code in (200, 201):
+            return response.json().get('id')
+        print(f"警告: ワークブックセッションの作成に失敗: {response.status_code} - {response.text}")
+        return None
+    
+    def _refresh_workbook_session(self, file_id, session_id, access_token):
+        """ワークブックセッションの有効期限を延長（成功した場合はTrue）"""
+        url = f"{GRAPH_BASE_URL}/me/drive/items/{file_id}/workbook/refreshSession"
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json',
+            'workbook-session-id': session_id
+        }
+        response = self.session.post(url, headers=headers, timeout=self.request_timeout)
+        return response.status_code in (200, 204)
+    
+    def _get_session_file_lock(self, file_id):
+        """file_idごとのセッション作成用ロックを取得"""
+        with self._session_lock:
+            lock = self._session_file_locks.get(file_id)
+            if lock is None:
+                lock = self._session_file_locks[file_id] = threading.Lock()
+            return lock
+    
+    def get_workbook_session_id(self, file_id, access_token):
+        """file_idごとのワークブックセッションIDを取得（一定時間使われていなければ延長・再作成）
+        
+        createSession・refreshSessionの通信中はそのfile_idのロックだけを保持するので、
+        他のファイルへの要求は待たされない。
+        """
+        with self._get_session_file_lock(file_id):
+            with self._session_lock:
+                cached = self._workbook_sessions.get(file_id)
+                if cached:
+                    idle = time.monotonic() - cached['last_used']
+                    if idle <= self.session_refresh_seconds:
+                        cached['last_used'] = time.monotonic()
+                        self.session_stats['reused'] += 1
+                        return cached['id']
+            
+            if cached and idle <= self.session_idle_seconds:
+                try:
+                    refreshed = self._refresh_workbook_session(file_id, cached['id'], access_token)
+                except Exception as e:
+                    print(f"警告: ワークブックセッションの延長に失敗: {e}")
+                    refreshed = False
+                if refreshed:
+                    with self._session_lock:
+                        cached['last_used'] = time.monotonic()
+                        self._workbook_sessions[file_id] = cached
+                        self.session_stats['refreshed'] += 1
+                    return cached['id']
+            if cached:
+                with self._session_lock:
+                    self.session_stats['expired'] += 1
+                    self._workbook_sessions.pop(file_id, None)
+            
+            try:
+                session_id = self._create_workbook_session(file_id, access_token)
+            except Exception as e:
+                print(f"警告: ワークブックセッションの作成に失敗: {e}")
+                session_id = None
+            with self._session_lock:
+                if not session_id:
+                    # セッションなしでも処理は続行できる
+                    self.session_stats['errors'] += 1
+                    return None
+                self._workbook_sessions[file_id] = {'id': session_id, 'last_used': time.monotonic()}
+                self.session_stats['created'] += 1
+            return session_id
+    
+    def invalidate_workbook_session(self, file_id):
+        """ワークブックセッションを破棄（期限切れ・無効と判定された場合）"""
+        with self._session_lock:
+            if self._workbook_sessions.pop(file_id, None):
+                self.session_stats['invalidated'] += 1
+    
+    def _get_headers(self, file_id=None):
+        """認証ヘッダー（file_idを指定するとワークブックセッションIDも付与）"""
+        access_token = self.get_access_token()
+        if not access_token:
+            return None
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        if file_id and self.use_workbook_session:
+            session_id = self.get_workbook_session_id(file_id, access_token)
+            if session_id:
+                headers['workbook-session-id'] = session_id
+        return headers
+    
+    def _request(self, method, file_id, path, **kwargs):
+        """ワークブックセッション付きでGraph APIを呼び出し（セッションが無効なら1回だけ作り直して再試行）"""
+        for attempt in range(2):
+            headers = self._get_headers(file_id)
+            if headers is None:
+                return None
+            response = self.session.request(method, GRAPH_BASE_URL + path, headers=headers, timeout=self.request_timeout, **kwargs)
+            if 'workbook-session-id' in headers and is_session_error(response):
+                print(f"ワークブックセッションが無効なため作り直します: {response.status_code}")
+                self.invalidate_workbook_session(file_id)
+                continue
+            return response
+        return response
+    
     def get_workbook(self, file_id):
         """Excelファイルの情報を取得"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return None, "アクセストークンの取得に失敗しました"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             # ファイル情報を取得
-            url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook"
-            response = requests.get(url, headers=headers)
+            response = self._request('GET', file_id, f"/me/drive/items/{file_id}/workbook")
+            if response is None:
+                return None, "アクセストークンの取得に失敗しました"
             
             if response.status_code == 200:
                 return response.json(), None
@@ -82,18 +367,10 @@ class ExcelOnlineManager:
     def get_worksheets(self, file_id):
         """Excelファイルのワークシート一覧を取得"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
+            response = self._request('GET', file_id, f"/me/drive/items/{file_id}/workbook/worksheets")
+            if response is None:
                 return None, "アクセストークンの取得に失敗しました"
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets"
-            response = requests.get(url, headers=headers)
-            
             if response.status_code == 200:
                 worksheets = response.json().get('value', [])
                 return [ws['name'] for ws in worksheets], None
@@ -106,23 +383,10 @@ class ExcelOnlineManager:
     def read_range(self, file_id, sheet_name, range_address):
         """指定された範囲のデータを読み取り"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
+            response = self._request('GET', file_id, self._range_path(file_id, sheet_name, range_address))
+            if response is None:
                 return None, "アクセストークンの取得に失敗しました"
             
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # シート名をURLエンコード
-            import urllib.parse
-            encoded_sheet_name = urllib.parse.quote(sheet_name)
-            encoded_range = urllib.parse.quote(range_address)
-            
-            url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_range}')"
-            response = requests.get(url, headers=headers)
-            
             if response.status_code == 200:
                 data = response.json()
                 return data.get('values', []), None
@@ -135,27 +399,13 @@ class ExcelOnlineManager:
     def write_range(self, file_id, sheet_name, range_address, values):
         """指定された範囲にデータを書き込み"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return False, "アクセストークンの取得に失敗しました"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # シート名をURLエンコード
-            import urllib.parse
-            encoded_sheet_name = urllib.parse.quote(sheet_name)
-            encoded_range = urllib.parse.quote(range_address)
-            
-            url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_range}')"
-            
             payload = {
                 "values": values
             }
             
-            response = requests.patch(url, headers=headers, json=payload)
+            response = self._request('PATCH', file_id, self._range_path(file_id, sheet_name, range_address), json=payload)
+            if response is None:
+                return False, "アクセストークンの取得に失敗しました"
             
             if response.status_code == 200:
                 return True, None
@@ -165,95 +415,175 @@ class ExcelOnlineManager:
         except Exception as e:
             return False, f"データ書き込みエラー: {e}"
     
-    def clear_new_estimate_short_only(self, file_id, sheet_name):
-        """新規見積書　ショート専用のリセット（B23:D23には一切触れない）"""
-        try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return False, "アクセストークンの取得に失敗しました"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # シート名をURLエンコード
-            import urllib.parse
-            encoded_sheet_name = urllib.parse.quote(sheet_name)
-            
-            print("新規見積書　ショートのリセットを開始します（B23:D23は保護されます）")
-            
-            # B23:D23のヘッダー行を事前にバックアップ
-            print("B23:D23のヘッダー行をバックアップ中...")
-            header_backup, error = self.read_range(file_id, sheet_name, 'B23:D23')
+    def _range_path(self, file_id, sheet_name, range_address):
+        """Graph APIの範囲リソースのパス（バージョン部分を除く）"""
+        encoded_sheet_name = urllib.parse.quote(sheet_name)
+        encoded_range = urllib.parse.quote(range_address)
+        return f"/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_range}')"
+    
+    def execute_batch(self, operations, file_id=None):
+        """複数のGraph API呼び出しを$batchでまとめて実行
+        
+        operationsは{'method', 'url', 'body'}の辞書のリスト（urlはバージョン部分を除いたパス）。
+        1回の$batchには最大20件を詰める。リクエストは互いに独立して並列に実行されるので、
+        順序が必要な操作だけ'depends_on'に先行する操作のインデックス（のリスト）を指定する
+        （別の$batchに入った先行操作は完了済みのため連結しない）。戻り値は(レスポンスのリスト, エラー)で、
+        レスポンスはoperationsと同じ順序の{'status', 'body'}。
+        file_idを指定すると各リクエストにワークブックセッションIDを付与する。
+        """
+        headers = self._get_headers()
+        if headers is None:
+            return None, "アクセストークンの取得に失敗しました"
+        session_id = None
+        if file_id and self.use_workbook_session:
+            session_id = self.get_workbook_session_id(file_id, headers['Authorization'][len('Bearer '):])
+        
+        results = []
+        for chunk_start in range(0, len(operations), GRAPH_BATCH_LIMIT):
+            chunk = operations[chunk_start:chunk_start + GRAPH_BATCH_LIMIT]
+            requests_payload = []
+            for i, operation in enumerate(chunk):
+                item = {
+                    'id': str(i + 1),
+                    'method': operation['method'],
+                    'url': operation['url']
+                }
+                item_headers = {}
+                if operation.get('body') is not None:
+                    item['body'] = operation['body']
+                    item_headers['Content-Type'] = 'application/json'
+                if session_id:
+                    item_headers['workbook-session-id'] = session_id
+                if item_headers:
+                    item['headers'] = item_headers
+                depends_on = operation.get('depends_on')
+                if depends_on is not None:
+                    if isinstance(depends_on, int):
+                        depends_on = [depends_on]
+                    depends_ids = [
+                        str(index - chunk_start + 1) for index in depends_on
+                        if chunk_start <= index < chunk_start + i
+                    ]
+                    if depends_ids:
+                        item['dependsOn'] = depends_ids
+                requests_payload.append(item)
+            
+            response = self.session.post(
+                GRAPH_BATCH_URL, headers=headers,
+                json={'requests': requests_payload}, timeout=self.request_timeout
+            )
+            with self._batch_lock:
+                self.batch_stats['batches'] += 1
+                self.batch_stats['operations'] += len(chunk)
+            
+            if response.status_code != 200:
+                with self._batch_lock:
+                    self.batch_stats['failed_operations'] += len(chunk)
+                return results, f"バッチ実行エラー: {response.status_code} - {response.text}"
+            
+            responses = {r['id']: r for r in response.json().get('responses', [])}
+            for i in range(len(chunk)):
+                r = responses.get(str(i + 1), {})
+                status = r.get('status', 0)
+                if session_id and status in (400, 404, 409, 410) and 'session' in str(r.get('body', '')).lower():
+                    # 次回の呼び出しでセッションを作り直す
+                    self.invalidate_workbook_session(file_id)
+                if status >= 300 or status == 0:
+                    with self._batch_lock:
+                        self.batch_stats['failed_operations'] += 1
+                results.append({'status': status, 'body': r.get('body')})
+        
+        return results, None
+    
+    def clear_ranges(self, file_id, sheet_name, range_addresses, protected_ranges=None, backup_range=None):
+        """複数の範囲を、保護セルを除いた最小限の矩形ごとに$batchでまとめてクリア
+        
+        各矩形はrange/clear（applyTo=Contents）で値だけを消すため、書式は残る。
+        クリア同士は独立しているので並列に実行させる。backup_rangeを指定すると事前に読み取り、
+        全クリアの完了後に書き戻すよう同じ$batchで復元をdependsOnで連結する。
+        """
+        rectangles = compute_clear_rectangles(range_addresses, protected_ranges or [])
+        print(f"クリア対象の矩形: {rectangles}（保護: {protected_ranges or []}）")
+        
+        header_backup = None
+        if backup_range:
+            # バックアップはクリアより先に読み取っておく
+            print(f"{backup_range}をバックアップ中...")
+            header_backup, error = self.read_range(file_id, sheet_name, backup_range)
             if error:
-                print(f"警告: ヘッダー行のバックアップに失敗: {error}")
+                print(f"警告: {backup_range}のバックアップに失敗: {error}")
                 header_backup = None
             else:
-                print(f"ヘッダー行をバックアップしました: {header_backup}")
-            
-            # B24:G30の範囲を個別セルで処理（B23:D23は除外）
-            target_cells = []
-            
-            # B列、C列、D列の24行目から30行目（B28:D28も含む）
-            for col in ['B', 'C', 'D']:
-                for row in range(24, 31):  # 24行目から30行目
-                    target_cells.append(f"{col}{row}")
-            
-            # E列、F列、G列の24行目から30行目
-            for col in ['E', 'F', 'G']:
-                for row in range(24, 31):  # 24行目から30行目
-                    target_cells.append(f"{col}{row}")
-            
-            print(f"リセット対象セル数: {len(target_cells)}")
-            print(f"リセット対象セル: {target_cells}")
-            
-            # 各セルを個別にクリア
-            cleared_count = 0
-            for cell_address in target_cells:
-                encoded_cell = urllib.parse.quote(cell_address)
-                url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_cell}')"
-                
-                payload = {
-                    "values": [['']]
-                }
-                
-                response = requests.patch(url, headers=headers, json=payload)
-                
-                if response.status_code != 200:
-                    print(f"警告: セル {cell_address} のクリアに失敗: {response.status_code}")
-                else:
-                    print(f"クリア: セル {cell_address}")
-                    cleared_count += 1
-                
-                # 各セルの処理後に少し待機
-                import time
-                time.sleep(0.1)
-            
-            # 処理完了後に少し待機
-            import time
-            time.sleep(0.5)
-            
-            # B23:D23のヘッダー行を復元
-            if header_backup:
-                print("B23:D23のヘッダー行を復元中...")
-                success, error = self.write_range(file_id, sheet_name, 'B23:D23', header_backup)
+                print(f"{backup_range}をバックアップしました: {header_backup}")
+        
+        operations = [
+            {
+                'method': 'POST',
+                'url': self._range_path(file_id, sheet_name, rectangle) + '/clear',
+                'body': {'applyTo': 'Contents'}
+            }
+            for rectangle in rectangles
+        ]
+        if header_backup:
+            # 復元はすべてのクリアが終わってから実行する
+            operations.append({
+                'method': 'PATCH',
+                'url': self._range_path(file_id, sheet_name, backup_range),
+                'body': {'values': header_backup},
+                'depends_on': list(range(len(rectangles)))
+            })
+        results, error = self.execute_batch(operations, file_id=file_id)
+        if results is None:
+            return False, error
+        
+        failed = [
+            rectangle for rectangle, result in zip(rectangles, results)
+            if result['status'] >= 300 or result['status'] == 0
+        ]
+        if not error and len(results) < len(rectangles):
+            error = "一部の範囲がクリアされていません"
+        
+        # バックアップ範囲を復元（$batch内の復元が失敗した場合は個別に書き戻す）
+        if header_backup:
+            print(f"{backup_range}を復元中...")
+            restored = len(results) == len(operations) and 200 <= results[-1]['status'] < 300
+            if restored:
+                success, restore_error = True, None
+            else:
+                success, restore_error = self.write_range(file_id, sheet_name, backup_range, header_backup)
+            if not success:
+                print(f"警告: {backup_range}の復元に失敗: {restore_error}")
+                print(f"{backup_range}の復元を再試行中...")
+                time.sleep(1)
+                success, restore_error = self.write_range(file_id, sheet_name, backup_range, header_backup)
                 if success:
-                    print("ヘッダー行の復元が完了しました")
+                    print(f"{backup_range}の復元が完了しました（再試行成功）")
                 else:
-                    print(f"警告: ヘッダー行の復元に失敗: {error}")
-                    
-                    # 復元に失敗した場合は、再度試行
-                    print("ヘッダー行の復元を再試行中...")
-                    time.sleep(1)
-                    success, error = self.write_range(file_id, sheet_name, 'B23:D23', header_backup)
-                    if success:
-                        print("ヘッダー行の復元が完了しました（再試行成功）")
-                    else:
-                        print(f"警告: ヘッダー行の復元に再び失敗: {error}")
+                    print(f"警告: {backup_range}の復元に再び失敗: {restore_error}")
+            else:
+                print(f"{backup_range}の復元が完了しました")
+        
+        if error:
+            return False, error
+        if failed:
+            return False, f"範囲 {', '.join(failed)} のクリアに失敗しました"
+        return True, None
+    
+    def clear_new_estimate_short_only(self, file_id, sheet_name):
+        """新規見積書　ショート専用のリセット（B23:D23には一切触れない）"""
+        try:
+            print("新規見積書　ショートのリセットを開始します（B23:D23は保護されます）")
+            
+            # B24:G30をクリア（B23:D23は保護対象から除外し、念のためバックアップ・復元も行う）
+            success, error = self.clear_ranges(
+                file_id, sheet_name, ['B24:G30'],
+                protected_ranges=['B23:D23'], backup_range='B23:D23'
+            )
+            if not success:
+                return False, error
             
-            print(f"リセット完了: {cleared_count}/{len(target_cells)} セルをクリアしました")
-            return True, f"新規見積書　ショートのリセットが完了しました（{cleared_count}セルをクリア、B23:D23は保護）"
+            print("リセット完了: B24:G30をクリアしました")
+            return True, "新規見積書　ショートのリセットが完了しました（B24:G30をクリア、B23:D23は保護）"
                 
         except Exception as e:
             return False, f"新規見積書　ショートリセットエラー: {e}"
@@ -261,91 +591,13 @@ class ExcelOnlineManager:
     def clear_range_safe_for_new_estimate_short(self, file_id, sheet_name):
         """新規見積書　ショート専用の安全なリセット（B23:D23を保護）"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return False, "アクセストークンの取得に失敗しました"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # シート名をURLエンコード
-            import urllib.parse
-            encoded_sheet_name = urllib.parse.quote(sheet_name)
-            
-            # B23:D23のヘッダー行を事前にバックアップ
-            print("B23:D23のヘッダー行をバックアップ中...")
-            header_backup, error = self.read_range(file_id, sheet_name, 'B23:D23')
-            if error:
-                print(f"警告: ヘッダー行のバックアップに失敗: {error}")
-                header_backup = None
-            else:
-                print(f"ヘッダー行をバックアップしました: {header_backup}")
-            
-            # 新規見積書　ショートのリセット範囲を個別に処理
-            # 各列を個別にクリアして安全性を確保
-            clear_columns = [
-                ('B', 24, 30),  # B列 24行目から30行目
-                ('C', 24, 30),  # C列 24行目から30行目
-                ('D', 24, 30),  # D列 24行目から30行目
-                ('E', 24, 30),  # E列 24行目から30行目
-                ('F', 24, 30),  # F列 24行目から30行目
-                ('G', 24, 30)   # G列 24行目から30行目
-            ]
-            
-            # 各列を個別にクリア
-            for col_letter, start_row, end_row in clear_columns:
-                print(f"{col_letter}列 {start_row}行目から{end_row}行目をクリア中...")
-                
-                # 各セルを個別にクリア
-                for row in range(start_row, end_row + 1):
-                    cell_address = f"{col_letter}{row}"
-                    
-                    # B23:D23の範囲は絶対にクリアしない
-                    if row == 23 and col_letter in ['B', 'C', 'D']:
-                        print(f"保護: セル {cell_address} はヘッダー行のためスキップ")
-                        continue
-                    
-                    encoded_cell = urllib.parse.quote(cell_address)
-                    url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_cell}')"
-                    
-                    payload = {
-                        "values": [['']]
-                    }
-                    
-                    response = requests.patch(url, headers=headers, json=payload)
-                    
-                    if response.status_code != 200:
-                        print(f"警告: セル {cell_address} のクリアに失敗: {response.status_code}")
-                    else:
-                        print(f"クリア: セル {cell_address}")
-                
-                # 各列の処理後に少し待機
-                import time
-                time.sleep(0.3)
-            
-            # リセット処理完了後に少し待機
-            import time
-            time.sleep(1)
-            
-            # B23:D23のヘッダー行を復元
-            if header_backup:
-                print("B23:D23のヘッダー行を復元中...")
-                success, error = self.write_range(file_id, sheet_name, 'B23:D23', header_backup)
-                if success:
-                    print("ヘッダー行の復元が完了しました")
-                else:
-                    print(f"警告: ヘッダー行の復元に失敗: {error}")
-                    
-                    # 復元に失敗した場合は、再度試行
-                    print("ヘッダー行の復元を再試行中...")
-                    time.sleep(2)
-                    success, error = self.write_range(file_id, sheet_name, 'B23:D23', header_backup)
-                    if success:
-                        print("ヘッダー行の復元が完了しました（再試行成功）")
-                    else:
-                        print(f"警告: ヘッダー行の復元に再び失敗: {error}")
+            # 新規見積書　ショートのリセット範囲（B列からG列の24行目から30行目）
+            success, error = self.clear_ranges(
+                file_id, sheet_name, ['B24:D30', 'E24:G30'],
+                protected_ranges=['B23:D23'], backup_range='B23:D23'
+            )
+            if not success:
+                return False, error
             
             return True, "新規見積書　ショートのリセットが完了しました（B23:D23は保護されました）"
                 
@@ -353,71 +605,11 @@ class ExcelOnlineManager:
             return False, f"新規見積書　ショートリセットエラー: {e}"
 
     def clear_range(self, file_id, sheet_name, range_address):
-        """指定された範囲のデータをクリア（個別セルで安全にクリア）"""
+        """指定された範囲のデータをクリア"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return False, "アクセストークンの取得に失敗しました"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # シート名をURLエンコード
-            import urllib.parse
-            encoded_sheet_name = urllib.parse.quote(sheet_name)
-            
-            # 範囲のサイズを計算
-            import re
-            range_match = re.match(r'([A-Z]+)(\d+):([A-Z]+)(\d+)', range_address)
-            if not range_match:
+            if not parse_range_address(range_address):
                 return False, "無効な範囲形式です"
-            
-            start_col = range_match.group(1)
-            start_row = int(range_match.group(2))
-            end_col = range_match.group(3)
-            end_row = int(range_match.group(4))
-            
-            # 列を数値に変換
-            def col_to_num(col):
-                result = 0
-                for char in col:
-                    result = result * 26 + (ord(char) - ord('A') + 1)
-                return result
-            
-            def num_to_col(num):
-                result = ""
-                while num > 0:
-                    num -= 1
-                    result = chr(num % 26 + ord('A')) + result
-                    num //= 26
-                return result
-            
-            start_col_num = col_to_num(start_col)
-            end_col_num = col_to_num(end_col)
-            
-            # 各セルを個別にクリア（より安全な方法）
-            for row in range(start_row, end_row + 1):
-                for col_num in range(start_col_num, end_col_num + 1):
-                    col_letter = num_to_col(col_num)
-                    cell_address = f"{col_letter}{row}"
-                    encoded_cell = urllib.parse.quote(cell_address)
-                    
-                    url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets/{encoded_sheet_name}/range(address='{encoded_cell}')"
-                    
-                    payload = {
-                        "values": [['']]
-                    }
-                    
-                    response = requests.patch(url, headers=headers, json=payload)
-                    
-                    if response.status_code != 200:
-                        print(f"警告: セル {cell_address} のクリアに失敗: {response.status_code}")
-                        # 個別セルの失敗は警告として記録するが、処理は続行
-            
-            return True, None
-                
+            return self.clear_ranges(file_id, sheet_name, [range_address])
         except Exception as e:
             return False, f"データクリアエラー: {e}"
     
@@ -454,19 +646,19 @@ class ExcelOnlineManager:
     
     def write_product_data_excel(self, data, file_id, sheet_name, row_number):
         """商品データをExcelファイルに書き込み"""
+        return self.write_products_data_excel([data], file_id, sheet_name, row_number)
+    
+    def write_products_data_excel(self, records, file_id, sheet_name, row_number):
+        """複数商品のデータをrow_number行目から連続した行に1回の範囲書き込みで書き込み"""
         try:
-            product_name = data.get('商品名', '')
-            unit_price = data.get('単価', '')
-            quantity = data.get('数量', '')
-            cycle = data.get('サイクル', '')
-            
-            # 商品データを配列として準備
+            # 商品データを配列として準備（1商品1行）
             product_data = [
-                [product_name, unit_price, quantity, '', '', cycle, '']
+                [data.get('商品名', ''), data.get('単価', ''), data.get('数量', ''), '', '', data.get('サイクル', ''), '']
+                for data in records
             ]
             
             # 行番号を指定して書き込み
-            range_address = f'A{row_number}:G{row_number}'
+            range_address = f'A{row_number}:G{row_number + len(product_data) - 1}'
             success, error = self.write_range(
                 file_id, 
                 sheet_name, 
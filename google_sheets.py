@@ -0,0 +1,332 @@
+import os
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+import gspread
+from database import SQLiteConnectionManager
+from ttl_cache import TTLCache
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request
+
+class GoogleSheetsClientManager:
+    def __init__(self, scopes, credentials_file='gsheet_service_account.json', refresh_margin_seconds=300):
+        """プロセス全体で共有するGoogle Sheetsクライアントを管理するクラス"""
+        self.scopes = scopes
+        self.credentials_file = credentials_file
+        self.refresh_margin = timedelta(seconds=refresh_margin_seconds)
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._client = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'errors': 0
+        }
+
+    def load_credentials(self):
+        """サービスアカウント情報を読み込み（ローカルファイルを優先）"""
+        if os.path.exists(self.credentials_file):
+            print("ローカルファイルからサービスアカウント情報を読み込み中...")
+            return Credentials.from_service_account_file(
+                self.credentials_file, scopes=self.scopes)
+
+        # 環境変数からサービスアカウント情報を取得
+        service_account_info = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')
+        print(f"GOOGLE_SHEETS_CREDENTIALS: {'SET' if service_account_info else 'NOT_SET'}")
+        if service_account_info:
+            print("環境変数からサービスアカウント情報を読み込み中...")
+            return Credentials.from_service_account_info(
+                json.loads(service_account_info), scopes=self.scopes)
+
+        print("サービスアカウント情報が見つかりません")
+        return None
+
+    def _needs_refresh(self):
+        """トークンが未取得、または有効期限が近い場合はTrue"""
+        creds = self._credentials
+        if not creds.token or not creds.expiry:
+            return True
+        # google-authのexpiryはタイムゾーンなしのUTC
+        return creds.expiry - datetime.utcnow() <= self.refresh_margin
+
+    def get_client(self):
+        """認証済みのgspreadクライアントを取得（初回のみ認証、期限前に更新）"""
+        with self._lock:
+            try:
+                if self._client is None:
+                    self.stats['misses'] += 1
+                    creds = self.load_credentials()
+                    if creds is None:
+                        return None
+                    print("gspreadクライアントを認証中...")
+                    self._credentials = creds
+                    self._client = gspread.authorize(creds)
+                else:
+                    self.stats['hits'] += 1
+
+                # 有効期限の前にトークンを更新（クライアントは同じ資格情報を共有）
+                if self._needs_refresh():
+                    self._credentials.refresh(Request())
+                    self.stats['refreshes'] += 1
+
+                return self._client
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"Google Sheetsクライアント取得エラー: {e}")
+                # 次回は最初から認証し直す
+                self._client = None
+                self._credentials = None
+                return None
+
+    def reset(self):
+        """キャッシュされたクライアントを破棄"""
+        with self._lock:
+            self._client = None
+            self._credentials = None
+
+    def get_stats(self):
+        """キャッシュの統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['authorized'] = self._client is not None
+            stats['token_expiry'] = (
+                self._credentials.expiry.isoformat()
+                if self._credentials and self._credentials.expiry else None
+            )
+            return stats
+
+class SheetHandleCache:
+    def __init__(self, max_entries=128, ttl_seconds=600):
+        """Spreadsheet/Worksheetハンドルとシート名一覧のLRU+TTLキャッシュ"""
+        self._entries = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    def get_spreadsheet(self, client, spreadsheet_id):
+        """Spreadsheetハンドルを取得（キャッシュがなければopen_by_key）"""
+        key = ('spreadsheet', spreadsheet_id)
+        spreadsheet = self._entries.get(key)
+        if spreadsheet is None:
+            spreadsheet = client.open_by_key(spreadsheet_id)
+            self._entries.put(key, spreadsheet)
+        return spreadsheet
+
+    def get_sheet_titles(self, client, spreadsheet_id):
+        """シート名一覧を取得（取得したWorksheetハンドルもまとめてキャッシュ）"""
+        key = ('titles', spreadsheet_id)
+        titles = self._entries.get(key)
+        if titles is None:
+            spreadsheet = self.get_spreadsheet(client, spreadsheet_id)
+            worksheets = spreadsheet.worksheets()
+            titles = [ws.title for ws in worksheets]
+            self._entries.put(key, titles)
+            for ws in worksheets:
+                self._entries.put(('worksheet', spreadsheet_id, ws.title), ws)
+        return titles
+
+    def get_worksheet(self, client, spreadsheet_id, sheet_name):
+        """Worksheetハンドルを取得（シートが見つからない場合はキャッシュを破棄して例外を再送出）"""
+        key = ('worksheet', spreadsheet_id, sheet_name)
+        worksheet = self._entries.get(key)
+        if worksheet is None:
+            spreadsheet = self.get_spreadsheet(client, spreadsheet_id)
+            try:
+                worksheet = spreadsheet.worksheet(sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                self.invalidate(spreadsheet_id)
+                raise
+            self._entries.put(key, worksheet)
+        return worksheet
+
+    def invalidate(self, spreadsheet_id, sheet_name=None):
+        """スプレッドシート（またはその中の1シート）のキャッシュを破棄"""
+        if sheet_name is not None:
+            # 対象シートのハンドルと、古くなっている可能性があるシート名一覧のみ破棄
+            self._entries.discard(('worksheet', spreadsheet_id, sheet_name))
+            self._entries.discard(('titles', spreadsheet_id))
+        else:
+            self._entries.discard_matching(lambda key: key[1] == spreadsheet_id)
+
+    def handle_api_error(self, error, spreadsheet_id, sheet_name=None):
+        """シートが存在しないことを示すAPIエラーの場合はキャッシュを破棄"""
+        if is_not_found_error(error):
+            print(f"シート未検出エラーのためハンドルキャッシュを破棄: {spreadsheet_id} / {sheet_name}")
+            self.invalidate(spreadsheet_id, sheet_name)
+
+    def get_stats(self):
+        """キャッシュの統計情報を取得"""
+        return self._entries.get_stats()
+
+def is_not_found_error(error):
+    """シートやスプレッドシートが見つからないことを示す例外かどうかを判定"""
+    if isinstance(error, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        message = str(error)
+        return 'Unable to parse range' in message or 'NOT_FOUND' in message or '404' in message
+    return False
+
+class RowCursorCache:
+    def __init__(self, revalidate_seconds=300, db_path=None, max_claim_attempts=5):
+        """(spreadsheet_id, sheet_name, product_type)ごとの次の書き込み行を管理するクラス
+
+        db_pathを指定するとSQLiteにも保存し、複数プロセス間では
+        next_rowの比較更新（楽観的排他）で競合を検出する。
+        """
+        self.revalidate_seconds = revalidate_seconds
+        self.max_claim_attempts = max_claim_attempts
+        self.db_path = db_path
+        self.db = SQLiteConnectionManager(db_path) if db_path else None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._cursors = {}  # key -> {'next_row': int, 'validated_at': float}
+        self.stats = {
+            'hits': 0,
+            'revalidations': 0,
+            'conflicts': 0,
+            'invalidations': 0,
+            'overflows': 0
+        }
+        if self.db_path:
+            self._init_table()
+
+    def _init_table(self):
+        with self.db.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sheet_cursors (
+                    spreadsheet_id TEXT,
+                    sheet_name TEXT,
+                    product_type TEXT,
+                    next_row INTEGER,
+                    validated_at REAL,
+                    PRIMARY KEY (spreadsheet_id, sheet_name, product_type)
+                )
+            ''')
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _read(self, key):
+        if not self.db_path:
+            with self._lock:
+                cursor = self._cursors.get(key)
+                return dict(cursor) if cursor else None
+        row = self.db.execute('''
+            SELECT next_row, validated_at FROM sheet_cursors
+            WHERE spreadsheet_id = ? AND sheet_name = ? AND product_type = ?
+        ''', key).fetchone()
+        return {'next_row': row[0], 'validated_at': row[1]} if row else None
+
+    def _write(self, key, next_row, validated_at):
+        """カーソルを無条件に保存（シートから再取得した値はこちらで保存）"""
+        with self._lock:
+            self._cursors[key] = {'next_row': next_row, 'validated_at': validated_at}
+        if self.db_path:
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO sheet_cursors
+                    (spreadsheet_id, sheet_name, product_type, next_row, validated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', key + (next_row, validated_at))
+
+    def _advance(self, key, expected_row, next_row):
+        """カーソルがexpected_rowのままの場合のみ進める（進められなければFalse）"""
+        if not self.db_path:
+            with self._lock:
+                cursor = self._cursors.get(key)
+                if not cursor or cursor['next_row'] != expected_row:
+                    return False
+                cursor['next_row'] = next_row
+                return True
+        with self.db.transaction() as conn:
+            updated = conn.execute('''
+                UPDATE sheet_cursors SET next_row = ?
+                WHERE spreadsheet_id = ? AND sheet_name = ? AND product_type = ? AND next_row = ?
+            ''', (next_row,) + key + (expected_row,)).rowcount
+        if updated:
+            with self._lock:
+                cursor = self._cursors.get(key)
+                if cursor:
+                    cursor['next_row'] = next_row
+        return updated == 1
+
+    def _revalidate(self, key, row_start, load_used_rows):
+        """シートの使用済み行数からカーソルを作り直す"""
+        self._count('revalidations')
+        cursor = {'next_row': row_start + load_used_rows(), 'validated_at': time.time()}
+        self._write(key, cursor['next_row'], cursor['validated_at'])
+        return cursor
+
+    def claim(self, key, row_start, row_end, load_used_rows, count=1):
+        """次の書き込み行からcount行を確保してカーソルを進め、先頭の行番号を返す
+
+        load_used_rowsはシートの使用済み行数を返す関数で、カーソルが未作成・
+        期限切れ・空き行不足のときだけ呼ばれる。
+        row_endまでの空き行がcount行に満たない場合はカーソルを進めずにNoneを返す
+        （行範囲を超えて書き込むと最終行の商品同士が上書きされるため）。
+        カーソルを進められた行だけを返し、max_claim_attempts回続けて他のプロセスと
+        競合した場合はRuntimeErrorを送出する。
+        """
+        with self._get_key_lock(key):
+            cursor = self._read(key)
+            if (cursor is None
+                    or cursor['next_row'] + count - 1 > row_end
+                    or time.time() - cursor['validated_at'] > self.revalidate_seconds):
+                # 空き行が足りないときは、シート側で行が消されていないかも確認する
+                cursor = self._revalidate(key, row_start, load_used_rows)
+            else:
+                self._count('hits')
+
+            for _ in range(self.max_claim_attempts):
+                row = cursor['next_row']
+                if row + count - 1 > row_end:
+                    free_rows = max(0, row_end - row + 1)
+                    print(f"警告: 空き行が足りません（{row_end}行目まで残り{free_rows}行、必要{count}行）")
+                    self._count('overflows')
+                    return None
+                if self._advance(key, row, row + count):
+                    return row
+                # 他のプロセスが同じカーソルを進めた場合は、進められた位置から確保し直す
+                # （シートはまだ書き込まれていない可能性があるため、保存済みのカーソルを読む）
+                self._count('conflicts')
+                cursor = self._read(key) or self._revalidate(key, row_start, load_used_rows)
+            raise RuntimeError(f"書き込み行の確保が{self.max_claim_attempts}回競合しました")
+
+    def invalidate(self, key):
+        """1つのカーソルを破棄（書き込み失敗時など）"""
+        self._delete(lambda k: k == key)
+
+    def reset(self, spreadsheet_id, sheet_name):
+        """シートのリセット後に、そのシートの全商品タイプのカーソルを破棄"""
+        self._delete(lambda k: k[0] == spreadsheet_id and k[1] == sheet_name)
+
+    def _delete(self, predicate):
+        with self._lock:
+            for key in [k for k in self._cursors if predicate(k)]:
+                del self._cursors[key]
+                self.stats['invalidations'] += 1
+        if self.db_path:
+            with self.db.transaction() as conn:
+                keys = [row for row in conn.execute(
+                    'SELECT spreadsheet_id, sheet_name, product_type FROM sheet_cursors'
+                ) if predicate(tuple(row))]
+                conn.executemany('''
+                    DELETE FROM sheet_cursors
+                    WHERE spreadsheet_id = ? AND sheet_name = ? AND product_type = ?
+                ''', keys)
+
+    def get_stats(self):
+        """カーソルキャッシュの統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._cursors)
+            stats['persistent'] = bool(self.db_path)
+            return stats
@@ -0,0 +1,42 @@
+import threading
+from collections import deque
+
+
+class LatencyRecorder:
+    """直近の計測値（ミリ秒）を保持してパーセンタイルを計算する"""
+
+    def __init__(self, window=1000):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.max_ms = 0.0
+
+    def record(self, value_ms):
+        """計測値を1件追加"""
+        with self._lock:
+            self._values.append(value_ms)
+            self.count += 1
+            if value_ms > self.max_ms:
+                self.max_ms = value_ms
+
+    def snapshot(self):
+        """件数・平均・p50/p95/p99・最大値を取得（パーセンタイルは直近window件から計算）"""
+        with self._lock:
+            values = sorted(self._values)
+            count = self.count
+            max_ms = self.max_ms
+        if not values:
+            return {'count': count, 'avg_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': round(max_ms, 2)}
+
+        def percentile(p):
+            index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+            return round(values[index], 2)
+
+        return {
+            'count': count,
+            'avg_ms': round(sum(values) / len(values), 2),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': round(max_ms, 2)
+        }
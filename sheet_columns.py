@@ -0,0 +1,16 @@
+def col_to_num(col):
+    """列名を数値に変換（A=1, B=2, ..., AA=27）"""
+    result = 0
+    for char in col:
+        result = result * 26 + (ord(char) - ord('A') + 1)
+    return result
+
+
+def num_to_col(num):
+    """数値を列名に変換（1=A, 2=B, ..., 27=AA）"""
+    result = ""
+    while num > 0:
+        num -= 1
+        result = chr(num % 26 + ord('A')) + result
+        num //= 26
+    return result
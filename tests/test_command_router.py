@@ -0,0 +1,66 @@
+import pytest
+
+from command_router import CommandRouter
+
+
+def test_exact_command_takes_precedence_over_patterns():
+    router = CommandRouter('test')
+    calls = []
+
+    @router.pattern(r'リセット')
+    def pattern_handler():
+        calls.append('pattern')
+
+    @router.command('リセット')
+    def exact_handler():
+        calls.append('exact')
+
+    assert router.dispatch('リセット')
+    assert calls == ['exact']
+
+
+def test_patterns_are_tried_in_registration_order():
+    router = CommandRouter('test')
+
+    @router.pattern(r'スプレッドシート')
+    def first():
+        pass
+
+    @router.pattern(r'https://docs\.google\.com/spreadsheets/')
+    def second():
+        pass
+
+    name, _ = router.match('スプレッドシート https://docs.google.com/spreadsheets/d/abc')
+    assert name == 'first'
+    name, _ = router.match('https://docs.google.com/spreadsheets/d/abc')
+    assert name == 'second'
+
+
+def test_unmatched_and_error_stats():
+    router = CommandRouter('test')
+
+    @router.command('失敗')
+    def failing():
+        raise RuntimeError('boom')
+
+    assert not router.dispatch('該当なし')
+    with pytest.raises(RuntimeError):
+        router.dispatch('失敗')
+    stats = router.get_stats()
+    assert stats['unmatched'] == 1
+    assert stats['errors'] == 1
+    assert stats['dispatched'] == 1
+    assert stats['routes']['failing']['count'] == 1
+
+
+def test_duplicate_command_is_rejected():
+    router = CommandRouter('test')
+
+    @router.command('ヘルプ')
+    def first():
+        pass
+
+    with pytest.raises(ValueError):
+        @router.command('ヘルプ')
+        def second():
+            pass
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from dispatcher import KeyedExecutor
+
+
+@pytest.fixture
+def executor():
+    executor = KeyedExecutor(shards=4, queue_size=10, name='test')
+    yield executor
+    executor.shutdown(wait=True, timeout=5)
+
+
+def keys_on_different_shards(executor):
+    first = 'U0'
+    for i in range(1, 100):
+        key = f'U{i}'
+        if executor._shard_for(key) is not executor._shard_for(first):
+            return first, key
+    raise AssertionError('別シャードのキーが見つかりません')
+
+
+def test_same_key_tasks_run_in_submission_order(executor):
+    order = []
+
+    def task(i):
+        # 先のタスクほど長く待たせても順序が入れ替わらないこと
+        time.sleep(0.001 * (20 - i))
+        order.append(i)
+
+    futures = [executor.submit_wait('U1', task, i) for i in range(20)]
+    for future in futures:
+        future.result(timeout=5)
+    assert order == list(range(20))
+
+
+def test_different_keys_run_concurrently(executor):
+    first, second = keys_on_different_shards(executor)
+    second_started = threading.Event()
+
+    def wait_for_second():
+        # 別キーのタスクが並列に動かなければタイムアウトする
+        return second_started.wait(timeout=5)
+
+    blocked = executor.submit(first, wait_for_second)
+    executor.submit(second, second_started.set).result(timeout=5)
+    assert blocked.result(timeout=5) is True
+
+
+def test_full_shard_rejects_submit_and_blocks_submit_wait():
+    executor = KeyedExecutor(shards=1, queue_size=1, name='test-full')
+    release = threading.Event()
+    try:
+        running = executor.submit('U1', release.wait, 5)
+        # ワーカーが1件目を取り出してからキューを埋める
+        deadline = time.monotonic() + 5
+        while executor.get_stats()['busy_workers'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        queued = executor.submit('U1', lambda: 'queued')
+        assert queued is not None
+        assert executor.submit('U1', lambda: 'rejected') is None
+        assert executor.get_stats()['rejected'] == 1
+
+        waited = []
+        waiter = threading.Thread(
+            target=lambda: waited.append(executor.submit_wait('U1', lambda: 'waited'))
+        )
+        waiter.start()
+        waiter.join(timeout=0.2)
+        assert waiter.is_alive()  # 空きができるまで待っている
+
+        release.set()
+        waiter.join(timeout=5)
+        assert not waiter.is_alive()
+        assert running.result(timeout=5) is True
+        assert queued.result(timeout=5) == 'queued'
+        assert waited[0].result(timeout=5) == 'waited'
+    finally:
+        release.set()
+        executor.shutdown(wait=True, timeout=5)
+
+
+def test_submit_after_shutdown_is_refused():
+    executor = KeyedExecutor(shards=2, queue_size=10, name='test-shutdown')
+    assert not executor.shutting_down
+    executor.shutdown(wait=True, timeout=5)
+    assert executor.shutting_down
+    assert executor.submit('U1', lambda: None) is None
+    assert executor.submit_wait('U1', lambda: None) is None
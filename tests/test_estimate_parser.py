@@ -0,0 +1,97 @@
+from estimate_parser import (
+    find_incomplete_products, has_product_fields, parse_bulk_records, parse_estimate_records
+)
+
+
+def test_parse_estimate_records_splits_products_on_blank_line():
+    text = "社名:テスト商事\n商品名:マット 現状\n単価:１，２００\n数量:3\n\n商品名:モップ\n単価:500\n数量:2"
+    records = parse_estimate_records(text)
+    assert len(records) == 2
+    assert records[0]['社名'] == 'テスト商事'
+    assert records[0]['商品名'] == 'マット'
+    assert records[0]['商品タイプ'] == '現状'
+    assert records[0]['料金'] == 3600
+    assert records[1]['商品名'] == 'モップ'
+    assert records[1]['商品タイプ'] == 'default'
+    assert records[1]['料金'] == 1000
+
+
+def test_bulk_comma_line_with_three_digit_quantity():
+    records, errors = parse_bulk_records("一括登録\nマット,1200,100")
+    assert errors == []
+    assert records[0]['単価'] == '1200'
+    assert records[0]['数量'] == '100'
+    assert records[0]['料金'] == 120000
+
+
+def test_bulk_comma_line_with_three_digit_price():
+    records, errors = parse_bulk_records("一括登録\nタオル,50,200,月1回\nモップ,500,2")
+    assert errors == []
+    assert records[0]['単価'] == '50'
+    assert records[0]['数量'] == '200'
+    assert records[0]['サイクル'] == '月1回'
+    assert records[1]['単価'] == '500'
+
+
+def test_bulk_comma_line_merges_thousands_separator_only_when_needed():
+    # 区切り文字どおりでは列が多すぎるので1,200を金額として読み直す
+    records, errors = parse_bulk_records("一括登録\nマット,1,200,3,月1回,玄関")
+    assert errors == []
+    assert records[0]['料金'] == 3600
+    assert records[0]['設置場所'] == '玄関'
+
+
+def test_bulk_comma_line_that_reads_both_ways_is_rejected():
+    records, errors = parse_bulk_records("一括登録\nマット,1,200,3\nA,100,2,1,000番地")
+    assert records == []
+    assert len(errors) == 2
+    assert all('判別できません' in error for error in errors)
+
+
+def test_bulk_ideographic_comma_line_keeps_thousands_separator():
+    records, errors = parse_bulk_records("一括登録\nマット、1,200、3、月1回、1,000番地")
+    assert errors == []
+    assert records[0]['料金'] == 3600
+    assert records[0]['設置場所'] == '1,000番地'
+
+
+def test_bulk_tab_and_ideographic_comma_lines():
+    records, errors = parse_bulk_records("一括登録\nマット\t1,200\t3\t4週\t玄関\nモップ、500、2")
+    assert errors == []
+    assert [r['商品名'] for r in records] == ['マット', 'モップ']
+    assert records[0]['サイクル'] == '4週'
+    assert records[0]['設置場所'] == '玄関'
+    assert records[1]['料金'] == 1000
+
+
+def test_bulk_items_on_command_line_are_read():
+    records, errors = parse_bulk_records("一括登録：マット,1200,3\nモップ,500,2")
+    assert errors == []
+    assert [r['商品名'] for r in records] == ['マット', 'モップ']
+
+
+def test_bulk_rejects_non_numeric_values_with_line_number():
+    records, errors = parse_bulk_records("一括登録\nマット,千円,3\nモップ,500,2")
+    assert [r['商品名'] for r in records] == ['モップ']
+    assert len(errors) == 1
+    assert errors[0].startswith('2行目「マット,千円,3」')
+    assert '単価' in errors[0]
+
+
+def test_bulk_skips_header_and_reports_missing_columns():
+    records, errors = parse_bulk_records("一括登録\n商品名,単価,数量\nマット,1200")
+    assert records == []
+    assert len(errors) == 1
+    assert '数量がありません' in errors[0]
+
+
+def test_incomplete_product_is_reported_with_its_number():
+    text = "社名:テスト商事\n商品名:マット\n単価:1200\n数量:3\n\n商品名:モップ\n単価:500"
+    records = [r for r in parse_estimate_records(text) if has_product_fields(r)]
+    assert len(records) == 2
+    assert find_incomplete_products(records) == ['2件目（数量がありません）']
+
+
+def test_company_only_message_has_no_product_fields():
+    records = parse_estimate_records("会社名:テスト商事 日付:2024/01/15")
+    assert not any(has_product_fields(r) for r in records)
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip('gspread')
+pytest.importorskip('google.oauth2.service_account')
+
+from google_sheets import RowCursorCache  # noqa: E402
+
+KEY = ('sheet-id', 'シート1', 'default')
+
+
+def test_claim_allocates_consecutive_rows():
+    cache = RowCursorCache()
+    assert cache.claim(KEY, 19, 26, lambda: 0, count=3) == 19
+    assert cache.claim(KEY, 19, 26, lambda: 3, count=2) == 22
+
+
+def test_claim_rejects_batch_that_overflows_row_end():
+    cache = RowCursorCache()
+    # 19〜26行目の8行に9件は収まらない
+    assert cache.claim(KEY, 19, 26, lambda: 0, count=9) is None
+    assert cache.get_stats()['overflows'] == 1
+    # カーソルは進んでいないので8件なら収まる
+    assert cache.claim(KEY, 19, 26, lambda: 0, count=8) == 19
+
+
+def test_claim_rejects_when_last_row_is_used():
+    cache = RowCursorCache()
+    assert cache.claim(KEY, 19, 26, lambda: 0, count=8) == 19
+    assert cache.claim(KEY, 19, 26, lambda: 8, count=1) is None
+
+
+def test_claim_after_conflict_does_not_reuse_rows(tmp_path):
+    db_path = str(tmp_path / 'cursors.db')
+    first = RowCursorCache(db_path=db_path)
+    second = RowCursorCache(db_path=db_path)
+    advance = first._advance
+    raced = []
+
+    def advance_after_other_process(key, expected_row, next_row):
+        # 別プロセスが先に同じ行を確保した状況を再現する（シートはまだ書き込まれていない）
+        if not raced:
+            raced.append(second.claim(KEY, 19, 26, lambda: 0, count=2))
+        return advance(key, expected_row, next_row)
+
+    first._advance = advance_after_other_process
+    row = first.claim(KEY, 19, 26, lambda: 0, count=3)
+    assert raced == [19]
+    assert row == 21
+    assert first.get_stats()['conflicts'] == 1
+
+
+def test_claim_gives_up_after_repeated_conflicts():
+    cache = RowCursorCache(max_claim_attempts=2)
+    cache._advance = lambda key, expected_row, next_row: False
+    with pytest.raises(RuntimeError):
+        cache.claim(KEY, 19, 26, lambda: 0, count=1)
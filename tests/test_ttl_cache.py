@@ -0,0 +1,52 @@
+import time
+
+from sheet_columns import col_to_num, num_to_col
+from ttl_cache import TTLCache
+from user_management import UserProfileCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_expired_entry_counts_as_miss():
+    cache = TTLCache(max_entries=2, ttl_seconds=0.01)
+    cache.put('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    stats = cache.get_stats()
+    assert stats['expired'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 0
+
+
+def test_discard_matching():
+    cache = TTLCache()
+    cache.put(('worksheet', 'S1', 'A'), 1)
+    cache.put(('titles', 'S1'), 2)
+    cache.put(('titles', 'S2'), 3)
+    cache.discard_matching(lambda key: key[1] == 'S1')
+    assert cache.get(('titles', 'S2')) == 3
+    assert cache.get_stats()['invalidations'] == 2
+
+
+def test_profile_loaded_before_invalidation_is_not_stored():
+    cache = UserProfileCache()
+    profile, generation = cache.get('U1')
+    assert profile is None
+    cache.invalidate('U1')
+    cache.put('U1', 'stale', generation)
+    assert cache.get('U1')[0] is None
+
+
+def test_column_letters_round_trip():
+    for num, col in [(1, 'A'), (26, 'Z'), (27, 'AA'), (52, 'AZ'), (703, 'AAA')]:
+        assert col_to_num(col) == num
+        assert num_to_col(num) == col
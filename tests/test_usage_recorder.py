@@ -0,0 +1,35 @@
+import pytest
+
+from user_management import UserManager
+
+
+@pytest.fixture
+def async_manager(tmp_path, monkeypatch):
+    monkeypatch.delenv('USAGE_LIMITS_ENABLED', raising=False)
+    monkeypatch.setenv('USAGE_ASYNC', '1')
+    manager = UserManager(db_path=str(tmp_path / 'users.db'))
+    manager.register_user('U1', 'テストユーザー')
+    yield manager
+    manager.close()
+
+
+def test_buffered_events_are_written_on_flush(async_manager):
+    for i in range(3):
+        async_manager.increment_usage('U1', 'add_product', {'n': i})
+    async_manager.flush_usage()
+    assert async_manager.get_current_monthly_usage('U1') == 3
+    assert async_manager.usage_recorder.get_stats()['flushed'] == 3
+
+
+def test_events_after_close_are_written_synchronously(async_manager):
+    async_manager.increment_usage('U1', 'add_product', {'n': 1})
+    async_manager.usage_recorder.close()
+    assert async_manager.usage_recorder.record('U1', 'add_product', {'n': 2}) is False
+    assert async_manager.usage_recorder.record_many('U1', 'add_product', [{'n': 3}]) is False
+
+    # 停止後の記録は同期書き込みに切り替わり、失われない
+    ok, _ = async_manager.increment_usage('U1', 'add_product', {'n': 2})
+    assert ok
+    ok, _ = async_manager.increment_usage_batch('U1', 'add_product', [{'n': 3}, {'n': 4}])
+    assert ok
+    assert async_manager.get_current_monthly_usage('U1') == 4
@@ -0,0 +1,60 @@
+import pytest
+
+from user_management import PLAN_LIMITS, UserManager
+
+
+@pytest.fixture
+def limited_manager(tmp_path, monkeypatch):
+    monkeypatch.setenv('USAGE_LIMITS_ENABLED', '1')
+    monkeypatch.setenv('USAGE_ASYNC', '0')
+    manager = UserManager(db_path=str(tmp_path / 'users.db'))
+    manager.register_user('U1', 'テストユーザー')
+    yield manager
+    manager.close()
+
+
+def test_reserve_usage_up_to_exact_limit(limited_manager):
+    limit = PLAN_LIMITS['free']
+    ok, _ = limited_manager.reserve_usage('U1', limit - 1)
+    assert ok
+    ok, _ = limited_manager.reserve_usage('U1', 1)
+    assert ok
+    assert limited_manager.get_current_monthly_usage('U1') == limit
+
+    ok, message = limited_manager.reserve_usage('U1', 1)
+    assert not ok
+    assert '利用制限' in message
+    assert limited_manager.get_current_monthly_usage('U1') == limit
+
+
+def test_reserve_usage_rejects_batch_over_limit_without_counting(limited_manager):
+    limit = PLAN_LIMITS['free']
+    ok, _ = limited_manager.reserve_usage('U1', limit - 2)
+    assert ok
+    ok, _ = limited_manager.reserve_usage('U1', 3)
+    assert not ok
+    assert limited_manager.get_current_monthly_usage('U1') == limit - 2
+
+
+def test_release_usage_returns_reservation(limited_manager):
+    ok, _ = limited_manager.reserve_usage('U1', 4)
+    assert ok
+    limited_manager.release_usage('U1', 4)
+    assert limited_manager.get_current_monthly_usage('U1') == 0
+
+
+def test_monthly_usage_is_read_from_rollup(tmp_path, monkeypatch):
+    monkeypatch.delenv('USAGE_LIMITS_ENABLED', raising=False)
+    monkeypatch.setenv('USAGE_ASYNC', '0')
+    manager = UserManager(db_path=str(tmp_path / 'users.db'))
+    try:
+        manager.register_user('U1', 'テストユーザー')
+        manager.increment_usage('U1', 'add_product', {'商品名': 'マット'})
+        manager.increment_usage_batch('U1', 'add_product', [{'商品名': 'モップ'}, {'商品名': 'タオル'}])
+        assert manager.get_current_monthly_usage('U1') == 3
+        assert manager.get_user_info('U1')['monthly_usage'] == 3
+        # usersテーブルの旧カウンタには書き込まない
+        row = manager.db.execute('SELECT monthly_usage FROM users WHERE user_id = ?', ('U1',)).fetchone()
+        assert row[0] == 0
+    finally:
+        manager.close()
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """件数の上限（LRUで追い出し）と有効期間つきのスレッドセーフなキャッシュ
+
+    値にNoneは保存しない（get()のNoneは「キャッシュになし」を表す）。
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=600):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def get(self, key):
+        """キャッシュ済みの値を返す（なし・期限切れの場合はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """値を保存し、上限を超えた分は最も古く使われたものから追い出す"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def discard(self, key):
+        """1件を破棄（なければ何もしない）"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def discard_matching(self, predicate):
+        """キーがpredicateを満たすものをすべて破棄"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        """すべて破棄"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """件数・ヒット数などの統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+        return stats
@@ -0,0 +1,169 @@
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+
+from metrics import LatencyRecorder
+
+_FLUSH = object()
+_STOP = object()
+
+# 月別利用回数のロールアップ（usage_history挿入と同じトランザクションで加算する）
+USAGE_MONTHLY_UPSERT = '''
+    INSERT INTO usage_monthly (user_id, year_month, count) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, year_month) DO UPDATE SET count = count + excluded.count
+'''
+
+
+def current_year_month():
+    """ロールアップのキーにする年月（ローカル時刻、'YYYY-MM'）"""
+    return datetime.now().strftime('%Y-%m')
+
+
+class UsageRecorder:
+    def __init__(self, db, flush_batch=50, flush_interval_ms=500, update_rollup=True):
+        """利用履歴をバッファしてまとめて書き込むクラス
+
+        record()はキューに積むだけで戻り、バックグラウンドのスレッドが
+        flush_batch件またはflush_interval_msごとに1トランザクションで
+        usage_historyへのINSERTとusage_monthlyの加算を行う。
+        利用回数はusage_monthlyから読むので、書き込み後にプロフィールのキャッシュは破棄しない。
+        update_rollup=Falseの場合、usage_monthlyは呼び出し側で加算済みとして扱う。
+        """
+        self.db = db
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval_ms / 1000
+        self.update_rollup = update_rollup
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.flush_latency = LatencyRecorder()
+        self.lag = LatencyRecorder()  # record()からコミットまでの時間
+        self.stats = {
+            'recorded': 0,
+            'flushed': 0,
+            'flushes': 0,
+            'errors': 0,
+            'dropped': 0
+        }
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='usage-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, user_id, action_type, action_data):
+        """利用イベントをバッファに追加（書き込みはバックグラウンドで行う）
+
+        close()の開始後はFalseを返すので、呼び出し側で同期的に書き込む。
+        """
+        with self._lock:
+            # 停止の番兵より後ろに積むと書き込まれずに失われるため、close()と排他する
+            if self._closed:
+                return False
+            self._queue.put((user_id, action_type, action_data, time.monotonic(), current_year_month()))
+            self.stats['recorded'] += 1
+        return True
+
+    def record_many(self, user_id, action_type, action_data_list):
+        """同じユーザー・同じ種類の利用イベントをまとめてバッファに追加（一括登録用）"""
+        queued_at = time.monotonic()
+        year_month = current_year_month()
+        with self._lock:
+            if self._closed:
+                return False
+            for action_data in action_data_list:
+                self._queue.put((user_id, action_type, action_data, queued_at, year_month))
+            self.stats['recorded'] += len(action_data_list)
+        return True
+
+    def flush(self, timeout=5):
+        """バッファに溜まったイベントを書き込むまで待つ"""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        """残りのイベントを書き込んでスレッドを終了（プロセス終了時）"""
+        with self._lock:
+            if self._closed:
+                return
+            # 以降のrecord()はFalseを返すので、番兵の後ろにイベントが積まれることはない
+            self._closed = True
+            self._queue.put((_STOP, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        pending = []
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, pending[0][3] + self.flush_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None:
+                # 最初のイベントからflush_interval経過
+                pending = self._flush(pending)
+            elif item[0] is _FLUSH:
+                pending = self._flush(pending)
+                item[1].set()
+            elif item[0] is _STOP:
+                self._flush(pending)
+                return
+            else:
+                pending.append(item)
+                if len(pending) >= self.flush_batch:
+                    pending = self._flush(pending)
+
+    def _flush(self, events, attempts=3):
+        """イベントを1トランザクションで書き込み（attempts回失敗したら破棄して統計に記録）"""
+        if not events:
+            return []
+        started = time.monotonic()
+        monthly_counts = {}
+        for user_id, _, _, _, year_month in events:
+            monthly_counts[(user_id, year_month)] = monthly_counts.get((user_id, year_month), 0) + 1
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO usage_history (user_id, action_type, action_data)
+                    VALUES (?, ?, ?)
+                ''', [
+                    (user_id, action_type, json.dumps(action_data, ensure_ascii=False))
+                    for user_id, action_type, action_data, _, _ in events
+                ])
+                if self.update_rollup:
+                    conn.executemany(USAGE_MONTHLY_UPSERT, [
+                        (user_id, year_month, count) for (user_id, year_month), count in monthly_counts.items()
+                    ])
+        except Exception as e:
+            print(f"利用履歴の書き込みエラー: {e}")
+            with self._lock:
+                self.stats['errors'] += 1
+            if attempts <= 1:
+                with self._lock:
+                    self.stats['dropped'] += len(events)
+                return []
+            time.sleep(0.1)
+            return self._flush(events, attempts - 1)
+
+        finished = time.monotonic()
+        self.flush_latency.record((finished - started) * 1000)
+        for event in events:
+            self.lag.record((finished - event[3]) * 1000)
+        with self._lock:
+            self.stats['flushed'] += len(events)
+            self.stats['flushes'] += 1
+        return []
+
+    def get_stats(self):
+        """書き込み件数・フラッシュ時間・遅延の統計情報を取得"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['pending'] = self._queue.qsize()
+        stats['flush_latency'] = self.flush_latency.snapshot()
+        stats['lag'] = self.lag.snapshot()
+        return stats
@@ -1,7 +1,94 @@
 import sqlite3
 import os
-from datetime import datetime, timedelta
+import threading
+import time
 import json
+from dataclasses import dataclass
+from database import SQLiteConnectionManager
+from ttl_cache import TTLCache
+from usage_recorder import UsageRecorder, USAGE_MONTHLY_UPSERT, current_year_month
+
+# 利用回数（usage_monthly）は書き込みのたびに変わるのでキャッシュに含めない
+PROFILE_COLUMNS = '''user_id, display_name, plan_type, is_active,
+                   spreadsheet_id, sheet_name, excel_online_url, excel_file_id, excel_sheet_name'''
+
+# プランごとの月間利用上限
+PLAN_LIMITS = {
+    'free': 10,
+    'basic': 100,
+    'pro': 999999
+}
+
+# INSERT ... RETURNINGはSQLite 3.35以降
+SQLITE_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+@dataclass
+class UserProfile:
+    """1イベントの処理で使うユーザー情報と書き込み先（usersテーブルの1行）"""
+    __slots__ = (
+        'user_id', 'display_name', 'plan_type', 'is_active',
+        'spreadsheet_id', 'sheet_name', 'excel_online_url', 'excel_file_id', 'excel_sheet_name'
+    )
+    user_id: str
+    display_name: str
+    plan_type: str
+    is_active: bool
+    spreadsheet_id: str
+    sheet_name: str
+    excel_online_url: str
+    excel_file_id: str
+    excel_sheet_name: str
+
+    @property
+    def uses_excel_online(self):
+        """Excel Onlineが書き込み先として登録されているか"""
+        return bool(self.excel_online_url and self.excel_file_id)
+
+    def google_sheets_target(self):
+        """get_user_spreadsheet()と同じ(spreadsheet_id, sheet_name)"""
+        return self.spreadsheet_id, self.sheet_name
+
+    def excel_online_target(self):
+        """get_user_excel_online()と同じ(excel_url, file_id, sheet_name)"""
+        return self.excel_online_url, self.excel_file_id, self.excel_sheet_name
+
+class UserProfileCache:
+    def __init__(self, max_entries=1024, ttl_seconds=300):
+        """user_idごとのUserProfileのLRU+TTLキャッシュ"""
+        self._entries = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._lock = threading.Lock()
+        self._generation = 0  # 無効化のたびに増やし、読み込み中に無効化された値は保存しない
+        self.clears = 0
+
+    def get(self, user_id):
+        """キャッシュ済みのプロフィールと現在の世代を返す（なければプロフィールはNone）"""
+        with self._lock:
+            return self._entries.get(user_id), self._generation
+
+    def put(self, user_id, profile, generation):
+        """読み込み開始時の世代から変わっていなければ保存"""
+        with self._lock:
+            if generation == self._generation:
+                self._entries.put(user_id, profile)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.discard(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.clears += 1
+
+    def get_stats(self):
+        """ヒット率などの統計情報を取得"""
+        stats = self._entries.get_stats()
+        stats['clears'] = self.clears
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
 
 class UserManager:
     def __init__(self, db_path=None):
@@ -13,12 +100,51 @@ class UserManager:
                 self.db_path = 'users.db'
         else:
             self.db_path = db_path
+        self.db = SQLiteConnectionManager(
+            self.db_path,
+            busy_timeout_ms=int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+        )
+        self._change_listeners = []
+        self.profile_cache = UserProfileCache(
+            max_entries=int(os.environ.get('PROFILE_CACHE_SIZE', 1024)),
+            ttl_seconds=int(os.environ.get('PROFILE_CACHE_TTL', 300))
+        )
+        # 複数プロセス構成ではcache_versionsテーブルのバージョンで他プロセスの変更を検知
+        self.profile_cache_shared = os.environ.get('PROFILE_CACHE_SHARED') == '1'
+        self.profile_version_poll_seconds = float(os.environ.get('PROFILE_CACHE_POLL_SECONDS', 2))
+        self._profile_version = None
+        self._profile_version_checked_at = 0.0
+        self._profile_version_lock = threading.Lock()
+        # USAGE_LIMITS_ENABLED=1でプランごとの利用制限を有効化（既定は開発者モードで無制限）
+        self.usage_limits_enabled = os.environ.get('USAGE_LIMITS_ENABLED') == '1'
         self.init_database()
+        # 利用履歴はバッファしてまとめて書き込む（USAGE_ASYNC=0で従来どおり同期書き込み）
+        self.usage_recorder = None
+        if os.environ.get('USAGE_ASYNC', '1') == '1':
+            self.usage_recorder = UsageRecorder(
+                self.db,
+                flush_batch=int(os.environ.get('USAGE_FLUSH_BATCH', 50)),
+                flush_interval_ms=int(os.environ.get('USAGE_FLUSH_INTERVAL_MS', 500)),
+                # 利用制限が有効な場合、usage_monthlyはreserve_usage()で加算済み
+                update_rollup=not self.usage_limits_enabled
+            )
+
+    def add_change_listener(self, callback):
+        """ユーザーの書き込み先などが変更されたときに呼ばれるコールバックを登録"""
+        self._change_listeners.append(callback)
+
+    def _notify_change(self, user_id, change_type, old_values, new_values):
+        """登録済みのコールバックに変更を通知（コールバックの失敗は無視）"""
+        for callback in self._change_listeners:
+            try:
+                callback(user_id, change_type, old_values, new_values)
+            except Exception as e:
+                print(f"変更通知エラー: {e}")
     
     def init_database(self):
         """データベースの初期化"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.db.connection()
             cursor = conn.cursor()
             
             # ユーザーテーブルの作成（スプレッドシート管理機能を追加）
@@ -28,8 +154,8 @@ class UserManager:
                     display_name TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     plan_type TEXT DEFAULT 'free',
-                    monthly_usage INTEGER DEFAULT 0,
-                    last_reset_date DATE DEFAULT CURRENT_DATE,
+                    monthly_usage INTEGER DEFAULT 0,  -- 未使用（利用回数はusage_monthly）
+                    last_reset_date DATE DEFAULT CURRENT_DATE,  -- 未使用
                     is_active BOOLEAN DEFAULT 1,
                     spreadsheet_id TEXT,
                     sheet_name TEXT DEFAULT '比較見積書 ロング',
@@ -65,6 +191,15 @@ class UserManager:
             except sqlite3.OperationalError:
                 pass  # カラムが既に存在する場合
             
+            # キャッシュ無効化用のバージョン（プロセス間で共有）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cache_versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('user_profiles', 0)")
+            
             # 利用履歴テーブルの作成
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS usage_history (
@@ -76,45 +211,68 @@ class UserManager:
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
             ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_usage_history_user_created
+                ON usage_history (user_id, created_at)
+            ''')
+            
+            # 月別利用回数のロールアップテーブル
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS usage_monthly (
+                    user_id TEXT,
+                    year_month TEXT,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, year_month)
+                )
+            ''')
+            
+            # 既存のusers.dbは利用履歴からロールアップを作成（PRAGMA user_versionで1回だけ）
+            schema_version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if schema_version < 1:
+                cursor.execute('DELETE FROM usage_monthly')
+                cursor.execute('''
+                    INSERT INTO usage_monthly (user_id, year_month, count)
+                    SELECT user_id, strftime('%Y-%m', created_at, 'localtime'), COUNT(*)
+                    FROM usage_history
+                    WHERE user_id IS NOT NULL
+                    GROUP BY user_id, strftime('%Y-%m', created_at, 'localtime')
+                ''')
+                cursor.execute('PRAGMA user_version = 1')
+                print("usage_monthlyを利用履歴から作成しました")
             
             conn.commit()
-            conn.close()
             print(f"Database initialized successfully at {self.db_path}")
         except Exception as e:
             print(f"Database initialization error: {e}")
+            try:
+                self.db.connection().rollback()
+            except Exception:
+                pass
             # エラーが発生してもアプリケーションは継続
             pass
     
     def register_user(self, user_id, display_name):
         """新規ユーザー登録"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                INSERT OR IGNORE INTO users (user_id, display_name)
-                VALUES (?, ?)
-            ''', (user_id, display_name))
-            
-            conn.commit()
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    INSERT OR IGNORE INTO users (user_id, display_name)
+                    VALUES (?, ?)
+                ''', (user_id, display_name))
+            self.invalidate_user_profile(user_id)
             return True, "ユーザー登録完了"
         except Exception as e:
             return False, f"登録エラー: {str(e)}"
-        finally:
-            conn.close()
     
     def get_user_info(self, user_id):
-        """ユーザー情報取得"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT user_id, display_name, plan_type, monthly_usage, last_reset_date, is_active
-            FROM users WHERE user_id = ?
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        """ユーザー情報取得（今月の利用回数はusage_monthlyから読む）"""
+        year_month = current_year_month()
+        result = self.db.execute('''
+            SELECT u.user_id, u.display_name, u.plan_type, COALESCE(m.count, 0), u.is_active
+            FROM users u
+            LEFT JOIN usage_monthly m ON m.user_id = u.user_id AND m.year_month = ?
+            WHERE u.user_id = ?
+        ''', (year_month, user_id)).fetchone()
         
         if result:
             return {
@@ -122,122 +280,237 @@ class UserManager:
                 'display_name': result[1],
                 'plan_type': result[2],
                 'monthly_usage': result[3],
-                'last_reset_date': result[4],
-                'is_active': result[5]
+                'year_month': year_month,
+                'is_active': result[4]
             }
         return None
     
-    def check_usage_limit(self, user_id):
-        """利用制限チェック（開発者用：一時的に無効化）"""
-        # 開発者用：利用制限を一時的に無効化
-        return True, "開発者モード：利用制限なし"
+    def get_user_profile(self, user_id):
+        """ユーザー情報と書き込み先を取得（キャッシュになければ1回のクエリで読み込み、未登録ならNone）"""
+        if self.profile_cache_shared:
+            self._check_profile_version()
+        profile, generation = self.profile_cache.get(user_id)
+        if profile is not None:
+            return profile
+        result = self.db.execute(f'SELECT {PROFILE_COLUMNS} FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if not result:
+            return None
+        profile = UserProfile(*result)
+        self.profile_cache.put(user_id, profile, generation)
+        return profile
+    
+    def ensure_user(self, user_id, display_name="LINE User"):
+        """未登録なら登録し、プロフィールを返す（戻り値は(profile, 新規登録したか)）
+        
+        キャッシュになければINSERT ... ON CONFLICT DO NOTHING RETURNINGで登録と取得を
+        1文で行い、既存ユーザーで行が返らなかった場合だけSELECTする。
+        """
+        if self.profile_cache_shared:
+            self._check_profile_version()
+        profile, generation = self.profile_cache.get(user_id)
+        if profile is not None:
+            return profile, False
         
-        # 元のコード（コメントアウト）
-        # user_info = self.get_user_info(user_id)
-        # if not user_info:
-        #     return False, "ユーザーが見つかりません"
-        # 
-        # # 月次リセット処理
-        # self.reset_monthly_usage_if_needed(user_id)
-        # 
-        # # 利用制限チェック
-        # if user_info['plan_type'] == 'free':
-        #     limit = 10
-        # elif user_info['plan_type'] == 'basic':
-        #     limit = 100
-        # else:  # pro
-        #     limit = 999999
-        # 
-        # current_usage = self.get_current_monthly_usage(user_id)
-        # 
-        # if current_usage >= limit:
-        #     return False, f"利用制限に達しました（月{limit}件まで）"
-        # 
-        # return True, f"利用可能（残り{limit - current_usage}件）"
+        with self.db.transaction() as conn:
+            if SQLITE_SUPPORTS_RETURNING:
+                result = conn.execute(f'''
+                    INSERT INTO users (user_id, display_name) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO NOTHING
+                    RETURNING {PROFILE_COLUMNS}
+                ''', (user_id, display_name)).fetchone()
+                created = result is not None
+            else:
+                created = conn.execute('''
+                    INSERT OR IGNORE INTO users (user_id, display_name) VALUES (?, ?)
+                ''', (user_id, display_name)).rowcount == 1
+                result = None
+        if result is None:
+            result = self.db.execute(f'SELECT {PROFILE_COLUMNS} FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if result is None:
+            return None, created
+        profile = UserProfile(*result)
+        self.profile_cache.put(user_id, profile, generation)
+        return profile, created
+    
+    def _read_profile_version(self):
+        row = self.db.execute("SELECT version FROM cache_versions WHERE name = 'user_profiles'").fetchone()
+        return row[0] if row else 0
     
-    def reset_monthly_usage_if_needed(self, user_id):
-        """月次利用回数のリセット"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _check_profile_version(self):
+        """他プロセスがプロフィールを変更していたらキャッシュを破棄（poll間隔ごとに1回だけ確認）"""
+        now = time.monotonic()
+        if now - self._profile_version_checked_at < self.profile_version_poll_seconds:
+            return
+        with self._profile_version_lock:
+            if now - self._profile_version_checked_at < self.profile_version_poll_seconds:
+                return
+            self._profile_version_checked_at = now
+            try:
+                version = self._read_profile_version()
+            except Exception as e:
+                print(f"プロフィールバージョン確認エラー: {e}")
+                return
+            if self._profile_version is not None and version != self._profile_version:
+                self.profile_cache.clear()
+            self._profile_version = version
+    
+    def invalidate_user_profile(self, user_id):
+        """プロフィールのキャッシュを破棄（共有モードでは他プロセスにも通知）
         
-        cursor.execute('''
-            SELECT last_reset_date FROM users WHERE user_id = ?
-        ''', (user_id,))
+        プラン・書き込み先・表示名など、キャッシュに含む項目を変更したときだけ呼ぶ。
+        利用回数の記録では呼ばない（共有モードでは全プロセスのキャッシュが消えるため）。
+        """
+        self.profile_cache.invalidate(user_id)
+        if not self.profile_cache_shared:
+            return
+        try:
+            with self._profile_version_lock:
+                before = self._read_profile_version()
+                with self.db.transaction() as conn:
+                    conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'user_profiles'")
+                after = self._read_profile_version()
+                # 自分の更新だけならキャッシュ全体は破棄しない
+                if self._profile_version == before and after == before + 1:
+                    self._profile_version = after
+        except Exception as e:
+            print(f"プロフィールバージョン更新エラー: {e}")
+    
+    def _get_usage_limit(self, user_id):
+        profile = self.get_user_profile(user_id)
+        if not profile:
+            return None
+        return PLAN_LIMITS.get(profile.plan_type, PLAN_LIMITS['pro'])
+    
+    def check_usage_limit(self, user_id):
+        """利用制限チェック（読み取りのみ。書き込み前の確保はreserve_usage()を使う）"""
+        if not self.usage_limits_enabled:
+            # 開発者用：利用制限を一時的に無効化
+            return True, "開発者モード：利用制限なし"
         
-        result = cursor.fetchone()
-        if result:
-            last_reset = datetime.strptime(result[0], '%Y-%m-%d')
-            current_date = datetime.now().date()
-            
-            # 月が変わったらリセット
-            if last_reset.month != current_date.month or last_reset.year != current_date.year:
-                cursor.execute('''
-                    UPDATE users 
-                    SET monthly_usage = 0, last_reset_date = ?
-                    WHERE user_id = ?
-                ''', (current_date, user_id))
-                
-                conn.commit()
+        limit = self._get_usage_limit(user_id)
+        if limit is None:
+            return False, "ユーザーが見つかりません"
         
-        conn.close()
+        current_usage = self.get_current_monthly_usage(user_id)
+        if current_usage >= limit:
+            return False, f"利用制限に達しました（月{limit}件まで）"
+        
+        return True, f"利用可能（残り{limit - current_usage}件）"
     
-    def get_current_monthly_usage(self, user_id):
-        """現在の月次利用回数を取得"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def reserve_usage(self, user_id, count=1):
+        """利用制限の確認と今月の利用回数の加算を1文で行う
         
-        cursor.execute('''
-            SELECT monthly_usage FROM users WHERE user_id = ?
-        ''', (user_id,))
+        usage_monthlyの(user_id, 年月)の行を上限以下の場合だけ加算するので、
+        月が変わった最初の利用で新しい行ができ、リセットの書き込みは不要。
+        同時に呼ばれても上限を超えて加算されることはない。
+        書き込みに失敗した場合はrelease_usage()で戻す。
+        """
+        if not self.usage_limits_enabled:
+            return True, "開発者モード：利用制限なし"
         
-        result = cursor.fetchone()
-        conn.close()
+        limit = self._get_usage_limit(user_id)
+        if limit is None:
+            return False, "ユーザーが見つかりません"
+        if count > limit:
+            return False, f"利用制限に達しました（月{limit}件まで）"
+        
+        with self.db.transaction() as conn:
+            reserved = conn.execute('''
+                INSERT INTO usage_monthly (user_id, year_month, count) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, year_month) DO UPDATE SET count = count + excluded.count
+                WHERE count + excluded.count <= ?
+            ''', (user_id, current_year_month(), count, limit)).rowcount == 1
+        if not reserved:
+            return False, f"利用制限に達しました（月{limit}件まで）"
+        return True, "利用回数を確保しました"
+    
+    def release_usage(self, user_id, count=1):
+        """reserve_usage()で確保した利用回数を戻す（書き込み失敗時）"""
+        if not self.usage_limits_enabled:
+            return
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    UPDATE usage_monthly SET count = MAX(count - ?, 0)
+                    WHERE user_id = ? AND year_month = ?
+                ''', (count, user_id, current_year_month()))
+        except Exception as e:
+            print(f"利用回数の戻しエラー: {e}")
+    
+    def get_current_monthly_usage(self, user_id):
+        """現在の月次利用回数を取得（usage_monthlyの1行を読む）"""
+        result = self.db.execute('''
+            SELECT count FROM usage_monthly WHERE user_id = ? AND year_month = ?
+        ''', (user_id, current_year_month())).fetchone()
         
         return result[0] if result else 0
     
     def increment_usage(self, user_id, action_type, action_data):
         """利用回数を増加"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
+        if self.usage_recorder and self.usage_recorder.record(user_id, action_type, action_data):
+            return True, "利用回数を記録しました"
         try:
-            # 利用回数を増加
-            cursor.execute('''
-                UPDATE users 
-                SET monthly_usage = monthly_usage + 1
-                WHERE user_id = ?
-            ''', (user_id,))
-            
-            # 利用履歴を記録
-            cursor.execute('''
-                INSERT INTO usage_history (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, action_type, json.dumps(action_data, ensure_ascii=False)))
-            
-            conn.commit()
+            with self.db.transaction() as conn:
+                # 利用履歴を記録（利用回数はusage_monthlyで数える）
+                conn.execute('''
+                    INSERT INTO usage_history (user_id, action_type, action_data)
+                    VALUES (?, ?, ?)
+                ''', (user_id, action_type, json.dumps(action_data, ensure_ascii=False)))
+                if not self.usage_limits_enabled:
+                    # 利用制限が有効な場合はreserve_usage()で加算済み
+                    conn.execute(USAGE_MONTHLY_UPSERT, (user_id, current_year_month(), 1))
             return True, "利用回数を記録しました"
         except Exception as e:
             return False, f"記録エラー: {str(e)}"
-        finally:
-            conn.close()
+    
+    def increment_usage_batch(self, user_id, action_type, action_data_list):
+        """複数件の利用回数をまとめて記録（一括登録用、同期モードでは1トランザクション）"""
+        count = len(action_data_list)
+        if not count:
+            return True, "記録する利用はありません"
+        if self.usage_recorder and self.usage_recorder.record_many(user_id, action_type, action_data_list):
+            return True, f"利用回数を{count}件記録しました"
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO usage_history (user_id, action_type, action_data)
+                    VALUES (?, ?, ?)
+                ''', [
+                    (user_id, action_type, json.dumps(action_data, ensure_ascii=False))
+                    for action_data in action_data_list
+                ])
+                if not self.usage_limits_enabled:
+                    # 利用制限が有効な場合はreserve_usage()で加算済み
+                    conn.execute(USAGE_MONTHLY_UPSERT, (user_id, current_year_month(), count))
+            return True, f"利用回数を{count}件記録しました"
+        except Exception as e:
+            return False, f"記録エラー: {str(e)}"
+    
+    def flush_usage(self):
+        """バッファ中の利用履歴を書き込む（最新の利用回数を読む前に呼ぶ）"""
+        if self.usage_recorder:
+            self.usage_recorder.flush()
     
     def get_usage_summary(self, user_id):
         """利用状況サマリー取得"""
+        self.flush_usage()
         user_info = self.get_user_info(user_id)
         if not user_info:
             return "ユーザーが見つかりません"
         
+        # 利用回数はusage_monthlyの今月の行なので、月が変わると自動的に0から数え直す
+        year_month = current_year_month()
+        year, month = map(int, year_month.split('-'))
+        next_reset = f"{year + month // 12}-{month % 12 + 1:02d}-01"
         current_usage = self.get_current_monthly_usage(user_id)
         
         if user_info['plan_type'] == 'free':
-            limit = 10
             plan_name = "無料プラン"
         elif user_info['plan_type'] == 'basic':
-            limit = 100
             plan_name = "ベーシックプラン"
         else:
-            limit = 999999
             plan_name = "プロプラン"
+        limit = PLAN_LIMITS.get(user_info['plan_type'], PLAN_LIMITS['pro'])
         
         remaining = max(0, limit - current_usage)
         
@@ -245,44 +518,44 @@ class UserManager:
         summary += f"プラン: {plan_name}\n"
         summary += f"今月の利用回数: {current_usage}回\n"
         summary += f"残り利用回数: {remaining}回\n"
-        summary += f"リセット日: {user_info['last_reset_date']}"
+        summary += f"集計月: {year_month}\n"
+        summary += f"次回リセット日: {next_reset}"
         
         return summary
     
     def upgrade_plan(self, user_id, plan_type):
         """プランアップグレード"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                UPDATE users 
-                SET plan_type = ?
-                WHERE user_id = ?
-            ''', (plan_type, user_id))
-            
-            conn.commit()
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    UPDATE users 
+                    SET plan_type = ?
+                    WHERE user_id = ?
+                ''', (plan_type, user_id))
+            self.invalidate_user_profile(user_id)
             return True
         except Exception as e:
             print(f"Plan upgrade error: {e}")
             return False
-        finally:
-            conn.close()
 
     def set_user_spreadsheet(self, user_id, spreadsheet_id, sheet_name="比較見積書 ロング"):
         """顧客のスプレッドシートIDを設定"""
         print(f"set_user_spreadsheet: user_id={user_id}, spreadsheet_id={spreadsheet_id}, sheet_name={sheet_name}")
         try:
             # --- シート名を正規化 ---
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET spreadsheet_id = ?, sheet_name = ?
-                WHERE user_id = ?
-            ''', (spreadsheet_id, sheet_name, user_id))
-            conn.commit()
-            conn.close()
+            with self.db.transaction() as conn:
+                old = conn.execute('SELECT spreadsheet_id, sheet_name FROM users WHERE user_id = ?', (user_id,)).fetchone() or (None, None)
+                conn.execute('''
+                    UPDATE users 
+                    SET spreadsheet_id = ?, sheet_name = ?
+                    WHERE user_id = ?
+                ''', (spreadsheet_id, sheet_name, user_id))
+            self.invalidate_user_profile(user_id)
+            self._notify_change(
+                user_id, 'spreadsheet',
+                {'spreadsheet_id': old[0], 'sheet_name': old[1]},
+                {'spreadsheet_id': spreadsheet_id, 'sheet_name': sheet_name}
+            )
             return True, "スプレッドシートを登録しました"
         except Exception as e:
             return False, f"登録エラー: {str(e)}"
@@ -290,11 +563,7 @@ class UserManager:
     def get_user_spreadsheet(self, user_id):
         """顧客のスプレッドシートIDを取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT spreadsheet_id, sheet_name FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
+            result = self.db.execute('SELECT spreadsheet_id, sheet_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
             if result:
                 print(f"get_user_spreadsheet: user_id={user_id}, spreadsheet_id={result[0]}, sheet_name={result[1]}")
                 # --- シート名を正規化 ---
@@ -307,15 +576,13 @@ class UserManager:
         """顧客のExcel Online設定を保存"""
         print(f"set_user_excel_online: user_id={user_id}, excel_url={excel_url}, file_id={file_id}, sheet_name={sheet_name}")
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET excel_online_url = ?, excel_file_id = ?, excel_sheet_name = ?
-                WHERE user_id = ?
-            ''', (excel_url, file_id, sheet_name, user_id))
-            conn.commit()
-            conn.close()
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    UPDATE users 
+                    SET excel_online_url = ?, excel_file_id = ?, excel_sheet_name = ?
+                    WHERE user_id = ?
+                ''', (excel_url, file_id, sheet_name, user_id))
+            self.invalidate_user_profile(user_id)
             return True, "Excel Online設定を登録しました"
         except Exception as e:
             return False, f"登録エラー: {str(e)}"
@@ -323,14 +590,16 @@ class UserManager:
     def get_user_excel_online(self, user_id):
         """顧客のExcel Online設定を取得"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT excel_online_url, excel_file_id, excel_sheet_name FROM users WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            conn.close()
+            result = self.db.execute('SELECT excel_online_url, excel_file_id, excel_sheet_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
             if result:
                 print(f"get_user_excel_online: user_id={user_id}, excel_url={result[0]}, file_id={result[1]}, sheet_name={result[2]}")
                 return result[0], result[1], result[2]
             return (None, None, None)
         except Exception as e:
-            return None, None, None 
\ No newline at end of file
+            return None, None, None
+
+    def close(self):
+        """バッファ中の利用履歴を書き込んでからデータベース接続をすべて閉じる"""
+        if self.usage_recorder:
+            self.usage_recorder.close()
+        self.db.close()